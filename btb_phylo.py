@@ -1,24 +1,18 @@
 import argparse
 import json
 import os
-import subprocess
 import shutil
-import sys
 import tempfile
-import io
 from datetime import datetime
-from contextlib import redirect_stdout
 import threading
+from concurrent.futures import ThreadPoolExecutor
+import functools
 
-import pandas as pd
+# btbphylo.paths only uses the standard library
+from btbphylo.paths import DEFAULT_WGS_SAMPLES_FILEPATH
 
-import btbphylo.utils as utils
-import btbphylo.update_summary as update_summary
-import btbphylo.de_duplicate as de_duplicate
-import btbphylo.consistify as consistify
-import btbphylo.missing_samples_report as missing_samples_report
-import btbphylo.filter_samples as filter_samples
-import btbphylo.phylogeny as phylogeny
+# pandas and the other btbphylo modules are imported by the sub-commands
+# which use them, so that parsing arguments (e.g. --help) stays fast
 
 DEFAULT_CLADE_INFO_PATH = \
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
@@ -28,9 +22,13 @@ DEFAULT_OUTLIERS_PATH = \
     os.path.join(os.path.dirname(os.path.abspath(__file__)),
                  "accessory/outliers.txt")
 
+# columns of the filtered samples csv used by phylo()
+PHYLO_COLUMNS = ["Sample", "ResultLoc"]
+
 
 def update_samples(results_path,
-                   all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
+                   all_wgs_samples_filepath=DEFAULT_WGS_SAMPLES_FILEPATH,
+                   n_workers=32):
     """
         Updates the local copy of the 'all_wgs_samples' .csv file
         containing WGS metadata for all WGS samples. Or builds a new
@@ -44,6 +42,9 @@ def update_samples(results_path,
             all_wgs_samples_filepath (str): path to location of
             summary csv
 
+            n_workers (int): number of threads for downloading
+            FinalOut.csv files
+
         Returns:
             metadata (dict): metadata relating to the complete
             (unfiltered) dataset
@@ -52,10 +53,11 @@ def update_samples(results_path,
             dataframe containing all WGS samples held in s3-csu-003.
     """
     print("\n## Update Summary ##\n")
+    import btbphylo.utils as utils
+    import btbphylo.update_summary as update_summary
     # create metadata path
     metadata_path = os.path.join(results_path, "metadata")
-    if not os.path.exists(metadata_path):
-        os.makedirs(metadata_path)
+    os.makedirs(metadata_path, exist_ok=True)
     print("\tloading all_wgs_samples.csv ... \n")
     # download sample summary csv
     df_all_wgs = update_summary.get_df_wgs(all_wgs_samples_filepath)
@@ -72,18 +74,22 @@ def update_samples(results_path,
     print("\tappending new metadata to df_summary ... \n")
     # update the summary dataframe
     df_all_wgs_updated, metadata = update_summary.append_df_wgs(df_all_wgs,
-                                                                new_keys)
+                                                                new_keys,
+                                                                n_workers)
     print("\tsaving all_wgs_samples.csv ... \n")
-    # save summary to csv
-    utils.df_to_csv(df_all_wgs_updated, all_wgs_samples_filepath)
-    # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath, os.path.join(metadata_path,
-                                                       "all_wgs_samples.csv"))
+    # save summary to csv, with a parquet mirror for sample_filter()
+    utils.df_to_csv(df_all_wgs_updated, all_wgs_samples_filepath,
+                    parquet=True)
+    # link (or copy) all_wgs_samples.csv into metadata; only the first
+    # stage of a pipeline does any work
+    utils.link_or_copy_summary(all_wgs_samples_filepath,
+                               os.path.join(metadata_path,
+                                            "all_wgs_samples.csv"))
     return metadata, df_all_wgs_updated
 
 
 def de_duplicate_samples(results_path, df_wgs_samples=None,
-                         all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
+                         all_wgs_samples_filepath=DEFAULT_WGS_SAMPLES_FILEPATH,
                          **kwargs):
     """
         'De-duplicates' WGS samples in df_wgs_samples. Removes dupliacte
@@ -110,11 +116,12 @@ def de_duplicate_samples(results_path, df_wgs_samples=None,
             of df_samples
 
     """
+    import btbphylo.utils as utils
+    import btbphylo.de_duplicate as de_duplicate
     print("\n## De-Duplicate ##\n")
     # create metadatapath
     metadata_path = os.path.join(results_path, "metadata")
-    if not os.path.exists(metadata_path):
-        os.makedirs(metadata_path)
+    os.makedirs(metadata_path, exist_ok=True)
     # remove unused kwargs
     args = {k: v for k, v in kwargs.items() if v is not None}
     # load df_samples from summary csv if dataframe not provided
@@ -137,14 +144,16 @@ def de_duplicate_samples(results_path, df_wgs_samples=None,
     print("\tsaving deduped_wgs_samples.csv ... \n")
     df_wgs_deduped.to_csv(os.path.join(metadata_path,
                           "deduped_wgs.csv"), index=False)
-    # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath, os.path.join(metadata_path,
-                "all_wgs_samples.csv"))
+    # link (or copy) all_wgs_samples.csv into metadata; only the first
+    # stage of a pipeline does any work
+    utils.link_or_copy_summary(all_wgs_samples_filepath,
+                               os.path.join(metadata_path,
+                                            "all_wgs_samples.csv"))
     return metadata, df_wgs_deduped
 
 
 def consistify_samples(results_path, cattle_movements_path, df_wgs_samples=None,
-                       all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
+                       all_wgs_samples_filepath=DEFAULT_WGS_SAMPLES_FILEPATH):
     """
         'Consistifies' WGS samples with cattle and movement samples;
         removes samples from each dataset that aren't present in all
@@ -178,6 +187,9 @@ def consistify_samples(results_path, cattle_movements_path, df_wgs_samples=None,
             df_wgs_consist (pandas DataFrame object): consistified wgs
             samples; contains the same fields as the summary csv
     """
+    import pandas as pd
+    import btbphylo.utils as utils
+    import btbphylo.consistify as consistify
     print("\n## Consistify ##\n")
     # cattle and movement csv filepaths
     cattle_filepath = f"{cattle_movements_path}/cattle.csv"
@@ -191,8 +203,7 @@ def consistify_samples(results_path, cattle_movements_path, df_wgs_samples=None,
             {cattle_movements_path}")
     # create metadatapath
     metadata_path = os.path.join(results_path, "metadata")
-    if not os.path.exists(metadata_path):
-        os.makedirs(metadata_path)
+    os.makedirs(metadata_path, exist_ok=True)
     # consistified file outpaths
     consistified_wgs_filepath = os.path.join(metadata_path,
                                              "consistified_wgs.csv")
@@ -217,20 +228,24 @@ def consistify_samples(results_path, cattle_movements_path, df_wgs_samples=None,
     t.join()
     # save consistified cattle & movement csvs
     print("\tsaving metadata files ... \n")
-    utils.df_to_csv(df_wgs_consist, consistified_wgs_filepath)
+    utils.df_to_csv(df_wgs_consist, consistified_wgs_filepath, parquet=True)
     df_cattle_corrected.to_csv(consistified_cattle_filepath, index=False)
     df_movement_fixed.to_csv(consistified_movement_filepath, index=False)
-    # copy cattle and movement csvs to metadata
-    shutil.copy(cattle_filepath, os.path.join(metadata_path, "cattle.csv"))
-    shutil.copy(movement_filepath, os.path.join(metadata_path, "movement.csv"))
-    # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath, os.path.join(metadata_path,
-                                                       "all_wgs_samples.csv"))
+    # link (or copy) cattle and movement csvs into metadata
+    utils.link_or_copy(cattle_filepath, os.path.join(metadata_path,
+                                                     "cattle.csv"))
+    utils.link_or_copy(movement_filepath, os.path.join(metadata_path,
+                                                       "movement.csv"))
+    # link (or copy) all_wgs_samples.csv into metadata; only the first
+    # stage of a pipeline does any work
+    utils.link_or_copy_summary(all_wgs_samples_filepath,
+                               os.path.join(metadata_path,
+                                            "all_wgs_samples.csv"))
     return metadata, df_wgs_consist
 
 
 def sample_filter(results_path, df_wgs_samples=None, allow_wipe_out=False,
-                  all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
+                  all_wgs_samples_filepath=DEFAULT_WGS_SAMPLES_FILEPATH,
                   config=False, **kwargs):
     """
         Filters the WGS samples. Automatically saves the the filtered
@@ -271,21 +286,20 @@ def sample_filter(results_path, df_wgs_samples=None, allow_wipe_out=False,
             'Pass' only samples filtered according to criteria set out
             in arguments
 
-            df_wgs_samples (pandas DataFrame object): see parameters
+            df_wgs_samples (pandas DataFrame object): see parameters.
+            None if not provided, in which case samples are read from
+            all_wgs_samples_filepath
     """
     print("\n## Filter Samples ##\n")
+    import btbphylo.utils as utils
+    import btbphylo.filter_samples as filter_samples
     # create metadatapath
     metadata_path = os.path.join(results_path, "metadata")
-    if not os.path.exists(metadata_path):
-        os.makedirs(metadata_path)
-    # if no sample set provided
-    if df_wgs_samples is None:
-        print("\tloading all_wgs_samples.csv ... \n")
-        df_wgs_samples = utils.wgs_csv_to_df(all_wgs_samples_filepath)
+    os.makedirs(metadata_path, exist_ok=True)
     if config:
-        error_keys = [key for key, val in kwargs.items() if val]
         # if any arguments provided with --config
-        if any(error_keys):
+        error_keys = [key for key, val in kwargs.items() if val]
+        if error_keys:
             raise ValueError(f"arguments '{', '.join(error_keys)}' \
                 are incompatible with the 'config' argument")
         # parse config file
@@ -294,6 +308,10 @@ def sample_filter(results_path, df_wgs_samples=None, allow_wipe_out=False,
     else:
         # remove unused filtering args
         filter_args = {k: v for k, v in kwargs.items() if v is not None}
+    # if no sample set provided, get_wgs_samples_df() reads only the
+    # rows of all_wgs_samples.csv which may pass the filters
+    if df_wgs_samples is None:
+        print("\tloading all_wgs_samples.csv ... \n")
     print("\tfiltering samples ... \n")
     # filter samples
     df_wgs_passed, metadata =\
@@ -304,15 +322,18 @@ def sample_filter(results_path, df_wgs_samples=None, allow_wipe_out=False,
     print("\tsaving filtered samples csv ... \n")
     # save filtered_df to csv in metadata output folder
     utils.df_to_csv(df_wgs_passed, os.path.join(metadata_path,
-                    "passed_wgs.csv"))
-    # copy all_wgs_samples.csv to metadata
-    shutil.copy(all_wgs_samples_filepath,
-                os.path.join(metadata_path, "all_wgs_samples.csv"))
+                    "passed_wgs.csv"), parquet=True)
+    # link (or copy) all_wgs_samples.csv into metadata; only the first
+    # stage of a pipeline does any work
+    utils.link_or_copy_summary(all_wgs_samples_filepath,
+                               os.path.join(metadata_path,
+                                            "all_wgs_samples.csv"))
     return metadata, filter_args, df_wgs_passed, df_wgs_samples
 
 
 def phylo(results_path, consensus_path, download_only=False, n_threads=1,
-          build_tree=False, df_wgs=None, light_mode=False):
+          build_tree=False, df_wgs=None, light_mode=False, n_workers=32,
+          snp_tool="snp-dists", validate_cache=True):
     """
         Runs phylogeny on WGS samples: Downloads consensus files,
         concatenates into 1 large fasta file, runs snp-sites, runs
@@ -344,13 +365,22 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
 
             dash_c (bool): whether to run snp-sites with '-c'
 
+            n_workers (int): number of threads for downloading
+            consensus files
+
+            snp_tool (str): tool for building the snp matrix, one of
+            'snp-dists', 'psdm' or 'numpy'
+
+            validate_cache (bool): re-download cached consensus files
+            whose s3 object has changed
+
         Returns:
             metadata (dict): phylogeny related metadata
     """
+    import btbphylo.utils as utils
     # create metadatapath
     metadata_path = os.path.join(results_path, "metadata")
-    if not os.path.exists(metadata_path):
-        os.makedirs(metadata_path)
+    os.makedirs(metadata_path, exist_ok=True)
     metadata = {}
     # if df_passed DataFrame provided
     if df_wgs is not None:
@@ -358,17 +388,18 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
     # otherwise if consistified_wgs.csv in metadata folder: load csv
     elif os.path.exists(os.path.join(metadata_path, "consistified_wgs.csv")):
         df_wgs = utils.wgs_csv_to_df(os.path.join(metadata_path,
-                                     "consistified_wgs.csv"))
+                                     "consistified_wgs.csv"),
+                                     columns=PHYLO_COLUMNS)
     # otherwise if passed_wgs_samples.csv in metadata folder: load csv
     elif os.path.exists(os.path.join(metadata_path, "passed_wgs.csv")):
         df_wgs = utils.wgs_csv_to_df(os.path.join(metadata_path,
-                                                  "passed_wgs.csv"))
+                                                  "passed_wgs.csv"),
+                                     columns=PHYLO_COLUMNS)
     else:
         raise ValueError("If passed_wgs_samples.csv does not exist in \
             results_path ensure that the filtered_df argument is \
                 provided")
-    if not os.path.exists(results_path):
-        os.makedirs(results_path)
+    os.makedirs(results_path, exist_ok=True)
     # if light_mode: use temporary directory for fasta files
     if light_mode:
         fasta_path = tempfile.mkdtemp()
@@ -381,21 +412,42 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
     snp_dists_outpath = os.path.join(results_path, "snps.csv")
     tree_path = os.path.join(results_path, "mega")
     print("\n## Phylogeny ##\n")
+    import btbphylo.phylogeny as phylogeny
     # concatonate fasta files
-    phylogeny.build_multi_fasta(multi_fasta_path, df_wgs, consensus_path)
+    phylogeny.build_multi_fasta(multi_fasta_path, df_wgs, consensus_path,
+                                n_workers, validate_cache)
     if not download_only:
-        # run snp-sites
-        print("\trunning snp_sites ... \n")
-        metadata.update(phylogeny.snp_sites(snp_sites_outpath,
-                                            multi_fasta_path))
-        # run snp-dists
-        print("\trunning snp_dists ... \n")
-        phylogeny.build_snp_matrix(snp_dists_outpath,
-                                   snp_sites_outpath,
-                                   n_threads)
+        if snp_tool == "numpy":
+            # extract snp sites in-process, without running snp-sites
+            print("\textracting snp sites ... \n")
+            names, snps = phylogeny.extract_snp_sites_np(multi_fasta_path)
+            metadata["number_of_snps"] = snps.shape[1]
+            # snps.fas is only needed for results and by megacc
+            if build_tree or not light_mode:
+                phylogeny.write_fasta(snp_sites_outpath, names, snps)
+            print("\tbuilding snp matrix ... \n")
+            phylogeny.snp_matrix_to_csv(snp_dists_outpath, names, snps)
+        elif snp_tool == "snp-dists":
+            # pipe snp-sites straight into snp-dists, only writing
+            # snps.fas if it's kept or needed by megacc
+            print("\trunning snp_sites | snp-dists ... \n")
+            metadata.update(
+                phylogeny.snp_sites_to_snp_matrix(
+                    snp_dists_outpath, multi_fasta_path, n_threads,
+                    snp_sites_outpath if build_tree or not light_mode
+                    else None))
+        else:
+            # run snp-sites
+            print("\trunning snp_sites ... \n")
+            metadata.update(phylogeny.snp_sites(snp_sites_outpath,
+                                                multi_fasta_path))
+            # run snp-dists
+            print(f"\trunning {snp_tool} ... \n")
+            phylogeny.build_snp_matrix(snp_dists_outpath,
+                                       snp_sites_outpath,
+                                       n_threads, snp_tool)
         if build_tree:
-            if not os.path.exists(tree_path):
-                os.makedirs(tree_path)
+            os.makedirs(tree_path, exist_ok=True)
             # build tree
             print("\trunning mega ... \n")
             phylogeny.build_tree(tree_path, snp_sites_outpath)
@@ -405,8 +457,10 @@ def phylo(results_path, consensus_path, download_only=False, n_threads=1,
 
 
 def full_pipeline(results_path, consensus_path,
-                  all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
-                  n_threads=1, build_tree=False, download_only=False, **kwargs):
+                  all_wgs_samples_filepath=DEFAULT_WGS_SAMPLES_FILEPATH,
+                  n_threads=1, build_tree=False, download_only=False,
+                  snp_tool="snp-dists", n_workers=32, validate_cache=True,
+                  **kwargs):
     """
         Runs the full pipeline:
             1. updates with new WGS samples;
@@ -432,14 +486,25 @@ def full_pipeline(results_path, consensus_path,
             download_only (bool): only download consensus files without
             running phylogeny
 
+            snp_tool (str): tool for building the snp matrix, one of
+            'snp-dists', 'psdm' or 'numpy'
+
+            n_workers (int): number of threads for downloading
+            FinalOut.csv and consensus files
+
+            validate_cache (bool): re-download cached consensus files
+            whose s3 object has changed
+
             **kwargs: see sample_filter() for available kwargs
 
         Returns:
             metadata (dict): full_pipeline metadata
     """
+    import btbphylo.utils as utils
     # update full sample summary
     metadata_update, df_all_wgs = update_samples(results_path,
-                                                 all_wgs_samples_filepath)
+                                                 all_wgs_samples_filepath,
+                                                 n_workers)
     metadata = metadata_update
     # remove duplicates
     metadata_dedup, df_wgs_deduped = de_duplicate_samples(results_path,
@@ -456,12 +521,13 @@ def full_pipeline(results_path, consensus_path,
     metadata.update(metadata_filt)
     # save filters to metadata output folder
     metadata_path = os.path.join(results_path, "metadata")
-    with open(os.path.join(metadata_path, "filters.json"), "w") as f:
-        json.dump(filter_args, f, indent=2)
+    utils.dump_json(filter_args, os.path.join(metadata_path, "filters.json"))
     # run phylogeny
     metadata_phylo, *_ = phylo(results_path, consensus_path, download_only,
                                n_threads, build_tree, df_wgs_deduped,
-                               light_mode=True)
+                               light_mode=True, n_workers=n_workers,
+                               snp_tool=snp_tool,
+                               validate_cache=validate_cache)
     metadata.update(metadata_phylo)
     return (metadata,)
 
@@ -469,8 +535,8 @@ def full_pipeline(results_path, consensus_path,
 def view_bovine(results_path, consensus_path, cattle_movements_path,
                 clade_info_path=DEFAULT_CLADE_INFO_PATH,
                 outliers_path=DEFAULT_OUTLIERS_PATH,
-                all_wgs_samples_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH,
-                **kwargs):
+                all_wgs_samples_filepath=DEFAULT_WGS_SAMPLES_FILEPATH,
+                n_workers=32, validate_cache=True, **kwargs):
     """
         Phylogeny for plugging into ViewBovine:
             1. updates with new WGS samples;
@@ -501,11 +567,22 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
             all_wgs_samples_filepath (str): input path to location of
             summary csv
 
+            n_workers (int): number of threads for downloading
+            FinalOut.csv and consensus files
+
+            validate_cache (bool): re-download cached consensus files
+            whose s3 object has changed
+
             **kwargs: see sample_filter() for available kwargs
 
         Returns:
             metadata (dict): ViewBovine metadata
     """
+    import pandas as pd
+    import btbphylo.utils as utils
+    import btbphylo.filter_samples as filter_samples
+    import btbphylo.missing_samples_report as missing_samples_report
+    import btbphylo.phylogeny as phylogeny
     # create metadatapath
     metadata_path = os.path.join(results_path, "metadata")
     # load CladeInfo.csv
@@ -515,7 +592,8 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
         outliers = [outlier.rstrip() for outlier in f]
     # update full sample summary
     metadata_update, df_all_wgs = update_samples(results_path,
-                                                 all_wgs_samples_filepath)
+                                                 all_wgs_samples_filepath,
+                                                 n_workers)
     metadata = metadata_update
     # remove duplicates
     metadata_dedup, df_wgs_deduped = de_duplicate_samples(results_path,
@@ -525,74 +603,55 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
                                                           pcMapped="max",
                                                           Ncount="min")
     metadata.update(metadata_dedup)
-    df_wgs_passed = pd.DataFrame(columns=["Sample", "GenomeCov", "MeanDepth",
-                                          "NumRawReads", "pcMapped", "Outcome",
-                                          "flag", "group", "CSSTested",
-                                          "matches", "mismatches", "noCoverage",
-                                          "anomalous", "Ncount", "ResultLoc",
-                                          "ID", "TotalReads", "Abundance",
-                                          "Submission"])
     print("\n## Filter Samples ##\n")
     # remove outliers
     _, filter_args, df_wgs_no_outliers, _ = \
         sample_filter(results_path, df_wgs_deduped, not_Submission=outliers)
-    i = 1
-    num_passed_samples = 0
-    f = io.StringIO()
-    # loop through clades in CladeInfo.csv
-    for clade, row in df_clade_info.iterrows():
-        print(f"\t\tclade: {i} / {len(df_clade_info)}", end="\r")
-        # filters samples within each clade according to Ncount in CladeInfo.csv
-        with redirect_stdout(f):
-            metadata_filt, filter_clade, df_clade, _ = \
-                sample_filter(results_path, df_wgs_no_outliers,
-                              allow_wipe_out=True, group=[clade],
-                              Ncount=(0, row["maxN"]), **kwargs)
-        del filter_clade["group"]
-        filter_args[clade] = filter_clade
-        # sum the number of filtered samples
-        num_passed_samples += metadata_filt["number_of_passed_samples"]
-        # update df_passed with cladewise filtering
-        df_wgs_passed = pd.concat([df_wgs_passed, df_clade])
-        i += 1
-    print(f"\t\tclade: {i-1} / {len(df_clade_info)}", end="\n")
+    # filters samples within each clade according to Ncount in CladeInfo.csv
+    print("\tfiltering samples by clade ... \n")
+    df_wgs_passed = filter_samples.filter_clades(df_wgs_no_outliers,
+                                                 df_clade_info, **kwargs)
+    clade_filter_args = {k: v for k, v in kwargs.items() if v is not None}
+    for clade, max_n in zip(df_clade_info.index,
+                            df_clade_info["maxN"].tolist()):
+        filter_args[clade] = {"Ncount": (0, max_n), **clade_filter_args}
     # save filtered_df to csv in metadata output folder
     utils.df_to_csv(df_wgs_passed,
-                    os.path.join(metadata_path, "passed_wgs.csv"))
+                    os.path.join(metadata_path, "passed_wgs.csv"),
+                    parquet=True)
     # save filters to metadata output folder
-    with open(os.path.join(metadata_path, "filters.json"), "w") as f:
-        json.dump(filter_args, f, indent=2)
-    # copy CladeInfo.csv into results folder
-    shutil.copy(clade_info_path, os.path.join(metadata_path, "CladeInfo.csv"))
+    utils.dump_json(filter_args, os.path.join(metadata_path, "filters.json"))
+    # link (or copy) CladeInfo.csv into results folder
+    utils.link_or_copy(clade_info_path, os.path.join(metadata_path,
+                                                     "CladeInfo.csv"))
     # update metadata
-    metadata.update(metadata_filt)
-    metadata["number_of_passed_samples"] = num_passed_samples
+    metadata["number_of_passed_samples"] = len(df_wgs_passed)
     # consistify datasets
     metadata_consist, df_wgs_consistified = \
         consistify_samples(results_path, cattle_movements_path,
                            df_wgs_samples=df_wgs_passed)
     # update metadata
     metadata.update(metadata_consist)
-    # printing in seperate thread
     print("## Missing samples report ##\n")
-    t = threading.Thread(target=utils.process_print,
-                         args=("\tgenerating report",),
-                         daemon=True)
-    t.start()
-    # generate report of missing samples
-    df_report = missing_samples_report.report(df_wgs_deduped,
-                                              df_wgs_consistified,
-                                              cattle_movements_path,
-                                              df_clade_info,
-                                              outliers_path)
-    # terminate printing thread
-    t.running = False
-    t.join()
-    # save report to metadata folder
-    df_report.to_csv(os.path.join(metadata_path, "report.csv"), index=False)
-    # run phylogeny
-    metadata_phylo, *_ = phylo(results_path, consensus_path, n_threads=4,
-                               df_wgs=df_wgs_consistified, light_mode=True)
+    print("\tgenerating report in the background ... \n")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # generate report of missing samples while consensus files are
+        # downloaded and phylogeny is run
+        report = executor.submit(missing_samples_report.report,
+                                 df_wgs_deduped, df_wgs_consistified,
+                                 cattle_movements_path, df_clade_info,
+                                 outliers_path)
+        try:
+            # run phylogeny
+            metadata_phylo, *_ = phylo(results_path, consensus_path,
+                                       n_threads=4,
+                                       df_wgs=df_wgs_consistified,
+                                       light_mode=True, n_workers=n_workers,
+                                       validate_cache=validate_cache)
+        finally:
+            # save report to metadata folder, even if phylogeny fails
+            report.result().to_csv(os.path.join(metadata_path, "report.csv"),
+                                   index=False)
     # process sample names in the snp matrix: snps.csv to be consistent with
     # cattle and movement data
     phylogeny.post_process_snps_csv(os.path.join(results_path, "snps.csv"))
@@ -600,12 +659,36 @@ def view_bovine(results_path, consensus_path, cattle_movements_path,
     return (metadata,)
 
 
-def parse_args():
+@functools.lru_cache(maxsize=None)
+def _build_parser():
     """
-        Parse command line arguments for use with each function
+        Builds the command line argument parser. Cached so that the
+        parser is only built once per process.
     """
     parser = argparse.ArgumentParser(prog="btb-phylo")
-    subparsers = parser.add_subparsers(help='sub-command help')
+    subparsers = parser.add_subparsers(dest="command", required=True,
+                                       help='sub-command help')
+
+    # filtering arguments shared by filter and full_pipeline
+    filter_parser = argparse.ArgumentParser(add_help=False)
+    filter_parser.add_argument("--config", default=None,
+                               help="path to configuration file")
+    filter_parser.add_argument("--sample_name", "-s", dest="Sample",
+                               nargs="+", help="optional filter")
+    filter_parser.add_argument("--clade", "-g", dest="group", nargs="+",
+                               help="optional filter")
+    filter_parser.add_argument("--outcome", dest="Outcome", nargs="+",
+                               help="optional filter")
+    filter_parser.add_argument("--pcmapped", "-pc", dest="pcMapped",
+                               type=float, nargs=2, help="optional filter")
+    filter_parser.add_argument("--genomecov", "-gc", dest="GenomeCov",
+                               type=float, nargs=2, help="optional filter")
+    filter_parser.add_argument("--n_count", "-nc", dest="Ncount",
+                               type=float, nargs=2, help="optional filter")
+    filter_parser.add_argument("--flag", "-f", dest="flag", nargs="+",
+                               help="optional filter")
+    filter_parser.add_argument("--meandepth", "-md", dest="MeanDepth",
+                               type=float, nargs=2, help="optional filter")
 
     # update complete summary csv
     subparser = subparsers.add_parser('update_samples', help='updates a local \
@@ -613,34 +696,19 @@ def parse_args():
     subparser.add_argument("results_path", help="path to results directory")
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
-                           default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
+                           default=DEFAULT_WGS_SAMPLES_FILEPATH)
+    subparser.add_argument("--n_workers", type=int, default=32,
+                           help="number of threads for downloading \
+                           FinalOut.csv files")
     subparser.set_defaults(func=update_samples)
 
     # filter samples
-    subparser = subparsers.add_parser('filter', help='filters \
-        wgs_samples.csv file')
+    subparser = subparsers.add_parser('filter', parents=[filter_parser],
+                                      help='filters wgs_samples.csv file')
     subparser.add_argument("results_path", help="path to results directory")
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
-                           default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
-    subparser.add_argument("--config", default=None, help="path to \
-        configuration file")
-    subparser.add_argument("--sample_name", "-s", dest="Sample", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--clade", "-g", dest="group", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--outcome", dest="Outcome", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--pcmapped", "-pc", dest="pcMapped", type=float,
-                           nargs=2, help="optional filter")
-    subparser.add_argument("--genomecov", "-gc", dest="GenomeCov", type=float,
-                           nargs=2, help="optional filter")
-    subparser.add_argument("--n_count", "-nc", dest="Ncount", type=float,
-                           nargs=2, help="optional filter")
-    subparser.add_argument("--flag", "-f", dest="flag", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--meandepth", "-md", dest="MeanDepth", type=float,
-                           nargs=2, help="optional filter")
+                           default=DEFAULT_WGS_SAMPLES_FILEPATH)
     subparser.set_defaults(func=sample_filter)
 
     # de_duplicate
@@ -649,7 +717,7 @@ def parse_args():
     subparser.add_argument("results_path", help="path to results directory")
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
-                           default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
+                           default=DEFAULT_WGS_SAMPLES_FILEPATH)
     subparser.add_argument("--outcome", dest="Outcome", help="optional filter, \
          must be a valid value in Outcome column of wgs_samples csv")
     subparser.add_argument("--flag", "-f", dest="flag", help="optional filter, \
@@ -686,42 +754,46 @@ def parse_args():
                            help="build a tree")
     subparser.add_argument("--light_mode", action="store_true", default=False,
                            help="save fastas to temporary directory")
+    subparser.add_argument("--n_workers", type=int, default=32,
+                           help="number of threads for downloading \
+                           consensus files")
+    subparser.add_argument("--no_validate_cache", dest="validate_cache",
+                           action="store_false", default=True,
+                           help="use cached consensus files without checking \
+                           them against s3")
+    subparser.add_argument("--snp_tool",
+                           choices=["snp-dists", "psdm", "numpy"],
+                           default="snp-dists", help="tool for building \
+                           the snp matrix")
     subparser.set_defaults(func=phylo)
 
     # full pipeline
-    subparser = subparsers.add_parser('full_pipeline', help="runs the full \
-        phylogeny pipeline: updates full samples summary, filters samples and \
-            performs phylogeny")
+    subparser = subparsers.add_parser('full_pipeline', parents=[filter_parser],
+                                      help="runs the full phylogeny pipeline: \
+        updates full samples summary, filters samples and performs phylogeny")
     subparser.add_argument("results_path", help="path to results directory")
     subparser.add_argument("consensus_path", help="path to where consensus \
         files will be held")
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
-                           default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
+                           default=DEFAULT_WGS_SAMPLES_FILEPATH)
     subparser.add_argument("--download_only", help="if only dowloading \
         connsensus sequences", action="store_true", default=False)
     subparser.add_argument("--n_threads", "-j", default=1, help="number of \
         threads for snp-dists")
     subparser.add_argument("--build_tree", action="store_true", default=False,
                            help="build a tree")
-    subparser.add_argument("--config", default=None,
-                           help="path to configuration file")
-    subparser.add_argument("--sample_name", "-s", dest="Sample", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--clade", "-g", dest="group", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--outcome", dest="Outcome", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--pcmapped", "-pc", dest="pcMapped", type=float,
-                           nargs=2, help="optional filter")
-    subparser.add_argument("--genomecov", "-gc", dest="GenomeCov", type=float,
-                           nargs=2, help="optional filter")
-    subparser.add_argument("--n_count", "-nc", dest="Ncount", type=float,
-                           nargs=2, help="optional filter")
-    subparser.add_argument("--flag", "-f", dest="flag", nargs="+",
-                           help="optional filter")
-    subparser.add_argument("--meandepth", "-md", dest="MeanDepth", type=float,
-                           nargs=2, help="optional filter")
+    subparser.add_argument("--snp_tool",
+                           choices=["snp-dists", "psdm", "numpy"],
+                           default="snp-dists", help="tool for building \
+                           the snp matrix")
+    subparser.add_argument("--n_workers", type=int, default=32,
+                           help="number of threads for downloading \
+                           FinalOut.csv and consensus files")
+    subparser.add_argument("--no_validate_cache", dest="validate_cache",
+                           action="store_false", default=True,
+                           help="use cached consensus files without checking \
+                           them against s3")
     subparser.set_defaults(func=full_pipeline)
 
     # viewbovine
@@ -739,22 +811,36 @@ def parse_args():
         file", default=DEFAULT_OUTLIERS_PATH)
     subparser.add_argument("--all_wgs_samples_filepath", help="path to \
                            'all_wgs_samples' .csv file",
-                           default=utils.DEFAULT_WGS_SAMPLES_FILEPATH)
+                           default=DEFAULT_WGS_SAMPLES_FILEPATH)
+    subparser.add_argument("--n_workers", type=int, default=32,
+                           help="number of threads for downloading \
+                           FinalOut.csv and consensus files")
+    subparser.add_argument("--no_validate_cache", dest="validate_cache",
+                           action="store_false", default=True,
+                           help="use cached consensus files without checking \
+                           them against s3")
     subparser.set_defaults(func=view_bovine)
+    return parser
+
 
+def parse_args():
+    """
+        Parse command line arguments for use with each function
+    """
+    parser = _build_parser()
     # pasre args
     kwargs = vars(parser.parse_args())
-    if not kwargs:
-        parser.print_help()
-        sys.exit(0)
+    # the sub-command is identified by func
+    kwargs.pop("command")
     return kwargs
 
 
 def run(**kwargs):
+    import btbphylo.utils as utils
     # metadata
     metadata = {"datetime": str(datetime.now())}
-    btb_phylo_git_commit = subprocess.check_output(["git", "rev-parse", "HEAD"])
-    metadata["git_commit"] = btb_phylo_git_commit.decode().strip('\n')
+    metadata["git_commit"] = \
+        utils.git_head_sha(os.path.dirname(os.path.abspath(__file__)))
     # retrieve opperation
     func = kwargs.pop("func")
     # run
@@ -763,13 +849,11 @@ def run(**kwargs):
     metadata.update(meta_update)
     # create metadata directory in results folder
     metadata_path = os.path.join(kwargs["results_path"], "metadata")
-    if not os.path.exists(metadata_path):
-        os.mkdir(metadata_path)
+    os.makedirs(metadata_path, exist_ok=True)
     # save metadata
     print("\nsaving metadata ... \n")
     meta_filepath = os.path.join(metadata_path, "metadata.json")
-    with open(meta_filepath, "w") as f:
-        json.dump(metadata, f, indent=2)
+    utils.dump_json(metadata, meta_filepath)
     print("Done!\n")
 
 
@@ -69,9 +69,13 @@ def clade_correction(df_wgs, df_cattle):
         error where the wrong clade is assigned in the MDWH
     """
     df_cattle_corrected = df_cattle.copy()
-    for _, row in df_cattle_corrected.iterrows():
-        row["clade"] = \
-            df_wgs.loc[df_wgs["Submission"] == row["CVLRef"], "group"].iloc[0]
+    # wgs clade of each submission; the first if a submission is
+    # repeated
+    wgs_clades = df_wgs.drop_duplicates("Submission")\
+        .set_index("Submission")["group"].astype(object)
+    df_cattle_corrected["clade"] = \
+        df_cattle_corrected["CVLRef"].map(wgs_clades)\
+        .fillna(df_cattle_corrected["clade"])
     return df_cattle_corrected
 
 
@@ -116,7 +120,7 @@ def consistify_csvs(wgs_samples_path, cattle_path, movement_path,
         missing_wgs_samples, missing_cattle_samples, missing_movement_samples =\
         process_datasets(df_wgs, df_cattle, df_movement)
     # save consistified csvs
-    utils.df_to_csv(df_wgs_consist, consistified_wgs_path)
+    utils.df_to_csv(df_wgs_consist, consistified_wgs_path, parquet=True)
     df_cattle_corrected.to_csv(consistified_cattle_path, index=False)
     df_movement_fixed.to_csv(consisitified_movement_path, index=False)
     return metadata, missing_wgs_samples, missing_cattle_samples, \
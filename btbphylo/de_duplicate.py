@@ -1,4 +1,4 @@
-
+import numpy as np
 import pandas as pd
 
 
@@ -37,8 +37,6 @@ def remove_duplicates(df, **kwargs):
     if not kwargs:
         raise TypeError("no kwargs provided, provide a column name and value \
                             for dropping duplicates, e.g. pcMapped='min'")
-    # reamining indexes: starts as all indexes
-    remaining_indexes = df.index
     for column_name, value in kwargs.items():
         if column_name not in df.columns:
             raise ValueError(f"Invalid kwarg '{column_name}': must be one of: "
@@ -47,28 +45,67 @@ def remove_duplicates(df, **kwargs):
             if value != "min" and value != "max":
                 raise ValueError(f"Inavlid kwarg value: '{value}', for \
                     numerical column, must be either 'min' or 'max'")
-        elif value not in list(df[column_name]):
+        elif value not in set(df[column_name].unique()):
             raise ValueError(f"Inavlid kwarg value: '{value}', for categorical \
                 column, must be a value in the '{column_name}' column")
+    # if only choosing min/max values: a single sort replaces the groupbys
+    if df["Submission"].notna().all() and \
+            all(pd.api.types.is_numeric_dtype(df[column_name])
+                for column_name in kwargs):
+        df_deduped = sort_and_drop_duplicates(df, **kwargs)
+    else:
+        df_deduped = drop_duplicates_iteratively(df, **kwargs)
+    # metadata
+    metadata = {"number_of_duplicate_WGS_submissions": len(df)-len(df_deduped)}
+    return metadata, df_deduped
+
+
+def drop_duplicates_iteratively(df, **kwargs):
+    """
+        Drops duplicated submissions from df by removing, for each kwarg
+        in turn, the duplicates which do not meet its criteria. If
+        duplicates remain, the sample appearing first is kept.
+    """
+    # group on categorical codes rather than hashing Submission strings
+    # for every groupby; df itself is returned with its original dtypes
+    df_categorical = df.assign(Submission=df["Submission"].astype("category"))
+    # reamining rows: starts as all rows
+    remaining = np.ones(len(df), dtype=bool)
+    for column_name, value in kwargs.items():
         # get indexes to remove based on column_name and the selected value
         # (min/max)
-        indexes_to_remove = get_indexes_to_remove(df.loc[remaining_indexes],
-                                                  column_name, value)
-        # update the remaining indexes by subtracting the indexes to remove
-        remaining_indexes = remaining_indexes.difference(indexes_to_remove)
+        indexes_to_remove = \
+            get_indexes_to_remove(df_categorical[remaining], column_name,
+                                  value)
+        # update the remaining rows by excluding the indexes to remove
+        remaining &= ~df.index.isin(indexes_to_remove)
     # drop the indexes to remove - additional .drop_duplicates ensures the first
     # appearing is kept if not resolved
-    df_deduped = df.drop(df.index.difference(remaining_indexes)).\
-        drop_duplicates(["Submission"])
-    # metadata
-    metadata = {"number_of_duplicate_WGS_submissions": len(df)-len(df_deduped)}
-    return metadata, df_deduped
+    return df[remaining].drop_duplicates(["Submission"])
+
+
+def sort_and_drop_duplicates(df, **kwargs):
+    """
+        Drops duplicated submissions from df, where every kwarg is a
+        numerical column and its value is 'min' or 'max'. Sorting on all
+        kwargs at once and keeping the first sample of each submission
+        chooses the same samples as drop_duplicates_iteratively, with
+        ties kept in order of appearance. Rows keep their original order.
+    """
+    df_keys = df[list(kwargs) + ["Submission"]].reset_index(drop=True)
+    # stable sort so that ties default to the sample appearing first
+    df_keys = df_keys.sort_values(list(kwargs),
+                                  ascending=[method == "min" for method in
+                                             kwargs.values()],
+                                  kind="stable")
+    positions = df_keys.index[~df_keys["Submission"].duplicated()].to_numpy()
+    return df.iloc[np.sort(positions)]
 
 
 def get_indexes_to_remove(df, parameter, method):
     """
-        Loops through unique submisions in the df and collects indexes
-        for duplicate submisions which should be excluded.
+        Collects indexes for duplicate submisions which should be
+        excluded, in a single vectorised pass over all submissions.
 
         Parameters:
             df (pandas DataFrame object): WGS samples
@@ -88,34 +125,32 @@ def get_indexes_to_remove(df, parameter, method):
             indexes (pandas index object): indexes to remove from
             dataframe
     """
-    indexes = pd.Index([])
-    submission_list = list(df["Submission"])
-    for submission_no in df.Submission.unique():
-        # ensure that only duplicated entries are considered
-        if submission_list.count(submission_no) > 1:
-            # if parameter is numeric: set the threshold value to the max or min
-            # value of that paramater for all samples with a Submission number
-            # of submission_no
-            if pd.api.types.is_numeric_dtype(df[parameter]):
-                if method == "max":
-                    threshold = \
-                        df.loc[df["Submission"] ==
-                               submission_no][parameter].max()
-                elif method == "min":
-                    threshold = \
-                        df.loc[df["Submission"] ==
-                               submission_no][parameter].min()
-            # otherwise: set the threshold to the method parameter
-            elif pd.api.types.is_categorical_dtype(df[parameter]) or \
-                    pd.api.types.is_object_dtype(df[parameter]):
-                threshold = method
-            # ensure at least one entry meets requirement - avoids removing
-            # entire submission
-            if threshold in \
-                    df.loc[(df["Submission"] == submission_no)][parameter].values:
-                # find all indexes for samples with Submission number =
-                # submission_no, where the parameter is not equal to threshold
-                indexes = \
-                    indexes.append(df.loc[(df["Submission"] == submission_no) &
-                                   (df[parameter] != threshold)].index)
-    return indexes
+    submissions = df["Submission"]
+    # ensure that only duplicated entries are considered
+    duplicated = submissions.duplicated(keep=False).to_numpy() & \
+        submissions.notna().to_numpy()
+    # if parameter is numeric: samples meet the requirement if they have the
+    # max or min value of that paramater for all samples with the same
+    # Submission number
+    if pd.api.types.is_numeric_dtype(df[parameter]):
+        thresholds = df.groupby("Submission", sort=False, observed=True)[
+            parameter].transform(method)
+        meets_threshold = df[parameter] == thresholds
+    # otherwise: samples meet the requirement if they equal the method
+    # parameter
+    elif pd.api.types.is_categorical_dtype(df[parameter]) or \
+            pd.api.types.is_object_dtype(df[parameter]):
+        meets_threshold = df[parameter] == method
+    else:
+        return pd.Index([])
+    # ensure at least one entry meets requirement - avoids removing entire
+    # submission
+    any_meets_threshold = meets_threshold.groupby(
+        submissions, sort=False, observed=True).transform("any")
+    # indexes of duplicated samples, where the parameter is not equal to
+    # threshold
+    indexes = df.index[duplicated &
+                       any_meets_threshold.to_numpy(dtype=bool,
+                                                    na_value=False) &
+                       ~meets_threshold.to_numpy(dtype=bool, na_value=False)]
+    return indexes if len(indexes) else pd.Index([])
@@ -1,7 +1,9 @@
 import warnings
 import re
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 import btbphylo.utils as utils
 
@@ -12,8 +14,11 @@ import btbphylo.utils as utils
 
 warnings.formatwarning = utils.format_warning
 
+# number of rows of the summary csv parsed at a time
+CSV_CHUNKSIZE = utils.CSV_CHUNKSIZE
 
-def filter_df(df, allow_wipe_out=False, **kwargs):
+
+def filter_df(df, allow_wipe_out=False, reference_values=None, **kwargs):
     """
         Filters WGS df (which is based off 'all_wgs_samples' csv file)
         according to a set of criteria.
@@ -25,6 +30,11 @@ def filter_df(df, allow_wipe_out=False, **kwargs):
             allow_wipe_out (bool): do not raise exception if 1 or fewer
             samples pass.
 
+            reference_values (dict): optional sets of the values present
+            in each column, keyed by column name, against which missing
+            categorical values are checked. Defaults to the values in
+            df.
+
             **kwargs: 0 or more optional arguments. Names must match a
             column name in btb_wgs_samples.csv or match with a leading
             'not_' prefix. If column is of type 'categorical' or
@@ -63,17 +73,50 @@ def filter_df(df, allow_wipe_out=False, **kwargs):
         else:
             # add numerical columns in **kwargs to numerical_kwargs
             numerical_kwargs[key] = kwargs[key]
-    # calls filter_columns_catergorical() with **categorical_kwargs on
-    # df, pipes the output into filter_columns_numeric() with
-    # **numerical_kwargs and assigns the output to a new df_passed
-    df_passed = df.pipe(filter_columns_categorical,
-                        **categorical_kwargs).pipe(filter_columns_numeric,
-                                                   **numerical_kwargs)
+    # builds a single boolean mask from the categorical and numerical
+    # criteria, so that df is only indexed once
+    mask = categorical_mask(df, reference_values, **categorical_kwargs) & \
+        numeric_mask(df, **numerical_kwargs)
+    df_passed = df[mask]
     if not allow_wipe_out and len(df_passed) < 2:
         raise Exception("1 or fewer samples meet specified criteria")
     return df_passed
 
 
+def numeric_mask(df, **kwargs):
+    """
+        Returns a boolean numpy array which is True for the rows of df
+        meeting the criteria in kwargs, where keys are the columns on
+        which to filter and the values must be tuple of length 2 with
+        min and max thresholds in elements 0 and 1. The data in column
+        name must me of dtype int or float.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    # scratch array reused for every comparison
+    in_range = np.empty(len(df), dtype=bool)
+    for column_name, value in kwargs.items():
+        # ensures that column_names are of numeric type
+        if not pd.api.types.is_numeric_dtype(df[column_name]):
+            raise utils.InvalidDtype(dtype="float or int",
+                                     column_name=column_name)
+        # ensures that values are of length 2 (min & max) and numeric
+        if (not isinstance(value, list) and not isinstance(value, tuple)) or\
+            len(value) != 2 or (not isinstance(value[0], float) and not
+                                isinstance(value[0], int)) \
+            or (not isinstance(value[1], float) and not
+                isinstance(value[1], int)) or value[0] >= value[1]:
+            raise ValueError(f"Invalid kwarg '{column_name}': must be list \
+                or tuple of 2 numbers where the 2nd element is larger than \
+                    the 1st")
+        # e.g. 'pcMapped >= 90 and pcMapped <= 100'; NaN never passes
+        values = df[column_name].to_numpy()
+        np.greater_equal(values, value[0], out=in_range)
+        mask &= in_range
+        np.less_equal(values, value[1], out=in_range)
+        mask &= in_range
+    return mask
+
+
 def filter_columns_numeric(df, **kwargs):
     """
         Filters the summary dataframe according to kwargs, where keys
@@ -82,35 +125,24 @@ def filter_columns_numeric(df, **kwargs):
         The data in column name must me of dtype int or float.
     """
     if kwargs:
-        for column_name, value in kwargs.items():
-            # ensures that column_names are of numeric type
-            if not pd.api.types.is_numeric_dtype(df[column_name]):
-                raise utils.InvalidDtype(dtype="float or int",
-                                         column_name=column_name)
-            # ensures that values are of length 2 (min & max) and numeric
-            if (not isinstance(value, list) and not isinstance(value, tuple)) or\
-                len(value) != 2 or (not isinstance(value[0], float) and not
-                                    isinstance(value[0], int)) \
-                or (not isinstance(value[1], float) and not
-                    isinstance(value[1], int)) or value[0] >= value[1]:
-                raise ValueError(f"Invalid kwarg '{column_name}': must be list \
-                    or tuple of 2 numbers where the 2nd element is larger than \
-                        the 1st")
-        # constructs a query string on which to query df; e.g. 'pcMapped >= 90
-        # and pcMapped <= 100 and GenomeCov >= 80 and GenomveCov <= 100'
-        query = ' and '.join(f'{col} >= {vals[0]} and {col} <= {vals[1]}'
-                             for col, vals in kwargs.items())
-        return df.query(query)
+        return df[numeric_mask(df, **kwargs)]
     else:
         return df
 
 
-def filter_columns_categorical(df, **kwargs):
+def categorical_mask(df, reference_values=None, **kwargs):
     """
-        Filters the summary dataframe according to kwargs, where keys
-        are the columns on which to filter and the values are lists
-        containing the values of df[kwarg[key]] to retain.
+        Returns a boolean numpy array which is True for the rows of df
+        meeting the criteria in kwargs, where keys are the columns on
+        which to filter and the values are lists containing the values
+        of df[kwarg[key]] to retain, or to exclude if the key has a
+        'not_' prefix. Missing values are checked against the sets of
+        values in reference_values (dict keyed by column name) if
+        provided.
     """
+    if reference_values is None:
+        reference_values = {}
+    mask = np.ones(len(df), dtype=bool)
     for column_name, value in kwargs.items():
         # ensures that column_names are of type object or categorical
         if not (pd.api.types.is_categorical_dtype(df[column_name.lstrip("not_")])
@@ -124,17 +156,180 @@ def filter_columns_categorical(df, **kwargs):
                 of strings")
         # issues a warning if any value is missing from specified column
         if not re.match(r'not_', column_name):
-            missing_values = \
-                [item for item in value if item not in list(df[column_name])]
+            # hash the distinct values once rather than scanning the column
+            # for each requested value
+            present_values = reference_values.get(column_name)
+            if present_values is None:
+                present_values = set(df[column_name].unique())
+            missing_values = [item for item in value
+                              if item not in present_values]
             if missing_values:
                 warnings.warn(f"Column '{column_name}' does not contain the "
                               f"values '{', '.join(missing_values)}'")
-    # constructs a query string on which to query df; e.g. 'Outcome in [Pass]
-    # and sample_name in ["AFT-61-03769-21", "20-0620719"].
-    query = ' and '.join((f'{col.lstrip("not_")} not in {vals}' if
-                          re.match(r'not_', col) else
-                          (f'{col} in {vals}')) for col, vals in kwargs.items())
-    return df.query(query)
+        # e.g. 'Outcome in [Pass]' or 'Sample not in ["20-0620719"]'
+        if re.match(r'not_', column_name):
+            mask &= ~df[column_name.lstrip("not_")].isin(value).to_numpy()
+        else:
+            mask &= df[column_name].isin(value).to_numpy()
+    return mask
+
+
+def filter_columns_categorical(df, reference_values=None, **kwargs):
+    """
+        Filters the summary dataframe according to kwargs, where keys
+        are the columns on which to filter and the values are lists
+        containing the values of df[kwarg[key]] to retain. Missing
+        values are checked against reference_values if provided (see
+        categorical_mask()).
+    """
+    return df[categorical_mask(df, reference_values, **kwargs)]
+
+
+def filter_clades(df, df_clade_info, **kwargs):
+    """
+        Filters df according to **kwargs (see filter_df()) and keeps
+        the samples of each clade in df_clade_info with an Ncount between
+        0 and the clade's maxN. Equivalent to filtering each clade in
+        turn with 'group=[clade]' and 'Ncount=(0, maxN)', but in a single
+        pass over df.
+
+        Returns:
+            df_passed (pandas DataFrame object): filtered samples,
+            grouped by clade in the order of df_clade_info
+    """
+    df_passed = filter_df(df, allow_wipe_out=True,
+                          group=df_clade_info.index.to_list(), **kwargs)
+    # each sample's clade threshold
+    max_n = df_passed["group"].map(df_clade_info["maxN"]).astype(float)
+    df_passed = df_passed[df_passed["Ncount"].between(0, max_n)]
+    clade_order = df_passed["group"].map(
+        pd.Series(range(len(df_clade_info)), index=df_clade_info.index))
+    return df_passed.iloc[np.argsort(clade_order.to_numpy(dtype=int),
+                                     kind="stable")]
+
+
+def parquet_filters(schema, **kwargs):
+    """
+        Translates the filtering criteria in **kwargs (see filter_df())
+        into a pyarrow filters list, for predicate pushdown when reading
+        the parquet mirror of the summary csv. Only well-formed criteria
+        on columns in schema (pyarrow Schema) are translated and 'not_'
+        criteria are never translated, so filter_df() must still be
+        applied to the result.
+    """
+    if "Outcome" not in kwargs:
+        kwargs = {"Outcome": ["Pass"], **kwargs}
+    filters = []
+    for column_name, value in kwargs.items():
+        if column_name not in schema.names:
+            continue
+        dtype = schema.field(column_name).type
+        if pa.types.is_dictionary(dtype):
+            dtype = dtype.value_type
+        if (pa.types.is_string(dtype) or pa.types.is_large_string(dtype)) \
+                and isinstance(value, list) and value \
+                and all(isinstance(item, str) for item in value):
+            filters.append((column_name, "in", value))
+        elif (pa.types.is_integer(dtype) or pa.types.is_floating(dtype)) \
+                and isinstance(value, (list, tuple)) and len(value) == 2 \
+                and all(isinstance(item, (int, float)) for item in value) \
+                and value[0] < value[1]:
+            filters.append((column_name, ">=", value[0]))
+            filters.append((column_name, "<=", value[1]))
+    return filters
+
+
+def reference_columns(df, **kwargs):
+    """
+        Returns the columns of df with inclusive categorical criteria in
+        **kwargs (see filter_df()), i.e. those whose values are needed
+        for reporting missing values. df may be an empty dataframe,
+        only its columns and dtypes are used.
+    """
+    if "Outcome" not in kwargs:
+        kwargs = {"Outcome": ["Pass"], **kwargs}
+    return [column_name for column_name in kwargs
+            if not column_name.startswith("not_")
+            and column_name in df.columns
+            and (pd.api.types.is_categorical_dtype(df[column_name])
+                 or pd.api.types.is_object_dtype(df[column_name]))]
+
+
+def parquet_to_filtered_df(summary_filepath, **kwargs):
+    """
+        Reads the parquet mirror of summary_filepath with the filtering
+        criteria in **kwargs pushed down to pyarrow.
+
+        Returns:
+            df (pandas DataFrame object): rows which may meet the
+            criteria; filter_df() must still be applied
+
+            reference_values (dict): the set of unique values of each
+            column with an inclusive categorical criterion, for
+            reporting missing values
+    """
+    schema = utils.wgs_parquet_schema(summary_filepath)
+    df = utils.wgs_parquet_to_df(summary_filepath,
+                                 filters=parquet_filters(schema, **kwargs))
+    reference_values = {}
+    # read one column at a time so only its unique values are kept
+    for column_name in reference_columns(df.iloc[:0], **kwargs):
+        column = utils.wgs_parquet_to_df(summary_filepath,
+                                         columns=[column_name])[column_name]
+        reference_values[column_name] = set(column.dropna().unique())
+    return df, reference_values
+
+
+def apply_filters(df, filters):
+    """
+        Returns the rows of df which satisfy every (column, operator,
+        value) criterion in filters (see parquet_filters())
+    """
+    mask = pd.Series(True, index=df.index)
+    for column_name, operator, value in filters:
+        if operator == "in":
+            mask &= df[column_name].isin(value)
+        elif operator == ">=":
+            mask &= df[column_name] >= value
+        else:
+            mask &= df[column_name] <= value
+    return df[mask]
+
+
+def csv_to_filtered_df(summary_filepath, **kwargs):
+    """
+        Reads summary_filepath in chunks of CSV_CHUNKSIZE rows, keeping
+        only the rows of each chunk which may meet the filtering
+        criteria in **kwargs, so that peak memory is about one chunk
+        more than the prefiltered rows rather than the size of the csv.
+
+        Returns:
+            df (pandas DataFrame object): rows which may meet the
+            criteria; filter_df() must still be applied
+
+            reference_values (dict): the set of unique values of each
+            column with an inclusive categorical criterion, for
+            reporting missing values
+    """
+    filters = None
+    chunks = []
+    for chunk in utils.wgs_csv_to_df(summary_filepath,
+                                     chunksize=CSV_CHUNKSIZE):
+        if filters is None:
+            # criteria are translated once, from the first chunk's dtypes
+            filters = parquet_filters(
+                pa.Schema.from_pandas(chunk, preserve_index=False), **kwargs)
+            reference_values = {column_name: set() for column_name in
+                                reference_columns(chunk, **kwargs)}
+        chunks.append(apply_filters(chunk, filters))
+        for column_name, values in reference_values.items():
+            values.update(chunk[column_name].dropna().unique())
+    df = utils.concat_chunks(chunks)
+    if filters is None:
+        # no chunks were read, so df is an empty summary dataframe
+        reference_values = {column_name: set() for column_name in
+                            reference_columns(df, **kwargs)}
+    return df, reference_values
 
 
 def get_wgs_samples_df(df_samples=None, allow_wipe_out=False,
@@ -143,15 +338,21 @@ def get_wgs_samples_df(df_samples=None, allow_wipe_out=False,
     """
         Gets all the WGS samples to be included in phylogeny. Parses
         all_wgs_samples csv file into a pandas DataFrame. Filters the
-        DataFrame arcording to criteria descriped in **kwargs.
+        DataFrame arcording to criteria descriped in **kwargs. If
+        summary_filepath has a fresh parquet mirror, this is read
+        instead with the criteria pushed down to pyarrow, otherwise the
+        csv is read and prefiltered in chunks.
     """
-    # pipes the output DataFrame from wgs_csv_to_df() (all wgs samples) into
-    # filter_df() i.e. wgs_csv_to_df() | filter_df() > df
     if df_samples is not None:
         df = df_samples.pipe(filter_df, allow_wipe_out, **kwargs)
     else:
-        df = utils.wgs_csv_to_df(summary_filepath).pipe(filter_df,
-                                                        allow_wipe_out,
-                                                        **kwargs)
+        # pipes the prefiltered rows of the summary file into filter_df()
+        if utils.parquet_is_fresh(summary_filepath):
+            df, reference_values = parquet_to_filtered_df(summary_filepath,
+                                                          **kwargs)
+        else:
+            df, reference_values = csv_to_filtered_df(summary_filepath,
+                                                      **kwargs)
+        df = df.pipe(filter_df, allow_wipe_out, reference_values, **kwargs)
     metadata = {"number_of_passed_samples": len(df)}
     return df, metadata
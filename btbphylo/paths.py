@@ -0,0 +1,11 @@
+from os import path
+
+"""
+    Default file paths. Only depends on the standard library, so that
+    btb_phylo.py's argument parser can use them without importing
+    pandas or boto3
+"""
+
+DEFAULT_WGS_SAMPLES_FILEPATH = \
+    path.join(path.dirname(path.dirname(path.abspath(__file__))),
+              "all_wgs_samples.csv")
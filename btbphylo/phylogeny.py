@@ -1,7 +1,15 @@
+import os
+import contextlib
+import mmap
 import re
+import shutil
+import subprocess
 import warnings
 from os import path
+from concurrent.futures import ThreadPoolExecutor
 
+import botocore
+import numpy as np
 import pandas as pd
 
 import btbphylo.utils as utils
@@ -13,6 +21,29 @@ import btbphylo.utils as utils
 
 warnings.formatwarning = utils.format_warning
 
+# upper limit on the size of the boolean comparison arrays held in memory at
+# once when computing snp distances
+BLOCK_BYTES = 1 << 26
+
+# errors from s3 for which a cached consensus file is used unvalidated
+S3_UNAVAILABLE_ERRORS = (utils.NoS3ObjectError,
+                         botocore.exceptions.ClientError,
+                         botocore.exceptions.BotoCoreError)
+
+# 2-bit codes for packing snp alignments
+_BASE_CODES = np.zeros(256, dtype=np.uint8)
+_BASE_VALID = np.zeros(256, dtype=np.uint8)
+for _code, _base in enumerate(b"ACGT"):
+    _BASE_CODES[_base] = _code
+    _BASE_VALID[_base] = 1
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)],
+                           dtype=np.uint8)
+
+# the bucket prefix of a results s3 uri, e.g. 's3://s3-csu-003/', and the
+# bucket name within it
+_S3_URI_RE = re.compile(r'^s3://(s3-csu-\d{3,3})/+')
+_S3_BUCKET_RE = re.compile(r's3-csu-\d{3,3}')
+
 
 class BadS3UriError(Exception):
     def __init__(self, s3_uri):
@@ -23,33 +54,117 @@ class BadS3UriError(Exception):
         return self.message
 
 
-def append_multi_fasta(s3_bucket, s3_key, outfile, sample, consensus_path):
+def download_consensus(s3_bucket, s3_key, consensus_filepath, s3_client=None,
+                       validate_cache=True, s3_etag=None):
     """
-        Appends a multi fasta file with the consensus sequence stored at
-        s3_uri
+        Downloads the consensus sequence stored at s3_bucket/s3_key to
+        consensus_filepath, unless the file is already present in the
+        consensus directory and, if validate_cache is True, the ETag
+        recorded when it was downloaded (see utils.record_etag())
+        matches the object's. Files cached before ETags were recorded
+        are hashed once (see utils.file_matches_etag()) and their ETag
+        recorded. If the object's ETag can't be fetched, because the
+        object is missing or s3 can't be reached, the cached file is
+        used and a warning is issued.
 
         Parameters:
             s3_bucket (string): s3 bucket of consensus file
 
             s3_key (string): s3 key of consensus file
 
+            consensus_filepath (string): local path for the consensus
+            file
+
+            s3_client (boto3 client object): optional client, may be
+            shared between threads
+
+            validate_cache (bool): re-download cached consensus files
+            which differ from the s3 object
+
+            s3_etag (tuple): the ETag and size of the s3 object if
+            already known, e.g. from utils.s3_list_etags(); otherwise
+            they are requested from s3 for validating cached files
+    """
+    etag = s3_etag[0] if s3_etag else None
+    if path.exists(consensus_filepath):
+        if not validate_cache:
+            return
+        try:
+            etag, size = s3_etag or utils.s3_object_etag(s3_bucket, s3_key,
+                                                         s3_client)
+        except S3_UNAVAILABLE_ERRORS as e:
+            warnings.warn(f"Could not validate cached consensus file "
+                          f"'{consensus_filepath}' against "
+                          f"s3://{s3_bucket}/{s3_key}, using it as is: {e}")
+            return
+        cached_etag = utils.recorded_etag(consensus_filepath)
+        if cached_etag is None:
+            if utils.file_matches_etag(consensus_filepath, etag, size):
+                utils.record_etag(consensus_filepath, etag)
+                return
+        elif cached_etag == etag and \
+                path.getsize(consensus_filepath) == size:
+            return
+    # forget the old ETag first, so that it never outlives its file
+    utils.record_etag(consensus_filepath, None)
+    # boto3 downloads to a temporary file and renames it into place, so an
+    # interrupted download never leaves a partial consensus file
+    utils.s3_download_file(s3_bucket, s3_key, consensus_filepath, s3_client)
+    utils.record_etag(consensus_filepath, etag)
+
+
+def append_multi_fasta(outfile, consensus_filepath):
+    """
+        Appends a multi fasta file with the consensus sequence stored at
+        consensus_filepath
+
+        Parameters:
             outfile (file object): file object refering to the multi
             fasta output file
+
+            consensus_filepath (string): path to local consensus file
     """
-    # check if file is already present in the consensus directory
-    consensus_filepath = path.join(consensus_path, sample + '.fas')
-    if not path.exists(consensus_filepath):
-        # dowload consensus file from s3 to tempfile
-        utils.s3_download_file_cli(s3_bucket, s3_key, consensus_filepath)
-    # writes to multifasta
     with open(consensus_filepath, 'rb') as consensus_file:
-        outfile.write(consensus_file.read())
+        offset = 0
+        try:
+            # copy in the kernel, without passing through python buffers
+            outfile.flush()
+            out_fd = outfile.fileno()
+            in_fd = consensus_file.fileno()
+            size = os.fstat(in_fd).st_size
+            # sendfile may copy fewer bytes than requested
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+        except (AttributeError, OSError):
+            # no sendfile on this platform or for these files; copy the
+            # remainder through python
+            consensus_file.seek(offset)
+            shutil.copyfileobj(consensus_file, outfile, 1 << 20)
+
+
+def _list_etags(s3_bucket, prefix, s3_client):
+    """
+        utils.s3_list_etags(), or an empty dictionary if the listing
+        fails, in which case download_consensus() requests each ETag
+        itself
+    """
+    try:
+        return utils.s3_list_etags(s3_bucket, prefix, s3_client)
+    except S3_UNAVAILABLE_ERRORS:
+        return {}
 
 
-def build_multi_fasta(multi_fasta_path, df, consensus_path):
+def build_multi_fasta(multi_fasta_path, df, consensus_path, n_workers=32,
+                      validate_cache=True):
     """
         Builds the multi fasta constructed from consensus sequences for
-        all samples in df
+        all samples in df. Consensus files missing from consensus_path,
+        or which differ from their s3 object, are downloaded concurrently
+        and each is appended, in the order of df, to the multi fasta as
+        soon as it is available.
 
         Parameters:
             multi_fasta_path (str): path for location of multi fasta
@@ -59,33 +174,83 @@ def build_multi_fasta(multi_fasta_path, df, consensus_path):
             for consensus sequences of samples to be included in
             phylogeny
 
+            consensus_path (str): path to directory for saving consensus
+            files
+
+            n_workers (int): number of threads for downloading consensus
+            files
+
+            validate_cache (bool): re-download cached consensus files
+            which differ from their s3 object (see download_consensus())
+
         Raises:
             utils.NoS3ObjectError: if the object cannot be found in the
             specified s3 bucket
     """
-    with open(multi_fasta_path, 'wb') as outfile:
-        # loops through all samples to be included in phylogeny
-        count = 0
-        num_samples = len(df)
-        for index, sample in df.iterrows():
-            count += 1
-            print(f"\t\tadding sample: {count} / {num_samples}", end="\r")
-            try:
-                # extract the bucket and key of consensus file from s3 uri
-                s3_bucket = extract_s3_bucket(sample["ResultLoc"])
-                consensus_key = extract_s3_key(sample["ResultLoc"],
-                                               sample["Sample"])
-                # appends sample's consensus sequence to multifasta
-                append_multi_fasta(s3_bucket, consensus_key, outfile,
-                                   sample["Sample"], consensus_path)
-            except utils.NoS3ObjectError as e:
-                # if consensus file can't be found in s3, btb_wgs_samples.csv
-                # must be corrupted
-                print(e.message)
-                print(f"\tCheck results objects in row {index} of \
-                    btb_wgs_sample.csv")
-                raise e
-        print(f"\t\tadded samples: {count} / {num_samples} \n")
+    num_samples = len(df)
+    s3_client = utils.get_s3_client()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor, \
+            open(multi_fasta_path, 'wb', buffering=1 << 20) as outfile:
+        # queue downloads for all samples to be included in phylogeny
+        downloads = []
+        # extract the buckets and keys of consensus files from s3 uris
+        s3_buckets, consensus_keys = \
+            extract_s3_buckets_keys(df["ResultLoc"], df["Sample"])
+        consensus_filepaths = [path.join(consensus_path, f"{sample_name}.fas")
+                               for sample_name in df["Sample"].to_numpy()]
+        # list the ETags of cached consensus files once per s3 prefix,
+        # rather than requesting each file's ETag separately; they are
+        # only needed for validating the cache
+        cached_prefixes = sorted(
+            {(s3_bucket, consensus_key.rpartition("/")[0] + "/")
+             for s3_bucket, consensus_key, consensus_filepath in
+             zip(s3_buckets, consensus_keys, consensus_filepaths)
+             if path.exists(consensus_filepath)}) if validate_cache else []
+        s3_etags = {}
+        for (s3_bucket, _), etags in \
+                zip(cached_prefixes,
+                    executor.map(lambda bucket_prefix:
+                                 _list_etags(*bucket_prefix, s3_client),
+                                 cached_prefixes)):
+            s3_etags.update({(s3_bucket, key): etag for key, etag in
+                             etags.items()})
+        try:
+            # iterates arrays rather than df.iterrows(), which builds a
+            # Series for every row
+            for index, consensus_filepath, s3_bucket, consensus_key in \
+                    zip(df.index.to_numpy(), consensus_filepaths, s3_buckets,
+                        consensus_keys):
+                s3_etag = s3_etags.get((s3_bucket, consensus_key))
+                downloads.append((index, consensus_filepath,
+                                  executor.submit(download_consensus,
+                                                  s3_bucket, consensus_key,
+                                                  consensus_filepath,
+                                                  s3_client, validate_cache,
+                                                  s3_etag=s3_etag)))
+            # append each consensus sequence to the multifasta, in the
+            # order of df, as soon as it is downloaded; later downloads
+            # continue in the background
+            for count, (index, consensus_filepath, download) in \
+                    enumerate(downloads, 1):
+                if count % utils.PROGRESS_INTERVAL == 0:
+                    print(f"\t\tadding sample: {count} / {num_samples}",
+                          end="\r")
+                try:
+                    download.result()
+                except utils.NoS3ObjectError as e:
+                    # if consensus file can't be found in s3,
+                    # btb_wgs_samples.csv must be corrupted
+                    print(e.message)
+                    print(f"\tCheck results objects in row {index} of \
+                        btb_wgs_sample.csv")
+                    raise e
+                append_multi_fasta(outfile, consensus_filepath)
+        except BaseException:
+            # on any error (including KeyboardInterrupt) don't wait for the
+            # queued downloads before it is raised
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        print(f"\t\tadded samples: {num_samples} / {num_samples} \n")
 
 
 def extract_s3_bucket(s3_uri):
@@ -94,10 +259,8 @@ def extract_s3_bucket(s3_uri):
     """
     # confirm s3 uri is correct and remove key from s3 uri
     sub_string = match_s3_uri(s3_uri)
-    pattern = r's3-csu-\d{3,3}'
     # extract the bucket name
-    matches = re.findall(pattern, sub_string)
-    return matches[0]
+    return _S3_BUCKET_RE.search(sub_string).group(0)
 
 
 def extract_s3_key(s3_uri, sample_name):
@@ -105,24 +268,51 @@ def extract_s3_key(s3_uri, sample_name):
         Generates an s3 key from an s3 uri and filename
     """
     # confirm s3 uri is correct
-    _ = match_s3_uri(s3_uri)
-    pattern = r'^s3://s3-csu-\d{3,3}/+'
+    sub_string = match_s3_uri(s3_uri)
     # construct s3 key of consensus file
-    return path.join(re.sub(pattern, "", s3_uri),
+    return path.join(s3_uri[len(sub_string):],
                      "consensus", f"{sample_name}_consensus.fas")
 
 
+def extract_s3_buckets_keys(s3_uris, sample_names):
+    """
+        Vectorised extract_s3_bucket() and extract_s3_key(): extracts the
+        s3 bucket names and consensus file keys for pandas Series of s3
+        uris and sample names in single passes.
+
+        Returns:
+            s3_buckets (numpy array): bucket name of each s3 uri
+
+            s3_keys (numpy array): s3 key of the consensus file of each
+            sample
+
+        Raises:
+            BadS3UriError: for the first incorrectly formatted s3 uri
+    """
+    s3_uris = s3_uris.astype(object)
+    s3_buckets = s3_uris.str.extract(_S3_URI_RE, expand=False)
+    bad_uris = s3_buckets.isna()
+    if bad_uris.any():
+        raise BadS3UriError(s3_uris[bad_uris].iloc[0])
+    # the key prefixes, joined as by path.join() in extract_s3_key()
+    key_prefixes = s3_uris.str.replace(_S3_URI_RE, "", regex=True)
+    separators = np.where((key_prefixes == "") |
+                          key_prefixes.str.endswith("/"), "", "/")
+    s3_keys = key_prefixes + separators + "consensus/" + \
+        sample_names.astype(str) + "_consensus.fas"
+    return s3_buckets.to_numpy(), s3_keys.to_numpy()
+
+
 def match_s3_uri(s3_uri):
     """
         Returns an s3 uri substring with the s3 key stripped away.
         Raises BadS3UriError if the pattern is not found within the s3
         uri.
     """
-    pattern = r'^s3://s3-csu-\d{3,3}/+'
-    matches = re.findall(pattern, s3_uri)
-    if not matches:
+    match = _S3_URI_RE.match(s3_uri)
+    if not match:
         raise BadS3UriError(s3_uri)
-    return matches[0]
+    return match.group(0)
 
 
 def snp_sites(snp_sites_outpath, multi_fasta_path):
@@ -133,42 +323,354 @@ def snp_sites(snp_sites_outpath, multi_fasta_path):
     cmd = f'snp-sites {multi_fasta_path} -c -o {snp_sites_outpath}'
     utils.run(cmd, shell=True)
     # read the number of snps for metadata
-    with open(snp_sites_outpath, "r") as f:
-        next(f)
-        for line in f:
-            metadata = {"number_of_snps": len(line)-1}
-            break
+    metadata = {"number_of_snps": fasta_line_length(snp_sites_outpath)}
     return metadata
 
 
-def build_snp_matrix(snp_dists_outpath, snp_sites_outpath, threads=1):
+def fasta_line_length(fasta_path):
+    """
+        Returns the length of the first sequence line of the fasta file
+        at fasta_path (i.e. its second line), found with mmap rather
+        than reading the line into python. snp-sites writes each
+        sequence on a single line, so for its output this is the number
+        of snps.
     """
-        Run snp-dists
+    with open(fasta_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            start = m.find(b"\n") + 1
+            if not start:
+                return 0
+            end = m.find(b"\n", start)
+            if end == -1:
+                end = len(m)
+            if end > start and m[end - 1:end] == b"\r":
+                end -= 1
+            return end - start
+
+
+def build_snp_matrix(snp_dists_outpath, snp_sites_outpath, threads=1,
+                     snp_tool="snp-dists"):
     """
+        Run snp-dists, or psdm if snp_tool is 'psdm'. psdm computes the
+        same matrix with SIMD-vectorised comparisons and scales better
+        across threads. Falls back to snp-dists if psdm is not
+        installed. If snp_tool is 'numpy' the matrix is built in-process
+        with build_snp_matrix_fast().
+    """
+    if snp_tool == "numpy":
+        build_snp_matrix_fast(snp_dists_outpath, snp_sites_outpath)
+        return
+    if snp_tool == "psdm":
+        if shutil.which("psdm"):
+            # run psdm
+            cmd = f'psdm -d , -t {threads} -o {snp_dists_outpath} \
+                {snp_sites_outpath}'
+            utils.run(cmd, shell=True)
+            return
+        warnings.warn("psdm is not installed, falling back to snp-dists")
     # run snp-dists
     cmd = f'snp-dists -c -j {threads} {snp_sites_outpath} > {snp_dists_outpath}'
     utils.run(cmd, shell=True)
 
 
+def _first_sequence_length(fasta_head, eof=False):
+    """
+        Returns the length of the first sequence in fasta_head (bytes),
+        the start of a fasta file, or None if fasta_head does not yet
+        contain the whole of the first sequence
+    """
+    start = fasta_head.find(b"\n") + 1
+    end = fasta_head.find(b">", start) if start else -1
+    if end == -1:
+        if not (eof and start):
+            return None
+        end = len(fasta_head)
+    return len(fasta_head[start:end].replace(b"\n", b"").replace(b"\r", b""))
+
+
+def snp_sites_to_snp_matrix(snp_dists_outpath, multi_fasta_path, threads=1,
+                            snp_sites_outpath=None):
+    """
+        Runs snp-sites and pipes its output straight into snp-dists, so
+        that snp-dists never reads the snp alignment back from disk. The
+        multi-fasta must still be a file, as snp-sites reads it twice.
+
+        Parameters:
+            snp_dists_outpath (str): path to the snp matrix csv
+
+            multi_fasta_path (str): path to the multi-fasta
+
+            threads (int): number of threads for snp-dists
+
+            snp_sites_outpath (str): if provided, the snp alignment is
+            also written here (i.e. tee'd), e.g. for building a tree
+
+        Returns:
+            metadata (dict): the number of snps, as with snp_sites()
+    """
+    with open(snp_dists_outpath, "wb") as outfile, \
+            (open(snp_sites_outpath, "wb", buffering=1 << 20)
+             if snp_sites_outpath else contextlib.nullcontext()) as snps_file:
+        processes = []
+        returncodes = []
+        finished = False
+        dists_exited_early = False
+        try:
+            processes.append(subprocess.Popen(["snp-sites", "-c", "-o",
+                                               "/dev/stdout",
+                                               multi_fasta_path],
+                                              stdout=subprocess.PIPE))
+            processes.append(subprocess.Popen(["snp-dists", "-c", "-j",
+                                               str(threads), "/dev/stdin"],
+                                              stdin=subprocess.PIPE,
+                                              stdout=outfile))
+            p_sites, p_dists = processes
+            # pump snp-sites' output through python, keeping the start of
+            # the alignment until the number of snps is known
+            fasta_head = b""
+            number_of_snps = None
+            try:
+                for chunk in iter(lambda: p_sites.stdout.read(1 << 20), b""):
+                    p_dists.stdin.write(chunk)
+                    if snps_file:
+                        snps_file.write(chunk)
+                    if number_of_snps is None:
+                        fasta_head += chunk
+                        number_of_snps = _first_sequence_length(fasta_head)
+                p_dists.stdin.close()
+            except BrokenPipeError:
+                # snp-dists exited before reading all of the alignment
+                dists_exited_early = True
+            finished = True
+        finally:
+            # closing the pipes first means neither process can block on
+            # the other while being waited for
+            for ps in processes:
+                for pipe in (ps.stdin, ps.stdout):
+                    if pipe is not None:
+                        with contextlib.suppress(BrokenPipeError):
+                            pipe.close()
+            for ps in processes:
+                if not finished and ps.poll() is None:
+                    ps.kill()
+                returncodes.append(ps.wait())
+    results = list(zip(processes, returncodes))
+    if dists_exited_early:
+        # snp-sites failing is then only a symptom of snp-dists exiting
+        results.reverse()
+    for ps, returncode in results:
+        utils.check_returncode(ps.args, returncode)
+    if number_of_snps is None:
+        number_of_snps = _first_sequence_length(fasta_head, eof=True)
+    return {"number_of_snps": number_of_snps}
+
+
+def iter_fasta(fasta_path):
+    """
+        Iterates over the records of a fasta file, yielding the name
+        and the sequence (numpy uint8 array) of each. The file is memory
+        mapped, so only one sequence is held in memory at a time.
+    """
+    with open(fasta_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = mm.find(b">")
+            while start != -1:
+                end = mm.find(b"\n>", start)
+                record = mm[start + 1:end if end != -1 else len(mm)]
+                header, _, seq = record.partition(b"\n")
+                seq = seq.replace(b"\n", b"").replace(b"\r", b"")
+                yield header.decode().strip(), np.frombuffer(seq,
+                                                             dtype=np.uint8)
+                start = end + 1 if end != -1 else -1
+
+
+def read_fasta(fasta_path):
+    """
+        Reads an aligned fasta file into a list of sample names and a
+        numpy uint8 array of shape (number of samples, alignment
+        length)
+    """
+    names = []
+    seqs = []
+    for name, seq in iter_fasta(fasta_path):
+        names.append(name)
+        seqs.append(seq)
+    if len(set(map(len, seqs))) > 1:
+        raise ValueError(f"Sequences in {fasta_path} are not aligned")
+    if not seqs:
+        return names, np.empty((0, 0), dtype=np.uint8)
+    return names, np.stack(seqs)
+
+
+def write_fasta(fasta_path, names, alignment):
+    """
+        Writes an alignment (numpy uint8 array) to fasta, with each
+        sequence on a single line as with snp-sites
+    """
+    with open(fasta_path, "wb") as f:
+        for name, seq in zip(names, alignment):
+            f.write(b">" + name.encode() + b"\n" + seq.tobytes() + b"\n")
+
+
+def extract_snp_sites_np(multi_fasta_path):
+    """
+        Extracts the snp sites from a multi fasta in-process, as with
+        'snp-sites -c': i.e. the columns which vary between samples and
+        are one of A, C, G or T in every sample. Makes 2 passes over
+        multi_fasta_path, so that only the snp sites of each sample are
+        held in memory.
+
+        Returns:
+            names (list): sample names
+
+            snps (numpy uint8 array): snp alignment of shape (number of
+            samples, number of snps)
+    """
+    # first pass: find snp sites
+    reference = None
+    for _, seq in iter_fasta(multi_fasta_path):
+        if reference is None:
+            reference = seq
+            variable = np.zeros(len(seq), dtype=bool)
+            acgt = np.ones(len(seq), dtype=bool)
+        elif len(seq) != len(reference):
+            raise ValueError(f"Sequences in {multi_fasta_path} are not \
+                aligned")
+        else:
+            variable |= seq != reference
+        acgt &= _BASE_VALID[seq].view(bool)
+    if reference is None:
+        return [], np.empty((0, 0), dtype=np.uint8)
+    snp_sites = np.flatnonzero(variable & acgt)
+    # second pass: extract snp sites
+    names = []
+    snps = []
+    for name, seq in iter_fasta(multi_fasta_path):
+        names.append(name)
+        snps.append(seq[snp_sites])
+    return names, np.stack(snps)
+
+
+def pack_alignment(alignment):
+    """
+        Packs an alignment (numpy uint8 array) into 2 bits per site, 32
+        sites per uint64 word.
+
+        Returns:
+            packed (numpy uint64 array): 2-bit codes for A, C, G and T
+            (0-3); any other character is encoded as 0
+
+            valid (numpy uint64 array): the low bit of each 2-bit lane is
+            set where the site is one of A, C, G or T
+    """
+    n_samples, n_sites = alignment.shape
+    # pad to a whole number of uint64 words
+    n_pad = -n_sites % 32
+    codes = np.pad(_BASE_CODES[alignment], ((0, 0), (0, n_pad)))
+    valid = np.pad(_BASE_VALID[alignment], ((0, 0), (0, n_pad)))
+    # 4 sites per byte; the 0x55 lanes of a byte line up with the 0x5555...
+    # lanes of a uint64 regardless of byte order
+    packed = (codes[:, 0::4] | codes[:, 1::4] << 2 | codes[:, 2::4] << 4 |
+              codes[:, 3::4] << 6)
+    valid = (valid[:, 0::4] | valid[:, 1::4] << 2 | valid[:, 2::4] << 4 |
+             valid[:, 3::4] << 6)
+    return (np.ascontiguousarray(packed).view(np.uint64),
+            np.ascontiguousarray(valid).view(np.uint64))
+
+
+def _popcount(words):
+    """
+        Returns the total number of set bits along the last axis of
+        words (numpy uint64 array)
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1,
+                                                      dtype=np.int64)
+
+
+def snp_distances(alignment):
+    """
+        Returns the matrix of pairwise snp distances between the rows of
+        alignment (numpy uint8 array). As with snp-dists, only sites
+        where both sequences are one of A, C, G or T are counted.
+
+        Sequences are packed with pack_alignment() so that each XOR
+        compares 32 sites; a lane differs if either of its 2 bits
+        differ. Rows are compared in blocks to bound memory usage.
+    """
+    n_samples = alignment.shape[0]
+    packed, valid = pack_alignment(alignment)
+    n_words = packed.shape[1]
+    distances = np.zeros((n_samples, n_samples), dtype=np.int64)
+    block_size = max(1, BLOCK_BYTES // max(1, 8 * n_samples * n_words))
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+        diff = packed[start:stop, None, :] ^ packed[None, :, :]
+        diff |= diff >> np.uint64(1)
+        diff &= valid[start:stop, None, :]
+        diff &= valid[None, :, :]
+        distances[start:stop] = _popcount(diff)
+    return distances
+
+
+def build_snp_matrix_fast(snp_dists_outpath, snp_sites_outpath):
+    """
+        Builds the snp matrix in-process with numpy rather than running
+        snp-dists. Writes the matrix to csv in the same layout as
+        'snp-dists -c'.
+    """
+    snp_matrix_to_csv(snp_dists_outpath, *read_fasta(snp_sites_outpath))
+
+
+def snp_matrix_to_csv(snp_dists_outpath, names, alignment):
+    """
+        Computes the snp matrix of alignment (numpy uint8 array) with
+        snp_distances() and writes it to csv in the same layout as
+        'snp-dists -c'
+    """
+    snp_matrix = pd.DataFrame(snp_distances(alignment), index=names,
+                              columns=names)
+    snp_matrix.to_csv(snp_dists_outpath)
+
+
 def build_tree(tree_path, snp_sites_outpath):
     """
         Run mega
     """
-    # count number of taxa
-    with open(snp_sites_outpath, "r") as f:
-        for n_lines, _ in enumerate(f):
-            if n_lines == 7:
-                # if more than 3 samples run mega
-                cmd = \
-                    f'megacc -a accessory/infer_MP.mao -d {snp_sites_outpath} \
-                        -o {tree_path}'
-                utils.run(cmd, shell=True)
-                break
-    if n_lines < 7:
+    # if more than 3 samples run mega
+    if count_fasta_records(snp_sites_outpath, limit=4) == 4:
+        cmd = \
+            f'megacc -a accessory/infer_MP.mao -d {snp_sites_outpath} \
+                -o {tree_path}'
+        utils.run(cmd, shell=True)
+    else:
         warnings.warn("Unable to build tree! Need at least 4 taxa for tree \
             building")
 
 
+def count_fasta_records(fasta_path, limit=None):
+    """
+        Counts the records (header lines) in the fasta file at
+        fasta_path, stopping once limit records are found. Headers are
+        found with mmap, so sequence lines are never read into python.
+    """
+    with open(fasta_path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            n_records = 1 if m[:1] == b">" else 0
+            position = m.find(b"\n>")
+            while position != -1 and (limit is None or n_records < limit):
+                n_records += 1
+                position = m.find(b"\n>", position + 2)
+    return n_records
+
+
 def post_process_snps_csv(snp_dists_outpath):
     """
         An I/O layer for post_process_snps_df. Changes the sample names
@@ -1,5 +1,5 @@
-import tempfile
 from os import path
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
@@ -11,35 +11,56 @@ import btbphylo.utils as utils
 """
 
 
-def get_finalout_s3_keys(bucket="s3-csu-003", prefix="v3-2"):
+def list_batch_prefixes(bucket="s3-csu-003", prefix="v3-2"):
     """
-        Returns a list of s3 keys for all FinalOut.csv files stored under the
-        given prefix.
+        Returns a list of the s3 prefixes of all batches of results
+        stored under the given prefix, e.g. 'v3-2/Results_10032_27Jun22/'
     """
-    cmd = \
-        f'aws s3 ls s3://{bucket}/{prefix}/ --recursive | grep -e \
-            ".*FinalOut.*"'
-    # direct output of cmd subprocess into finalout_s3_data
-    finalout_s3_data = utils.run(cmd, shell=True, capture_output=True)
-    # extract s3 key from output of cmd
-    return list(map(extract_s3_key, finalout_s3_data.split("\n")))
+    paginator = utils.get_s3_client().get_paginator("list_objects_v2")
+    return [common_prefix["Prefix"] for page in
+            paginator.paginate(Bucket=bucket, Prefix=path.join(prefix, ""),
+                               Delimiter="/")
+            for common_prefix in page.get("CommonPrefixes", [])]
 
 
-def extract_s3_key(final_out_s3_object):
+def list_finalout_s3_keys(batch_prefix, bucket="s3-csu-003"):
     """
-        Extracts the s3 key from s3 metadata of a single FinalOut.csv file
+        Returns a list of s3 keys for all FinalOut.csv files stored under
+        a single batch prefix
     """
-    return final_out_s3_object.split(" ")[-1]
+    paginator = utils.get_s3_client().get_paginator("list_objects_v2")
+    return [s3_object["Key"] for page in
+            paginator.paginate(Bucket=bucket, Prefix=batch_prefix)
+            for s3_object in page.get("Contents", [])
+            if "FinalOut" in s3_object["Key"]]
 
 
-def finalout_s3_to_df(s3_key, s3_bucket="s3-csu-003"):
+def get_finalout_s3_keys(bucket="s3-csu-003", prefix="v3-2",
+                         batch_prefixes=None, n_workers=16):
     """
-        Downloads FinalOut.csv files and writes to pandas dataframe
+        Returns a list of s3 keys for all FinalOut.csv files stored under the
+        given prefix, or only under batch_prefixes if provided. Each batch
+        is listed concurrently.
     """
-    with tempfile.TemporaryDirectory() as temp_dirname:
-        finalout_path = path.join(temp_dirname, "FinalOut.csv")
-        utils.s3_download_file_cli(s3_bucket, s3_key, finalout_path)
-        return utils.finalout_csv_to_df(finalout_path)
+    if batch_prefixes is None:
+        batch_prefixes = list_batch_prefixes(bucket, prefix)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        batch_keys = executor.map(lambda batch_prefix:
+                                  list_finalout_s3_keys(batch_prefix, bucket),
+                                  batch_prefixes)
+        return [key for keys in batch_keys for key in keys]
+
+
+def finalout_s3_to_df(s3_key, s3_bucket="s3-csu-003", s3_client=None):
+    """
+        Streams FinalOut.csv files from s3 straight into a pandas
+        dataframe. s3_client may be shared between threads.
+    """
+    if s3_client is None:
+        s3_client = utils.get_s3_client()
+    response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)
+    # parse the body as it arrives rather than buffering the whole object
+    return utils.finalout_csv_to_df(response["Body"])
 
 
 def get_df_wgs(summary_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
@@ -50,14 +71,9 @@ def get_df_wgs(summary_filepath=utils.DEFAULT_WGS_SAMPLES_FILEPATH):
     if path.exists(summary_filepath):
         return utils.wgs_csv_to_df(summary_filepath)
     # if running for the first time (i.e. no btb_wgs_samples.csv),
-    # create new empty dataframe
+    # create new empty dataframe, typed as if read from the csv
     else:
-        column_names = ["Sample", "GenomeCov", "MeanDepth", "NumRawReads",
-                        "pcMapped", "Outcome", "flag", "group", "CSSTested",
-                        "matches", "mismatches", "noCoverage", "anomalous",
-                        "Ncount", "ResultLoc", "ID", "TotalReads", "Abundance",
-                        "Submission"]
-        return pd.DataFrame(columns=column_names)
+        return utils.empty_wgs_df()
 
 
 def new_final_out_keys(df_summary):
@@ -65,10 +81,15 @@ def new_final_out_keys(df_summary):
         Returns a list of s3_keys for FinalOut.csv files not currently
         in the 'all_wgs_samples' .csv file, i.e. new data.
     """
-    # get list of all FinalOut.csv s3 keys
-    s3_keys = get_finalout_s3_keys()
-    new_keys = []
     old_result_loc = set(df_summary["ResultLoc"])
+    # only list batches not already summarised in df_summary
+    new_batch_prefixes = [batch_prefix for batch_prefix in
+                          list_batch_prefixes()
+                          if f"s3://s3-csu-003/{batch_prefix}"
+                          not in old_result_loc]
+    # get list of FinalOut.csv s3 keys for new batches
+    s3_keys = get_finalout_s3_keys(batch_prefixes=new_batch_prefixes)
+    new_keys = []
     for key in s3_keys:
         prefix = "/".join(key.split("/")[:-1])
         result_loc = f"s3://s3-csu-003/{prefix}/"
@@ -87,10 +108,11 @@ def add_submission_col(df):
     return df
 
 
-def append_df_wgs(df_summary, new_keys, itteration=0):
+def append_df_wgs(df_summary, new_keys, n_workers=32):
     """
         Appends new FinalOut.csv data (with additional submission
-        number) to the df_wgs.
+        number) to the df_wgs. FinalOut.csv files are downloaded
+        concurrently, sharing the boto3 client between threads.
 
         Parameters:
             df_summary (pandas DataFrame object): a dataframe read from
@@ -100,27 +122,34 @@ def append_df_wgs(df_summary, new_keys, itteration=0):
             all new data, i.e. data not currently summarised in
             wgs_samples.csv
 
-            itteration (int): the current itteration for reccursive
-            count
+            n_workers (int): the number of threads for downloading
+            FinalOut.csv files
 
         Returns:
             df_summary (pandas DataFrame object): an updated dataframe
             with new wgs sample metadata added
     """
-    df_summary.reset_index(inplace=True, drop=True)
-    # if not yet on last itteration (last new_key element)
     num_batches = len(new_keys)
-    if itteration < num_batches:
-        print(f"\t\tdownloading batch summary: {itteration+1} / {num_batches}",
-              end="\r")
-        # read FinalOut.csv for current key
-        finalout_df = finalout_s3_to_df(new_keys[itteration]).\
-            pipe(add_submission_col)
-        # append to df_summary
-        df_summary, _ = append_df_wgs(pd.concat([df_summary, finalout_df]),
-                                      new_keys, itteration+1)
-    else:
-        print(f"\t\tdownloaded batch summaries: \
-            {num_batches} / {num_batches} \n")
+    finalout_dfs = []
+    if num_batches:
+        s3_client = utils.get_s3_client()
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(finalout_s3_to_df, key,
+                                       s3_client=s3_client)
+                       for key in new_keys]
+            # collect results in the order of new_keys
+            for count, future in enumerate(futures, 1):
+                if count % utils.PROGRESS_INTERVAL == 0:
+                    print(f"\t\tdownloading batch summary: {count} / "
+                          f"{num_batches}", end="\r")
+                finalout_dfs.append(future.result())
+    print(f"\t\tdownloaded batch summaries: \
+        {num_batches} / {num_batches} \n")
+    if finalout_dfs:
+        # build the new rows with a single concat rather than one per batch
+        df_new = pd.concat(finalout_dfs,
+                           ignore_index=True).pipe(add_submission_col)
+        df_summary = pd.concat([df_summary, df_new])
+    df_summary = df_summary.reset_index(drop=True)
     metadata = {"total_number_of_wgs_samples": len(df_summary)}
     return df_summary, metadata
@@ -1,23 +1,73 @@
 import subprocess
+import os
 from os import path
+import hashlib
 import re
 import itertools
+import json
 import time
 import sys
 import threading
+import shutil
+import warnings
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 import botocore
+from botocore.config import Config
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+try:
+    import orjson
+except ImportError:
+    # optional; dump_json() falls back to json
+    orjson = None
 
+from btbphylo.paths import DEFAULT_WGS_SAMPLES_FILEPATH
 
 """
     Utility functions
 """
 
-DEFAULT_WGS_SAMPLES_FILEPATH = \
-    path.join(path.dirname(path.dirname(path.abspath(__file__))),
-              "all_wgs_samples.csv")
+# dtypes of the columns of the sample summary csv
+SUMMARY_DTYPES = {"Sample": "category", "GenomeCov": float,
+                  "MeanDepth": float, "NumRawReads": float,
+                  "pcMapped": float, "Outcome": "category",
+                  "flag": "category", "group": "category",
+                  "CSSTested": float, "matches": float,
+                  "mismatches": float, "noCoverage": float,
+                  "anomalous": float, "Ncount": float,
+                  "ResultLoc": "category", "ID": "category",
+                  "TotalReads": float, "Abundance": float,
+                  "Submission": object}
+
+# progress lines of per-sample/per-batch loops are printed once every
+# PROGRESS_INTERVAL iterations
+PROGRESS_INTERVAL = 100
+
+# number of rows of a csv parsed at a time when reading in chunks
+CSV_CHUNKSIZE = 100_000
+
+# keys of the parquet mirror's metadata recording the mtime (in ns) and size
+# of the csv it was written from
+PARQUET_CSV_MTIME_KEY = b"btbphylo.csv_mtime_ns"
+PARQUET_CSV_SIZE_KEY = b"btbphylo.csv_size"
+
+# size of the connection pool of the shared s3 client; should be at least
+# the number of threads using the client at once
+S3_MAX_POOL_CONNECTIONS = 64
+
+# objects larger than multipart_threshold are downloaded as concurrent
+# ranged GETs of multipart_chunksize bytes; smaller objects (e.g. consensus
+# files) are downloaded with a single GET
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=32 * 1024 * 1024,
+                                    multipart_chunksize=16 * 1024 * 1024,
+                                    max_concurrency=8)
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
 
 
 class InvalidDtype(Exception):
@@ -71,42 +121,147 @@ def format_warning(message, category, filename, lineno, file=None, line=None):
     return '%s:%s: %s:%s\n' % (filename, lineno, category.__name__, message)
 
 
-def wgs_csv_to_df(summary_filepath):
+def _arrow_type(dtype):
+    """
+        Returns the pyarrow type for reading a column of SUMMARY_DTYPES
+    """
+    if dtype == "category":
+        return pa.dictionary(pa.int32(), pa.string())
+    if dtype is float:
+        return pa.float64()
+    return pa.string()
+
+
+def arrow_csv_to_df(csv_filepath, dtypes, columns=None):
+    """
+        Reads a CSV with pyarrow's multi-threaded reader, with the
+        column types in dtypes (as passed to pandas.read_csv) fixed
+        rather than inferred. columns optionally limits the columns
+        read. Returns a pandas dataframe with the same dtypes as
+        pandas.read_csv(csv_filepath, dtype=dtypes, usecols=columns).
+    """
+    table = pa_csv.read_csv(
+        csv_filepath,
+        read_options=pa_csv.ReadOptions(use_threads=True,
+                                        block_size=16 << 20),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column_name: _arrow_type(dtype)
+                          for column_name, dtype in dtypes.items()},
+            strings_can_be_null=True,
+            include_columns=columns))
+    # converts and frees arrow's buffers column by column, rather than
+    # holding both copies of the data at once
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    # pandas sorts categories, where arrow keeps the order of appearance
+    for column_name, dtype in df.dtypes.items():
+        if pd.api.types.is_categorical_dtype(dtype):
+            df[column_name] = df[column_name].cat.set_categories(
+                dtype.categories.sort_values())
+    return df
+
+
+def wgs_csv_to_df(summary_filepath, chunksize=None, columns=None):
     """
         Read sample summary CSV and returns the data in a pandas
-        dataframe.
-    """
-    df = pd.read_csv(summary_filepath, comment="#",
-                     dtype={"Sample": "category", "GenomeCov": float,
-                            "MeanDepth": float, "NumRawReads": float,
-                            "pcMapped": float, "Outcome": "category",
-                            "flag": "category", "group": "category",
-                            "CSSTested": float, "matches": float,
-                            "mismatches": float, "noCoverage": float,
-                            "anomalous": float, "Ncount": float,
-                            "ResultLoc": "category", "ID": "category",
-                            "TotalReads": float, "Abundance": float,
-                            "Submission": object})
+        dataframe. If the CSV has a fresh parquet mirror (see
+        df_to_csv()) this is read instead, which avoids re-parsing
+        every value. columns optionally limits the columns read, which
+        from the parquet mirror avoids decoding the others at all. If
+        chunksize is set, the CSV is always read and an iterator over
+        dataframes of chunksize rows is returned instead. Reads are not
+        cached: pipeline stages share one parse by passing the dataframe
+        on (e.g. df_wgs_samples= in btb_phylo.py) instead.
+    """
+    if chunksize is not None:
+        return pd.read_csv(summary_filepath, comment="#",
+                           chunksize=chunksize, dtype=SUMMARY_DTYPES,
+                           usecols=columns)
+    if parquet_is_fresh(summary_filepath):
+        return wgs_parquet_to_df(summary_filepath, columns=columns)
+    try:
+        return arrow_csv_to_df(summary_filepath, SUMMARY_DTYPES, columns)
+    except pa.ArrowInvalid:
+        # e.g. comment lines, which only pandas can skip; parsed in chunks
+        # so that peak memory is about one chunk more than the dataframe
+        return concat_chunks(pd.read_csv(summary_filepath, comment="#",
+                                         chunksize=CSV_CHUNKSIZE,
+                                         dtype=SUMMARY_DTYPES,
+                                         usecols=columns))
+
+
+def concat_chunks(chunks):
+    """
+        Concatenates an iterable of dataframe chunks (e.g. from
+        pandas.read_csv(..., chunksize=n)) into one dataframe in a single
+        pass. Category columns are given the sorted union of every
+        chunk's categories, so that they stay categorical. If there are
+        no chunks, an empty sample summary dataframe is returned (see
+        empty_wgs_df()).
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return empty_wgs_df()
+    category_dtypes = {
+        column_name: pd.CategoricalDtype(pd.api.types.union_categoricals(
+            [chunk[column_name] for chunk in chunks],
+            sort_categories=True).categories)
+        for column_name, dtype in chunks[0].dtypes.items()
+        if pd.api.types.is_categorical_dtype(dtype)}
+    if category_dtypes:
+        chunks = [chunk.astype(category_dtypes) for chunk in chunks]
+    df = pd.concat(chunks, copy=False)
+    del chunks
     return df
 
 
+def empty_wgs_df():
+    """
+        Returns an empty sample summary dataframe with the columns and
+        dtypes of SUMMARY_DTYPES
+    """
+    return pd.DataFrame({column_name: pd.Series(dtype=dtype) for
+                         column_name, dtype in SUMMARY_DTYPES.items()})
+
+
 def finalout_csv_to_df(finalout_filepath):
     """
         Reads finalout CSV and returns the data in a pandas dataframe.
     """
-    df = pd.read_csv(finalout_filepath, comment="#",
-                     dtype={"Sample": "category", "GenomeCov": float,
-                            "MeanDepth": float, "NumRawReads": float,
-                            "pcMapped": float, "Outcome": "category",
-                            "flag": "category", "group": "category",
-                            "CSSTested": float, "matches": float,
-                            "mismatches": float, "noCoverage": float,
-                            "anomalous": float, "Ncount": float,
-                            "ResultLoc": "category", "ID": "category",
-                            "TotalReads": float, "Abundance": float})
+    df = pd.read_csv(finalout_filepath, comment="#", dtype=SUMMARY_DTYPES)
     return df
 
 
+def git_head_sha(repo_root):
+    """
+        Returns the commit SHA of HEAD of the git repository at
+        repo_root. Reads .git directly, following a symbolic ref to its
+        loose or packed ref, and only falls back to running
+        'git rev-parse HEAD' if this fails.
+    """
+    git_dir = path.join(repo_root, ".git")
+    try:
+        with open(path.join(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+        if not head.startswith("ref: "):
+            # detached HEAD
+            return head
+        ref = head[len("ref: "):]
+        ref_filepath = path.join(git_dir, ref)
+        if path.exists(ref_filepath):
+            with open(ref_filepath) as f:
+                return f.read().strip()
+        with open(path.join(git_dir, "packed-refs")) as f:
+            for line in f:
+                sha, _, packed_ref = line.rstrip("\n").partition(" ")
+                if packed_ref == ref:
+                    return sha
+    except OSError:
+        pass
+    return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                   cwd=repo_root).decode().strip("\n")
+
+
 def extract_submission_no(sample_name):
     """
         Extracts submision number from sample name using regex.
@@ -119,13 +274,34 @@ def extract_submission_no(sample_name):
     return submission_no.upper()
 
 
+def get_s3_client():
+    """
+        Returns the s3 client shared by all btbphylo modules, creating
+        it on first use. boto3 clients are thread safe, so the client
+        may be used by any number of threads at once; boto3 sessions
+        are not, so the client is created under a lock from its own
+        session. Reusing the client means that connections, and their
+        TLS handshakes, are reused between requests.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = boto3.session.Session().client(
+                    "s3", config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        tcp_keepalive=True,
+                        retries={"max_attempts": 10, "mode": "adaptive"}))
+    return _s3_client
+
+
 # TODO: remove if unused
 def s3_folder_exists(bucket, path):
     """
         Returns true if the folder is in the S3 bucket. False otherwise
     """
     exists = False
-    client = boto3.client('s3')
+    client = get_s3_client()
     path = path.join(path, "")
     response = client.list_objects(Bucket=bucket, Prefix=path, MaxKeys=1)
     if 'Contents' in response:
@@ -139,9 +315,8 @@ def s3_object_exists(bucket, key):
         Thanks: https://stackoverflow.com/questions/33842944/check-if-a-key-exists-in-a-bucket-in-s3-using-boto3
     """
     key_exists = True
-    s3 = boto3.resource('s3')
     try:
-        s3.Object(bucket, key).load()
+        get_s3_client().head_object(Bucket=bucket, Key=key)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             # The object does not exist.
@@ -152,6 +327,98 @@ def s3_object_exists(bucket, key):
     return key_exists
 
 
+def s3_object_etag(bucket, key, s3_client=None):
+    """
+        Returns the ETag (without quotes) and size in bytes of an S3
+        object. Uses the shared client (see get_s3_client()) unless
+        s3_client is provided.
+
+        Raises:
+            NoS3ObjectError: if the object does not exist
+    """
+    if s3_client is None:
+        s3_client = get_s3_client()
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            raise NoS3ObjectError(bucket, key)
+        raise e
+    return response["ETag"].strip('"'), response["ContentLength"]
+
+
+def s3_list_etags(bucket, prefix, s3_client=None):
+    """
+        Returns a dictionary mapping the key of every S3 object under
+        prefix to its ETag (without quotes) and size in bytes, listing
+        up to 1000 objects per request rather than one HEAD request per
+        object. Uses the shared client (see get_s3_client()) unless
+        s3_client is provided.
+    """
+    if s3_client is None:
+        s3_client = get_s3_client()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return {s3_object["Key"]: (s3_object["ETag"].strip('"'),
+                               s3_object["Size"])
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for s3_object in page.get("Contents", [])}
+
+
+def file_matches_etag(filepath, etag, size):
+    """
+        Returns True if the local file at filepath has the given size
+        and, for objects uploaded in a single part (whose ETag is the
+        MD5 of their content), the same MD5 as etag
+    """
+    if path.getsize(filepath) != size:
+        return False
+    if "-" in etag:
+        # multipart uploads have no content hash in their ETag
+        return True
+    md5 = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest() == etag
+
+
+def etag_filepath(filepath):
+    """
+        Returns the path of the file recording the ETag of the s3 object
+        which filepath was downloaded from
+    """
+    return f"{filepath}.etag"
+
+
+def recorded_etag(filepath):
+    """
+        Returns the ETag recorded for filepath by record_etag(), or None
+        if there isn't one
+    """
+    try:
+        with open(etag_filepath(filepath)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def record_etag(filepath, etag):
+    """
+        Records etag (string) as the ETag of the s3 object which
+        filepath was downloaded from, or removes any recorded ETag if
+        etag is None. The record is written to a temporary path and then
+        renamed into place.
+    """
+    if etag is None:
+        if path.exists(etag_filepath(filepath)):
+            os.remove(etag_filepath(filepath))
+        return
+    tmp_filepath = _tmp_filepath(etag_filepath(filepath))
+    with open(tmp_filepath, "w") as f:
+        f.write(etag)
+    os.replace(tmp_filepath, etag_filepath(filepath))
+
+
 def run(cmd, *args, **kwargs):
     """ Run a command and assert that the process exits with a non-zero
         exit code. See python's subprocess.run command for args/kwargs
@@ -166,14 +433,21 @@ def run(cmd, *args, **kwargs):
     """
     # TODO: store stdout to a file
     ps = subprocess.run(cmd, *args, **kwargs)
-    returncode = ps.returncode
+    check_returncode(cmd, ps.returncode)
+    if "capture_output" in kwargs and kwargs["capture_output"]:
+        return ps.stdout.decode().strip('\n')
+
+
+def check_returncode(cmd, returncode):
+    """
+        Raises the exception of run() if returncode, the exit code of
+        cmd, is non-zero
+    """
     if returncode:
         raise Exception("""*****
             %s
             cmd failed with exit code %i
           *****""" % (cmd, returncode))
-    if "capture_output" in kwargs and kwargs["capture_output"]:
-        return ps.stdout.decode().strip('\n')
 
 
 # TODO: remove if unused
@@ -191,17 +465,21 @@ def s3_download_folder(bucket, key, dest):
         raise NoS3ObjectError(bucket, key)
 
 
-# TODO: remove if unused
-def s3_download_file(bucket, key, dest):
+def s3_download_file(bucket, key, dest, s3_client=None):
     """
-        Downloads s3 folder at the key-bucket pair (strings) to dest
-        path (string) using boto3
+        Downloads s3 object at the key-bucket pair (strings) to dest
+        path (string) using boto3. Uses the shared client (see
+        get_s3_client()) unless s3_client is provided. Large objects are
+        downloaded in concurrent ranged parts (see S3_TRANSFER_CONFIG).
     """
-    if s3_object_exists(bucket, key):
-        s3 = boto3.client('s3')
-        s3.download_file(bucket, key, dest)
-    else:
-        raise NoS3ObjectError(bucket, key)
+    if s3_client is None:
+        s3_client = get_s3_client()
+    try:
+        s3_client.download_file(bucket, key, dest, Config=S3_TRANSFER_CONFIG)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ("404", "NoSuchKey"):
+            raise NoS3ObjectError(bucket, key)
+        raise e
 
 
 def s3_download_file_cli(bucket, key, dest):
@@ -217,8 +495,7 @@ def s3_download_file_cli(bucket, key, dest):
 
 
 def s3_upload_file(file, bucket, key):
-    s3_client = boto3.client('s3')
-    s3_client.upload_file(file, bucket, key)
+    get_s3_client().upload_file(file, bucket, key)
 
 
 # TODO: remove if unused
@@ -226,14 +503,164 @@ def list_s3_objects(bucket, prefix):
     """
         Return a list of s3 objects with the common prefix (argument)
     """
-    s3_client = boto3.client('s3')
-    response = s3_client.list_objects_v2(Bucket=bucket, Delimiter='/',
-                                         Prefix=prefix)
+    response = get_s3_client().list_objects_v2(Bucket=bucket, Delimiter='/',
+                                               Prefix=prefix)
     return [i['Prefix'] for i in response['CommonPrefixes']]
 
 
-def df_to_csv(df_wgs, summary_filepath=DEFAULT_WGS_SAMPLES_FILEPATH):
+def df_to_csv(df_wgs, summary_filepath=DEFAULT_WGS_SAMPLES_FILEPATH,
+              parquet=False):
+    """
+        Save df_wgs to csv. If parquet is True, also saves a zstd
+        compressed parquet mirror alongside the csv (see
+        parquet_filepath()), with string columns dictionary encoded and
+        the csv's mtime and size recorded in its metadata (see
+        parquet_is_fresh()). Each file is written to a temporary path and then renamed into
+        place, so that readers and hard links of the previous file (see
+        link_or_copy()) never see a partially written file.
+    """
+    tmp_filepath = _tmp_filepath(summary_filepath)
+    df_wgs.to_csv(tmp_filepath, index=False)
+    os.replace(tmp_filepath, summary_filepath)
+    if parquet:
+        csv_stat = os.stat(summary_filepath)
+        tmp_filepath = _tmp_filepath(parquet_filepath(summary_filepath))
+        try:
+            table = pa.Table.from_pandas(df_wgs, preserve_index=False)
+            table = table.replace_schema_metadata(
+                {**table.schema.metadata,
+                 PARQUET_CSV_MTIME_KEY: str(csv_stat.st_mtime_ns),
+                 PARQUET_CSV_SIZE_KEY: str(csv_stat.st_size)})
+            pq.write_table(table, tmp_filepath, compression="zstd",
+                           use_dictionary=True, row_group_size=50_000)
+            os.replace(tmp_filepath, parquet_filepath(summary_filepath))
+        except (ValueError, TypeError) as e:
+            if path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            # any existing mirror no longer matches the csv, so is not used
+            warnings.warn(f"Could not save parquet mirror of "
+                          f"{summary_filepath}: {e}")
+
+
+def _tmp_filepath(filepath):
+    """
+        Returns a temporary path in the same directory as filepath, for
+        writing a file which is then renamed to filepath
+    """
+    return f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def link_or_copy(src, dst):
+    """
+        Hard links dst to src, replacing any existing dst, or copies src
+        to dst if src can not be linked (e.g. dst is on another
+        filesystem). Does nothing if dst is already src, and only copies
+        if dst is missing or differs from src in size or mtime. dst is
+        only replaced once the link or copy is complete, so a failure
+        leaves any existing dst in place.
+    """
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        dst_stat = None
+    if dst_stat is not None and path.samestat(src_stat, dst_stat):
+        return
+    tmp_filepath = _tmp_filepath(dst)
+    try:
+        os.link(src, tmp_filepath)
+    except OSError:
+        if dst_stat is not None and dst_stat.st_size == src_stat.st_size \
+                and dst_stat.st_mtime_ns == src_stat.st_mtime_ns:
+            # an earlier copy of the same file
+            return
+        # copy2 keeps the mtime, as a link would
+        try:
+            shutil.copy2(src, tmp_filepath)
+        except BaseException:
+            if path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
+            raise
+    os.replace(tmp_filepath, dst)
+
+
+def link_or_copy_summary(summary_filepath, dst):
+    """
+        link_or_copy() for a summary csv and, if it is fresh, its
+        parquet mirror
+    """
+    link_or_copy(summary_filepath, dst)
+    if parquet_is_fresh(summary_filepath):
+        link_or_copy(parquet_filepath(summary_filepath),
+                     parquet_filepath(dst))
+
+
+def dump_json(obj, filepath):
+    """
+        Saves obj to filepath as JSON indented by 2 spaces. Uses orjson
+        if it is installed and can serialise obj, otherwise json.
+    """
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 |
+                                orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            # e.g. non-string keys, which json converts
+            pass
+        else:
+            with open(filepath, "wb") as f:
+                f.write(data)
+            return
+    with open(filepath, "w") as f:
+        json.dump(obj, f, indent=2)
+
+
+def parquet_filepath(summary_filepath):
+    """
+        Returns the path to the parquet mirror of a summary csv
+    """
+    return path.splitext(summary_filepath)[0] + ".parquet"
+
+
+def parquet_is_fresh(summary_filepath):
+    """
+        Returns True if summary_filepath has a parquet mirror which was
+        written from the csv as it is now, i.e. the csv's mtime (in ns)
+        and size match those recorded in the mirror's metadata by
+        df_to_csv(). Comparing mtimes of the two files instead would
+        pass stale mirrors on filesystems with coarse timestamps.
+    """
+    parquet = parquet_filepath(summary_filepath)
+    if not (path.exists(summary_filepath) and path.exists(parquet)):
+        return False
+    try:
+        metadata = pq.read_schema(parquet).metadata or {}
+    except pa.ArrowInvalid:
+        return False
+    csv_stat = os.stat(summary_filepath)
+    return metadata.get(PARQUET_CSV_MTIME_KEY) == \
+        str(csv_stat.st_mtime_ns).encode() and \
+        metadata.get(PARQUET_CSV_SIZE_KEY) == str(csv_stat.st_size).encode()
+
+
+def wgs_parquet_schema(summary_filepath):
+    """
+        Returns the pyarrow schema of the parquet mirror of a sample
+        summary CSV
+    """
+    return pq.read_schema(parquet_filepath(summary_filepath))
+
+
+def wgs_parquet_to_df(summary_filepath, filters=None, columns=None):
     """
-        Save df_wgs to csv
+        Reads the parquet mirror of a sample summary CSV and returns the
+        data in a pandas dataframe. filters is passed to pyarrow, so
+        that row groups which can not match are never decoded, and
+        columns optionally limits the columns read.
     """
-    df_wgs.to_csv(summary_filepath, index=False)
+    df = pd.read_parquet(parquet_filepath(summary_filepath),
+                         engine="pyarrow", filters=filters or None,
+                         columns=columns)
+    # match the dtypes of wgs_csv_to_df()
+    return df.astype({column_name: dtype for column_name, dtype in
+                      SUMMARY_DTYPES.items() if column_name in df.columns})
@@ -8,7 +8,7 @@ setup(name=NAME,
       version="beta",
       license="MIT",
       url="https://github.com/APHA-CSU/btb-phylo",
-      install_requires=['pandas', 'boto3'], 
+      install_requires=['pandas', 'numpy', 'pyarrow', 'boto3'], 
       packages = find_packages())
 
 # remove build and metadata
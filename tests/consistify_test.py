@@ -43,3 +43,6 @@ class TestConsistify(unittest.TestCase):
         cattle_corrected = consistify.clade_correction(test_wgs, test_cattle)
         # assert output
         nptesting.assert_array_equal(cattle_corrected, test_cattle_corrected)
+        # test cattle records in a different order to the wgs records
+        cattle_corrected = consistify.clade_correction(test_wgs, test_cattle.iloc[::-1])
+        nptesting.assert_array_equal(cattle_corrected, test_cattle_corrected.iloc[::-1])
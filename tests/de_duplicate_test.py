@@ -1,6 +1,7 @@
 import unittest
 from unittest import mock
 
+import numpy as np
 import pandas as pd
 import numpy.testing as nptesting
 
@@ -8,6 +9,14 @@ import btbphylo.de_duplicate as de_duplicate
 
 
 class TestDeDuplicate(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # large frame with ~10 samples per submission, built once
+        rng = np.random.default_rng(0)
+        cls.big_dup_df = pd.DataFrame({"Submission": pd.Series(rng.integers(0, 10000, 100_000).astype(str),
+                                                               dtype="object"),
+                                       "pcMapped": rng.random(100_000)})
+
     def test_remove_duplicates(self):
         # test normal operation
         # test input
@@ -15,7 +24,7 @@ class TestDeDuplicate(unittest.TestCase):
                                 "foo": pd.Series([1, 2, 3, 4, 5, 6], dtype=float),
                                 "bar": pd.Series([1, 2, 3, 4, 5, 6], dtype=float)})
         # test output
-        desired_df_output = pd.DataFrame({"Submission": ["D", "E", "F"], "pcMapped": [4, 5, 6], "Ncount": [4, 5, 6]})
+        desired_df_output = np.array([["D", 4, 4], ["E", 5, 5], ["F", 6, 6]], dtype=object)
         desired_metadata_output = {"number_of_duplicate_WGS_submissions": 3}
         # mock get_indexes_to_remove
         with mock.patch("btbphylo.de_duplicate.get_indexes_to_remove") as mock_get_indexes_to_remove:
@@ -23,9 +32,8 @@ class TestDeDuplicate(unittest.TestCase):
             mock_get_indexes_to_remove.side_effect = [pd.Index([0, 1]),
                                                       pd.Index([2])]
             # assert output
-            metadata, df_output = de_duplicate.remove_duplicates(test_df, foo="max", bar="min")
-            nptesting.assert_array_equal(df_output.values, desired_df_output.values)
-            self.assertDictEqual(metadata, desired_metadata_output)
+            df_output = de_duplicate.drop_duplicates_iteratively(test_df, foo="max", bar="min")
+            nptesting.assert_array_equal(df_output.values, desired_df_output)
             actual_get_index_to_remove_calls = mock_get_indexes_to_remove.call_args_list
             # assert calls to get_indexes_to_remove
             nptesting.assert_array_equal(actual_get_index_to_remove_calls[0][0][0], test_df.loc[pd.Index([0, 1, 2, 3, 4, 5])])
@@ -35,14 +43,31 @@ class TestDeDuplicate(unittest.TestCase):
         test_df = pd.DataFrame({"Submission": pd.Series(["A", "A"], dtype="object"),
                                 "foo": pd.Series([1, 2], dtype=float)})
         # test output
-        desired_df_output = pd.DataFrame({"Submission": ["A"], "foo": [1]})
+        desired_df_output = np.array([["A", 1]], dtype=object)
         desired_metadata_output = {"number_of_duplicate_WGS_submissions": 1}
         with mock.patch("btbphylo.de_duplicate.get_indexes_to_remove") as mock_get_indexes_to_remove:
             # side effect is to return no indexes, i.e. don't remove any entries
             mock_get_indexes_to_remove.side_effect = [pd.Index([])]
+            df_output = de_duplicate.drop_duplicates_iteratively(test_df, foo="max")
+            nptesting.assert_array_equal(df_output.values, desired_df_output)
+
+        # test choosing between the sorting and iterative methods
+        test_df = pd.DataFrame({"Submission": pd.Series(["A", "A", "B", "C", "D", "E"], dtype="object"),
+                                "foo": pd.Series([1, 2, 3, 4, 5, 6], dtype=float),
+                                "bar": pd.Series(["1", "2", "3", "4", "5", "6"], dtype="object")})
+        with mock.patch("btbphylo.de_duplicate.sort_and_drop_duplicates") as mock_sort_and_drop_duplicates, \
+                mock.patch("btbphylo.de_duplicate.drop_duplicates_iteratively") as mock_drop_duplicates_iteratively:
+            mock_sort_and_drop_duplicates.return_value = test_df.iloc[1:]
+            mock_drop_duplicates_iteratively.return_value = test_df.iloc[2:]
+            # numerical columns only
             metadata, df_output = de_duplicate.remove_duplicates(test_df, foo="max")
-            nptesting.assert_array_equal(df_output.values, desired_df_output.values)
+            mock_sort_and_drop_duplicates.assert_called_once_with(test_df, foo="max")
+            mock_drop_duplicates_iteratively.assert_not_called()
             self.assertDictEqual(metadata, desired_metadata_output)
+            # categorical column
+            metadata, df_output = de_duplicate.remove_duplicates(test_df, foo="max", bar="1")
+            mock_drop_duplicates_iteratively.assert_called_once_with(test_df, foo="max", bar="1")
+            self.assertDictEqual(metadata, {"number_of_duplicate_WGS_submissions": 2})
 
         # test exceptions
         with self.assertRaises(ValueError):
@@ -58,6 +83,43 @@ class TestDeDuplicate(unittest.TestCase):
             de_duplicate.remove_duplicates(pd.DataFrame({"Submission": pd.Series(["1"], dtype="object"),
                                            "foo": pd.Series([1], dtype=float)}))
 
+    def test_remove_duplicates_scale(self):
+        metadata, df_output = de_duplicate.remove_duplicates(self.big_dup_df, pcMapped="max")
+        # test one sample, with the largest pcMapped, is kept per submission
+        max_pc_mapped = self.big_dup_df.groupby("Submission")["pcMapped"].max()
+        self.assertTrue(df_output["Submission"].is_unique)
+        nptesting.assert_array_equal(df_output["pcMapped"], max_pc_mapped[df_output["Submission"]])
+        self.assertDictEqual(metadata, {"number_of_duplicate_WGS_submissions":
+                                        len(self.big_dup_df) - len(max_pc_mapped)})
+
+    def test_remove_duplicates_without_groupby(self):
+        shuffled_df = self.big_dup_df.sample(frac=1, random_state=0)
+        expected = de_duplicate.drop_duplicates_iteratively(shuffled_df, pcMapped="max")
+        # test min/max deduplication is dispatched to the sort path, which
+        # never groups
+        with mock.patch.object(pd.DataFrame, "groupby", side_effect=AssertionError("groupby path hit")), \
+                mock.patch.object(pd.Series, "groupby", side_effect=AssertionError("groupby path hit")), \
+                mock.patch("btbphylo.de_duplicate.drop_duplicates_iteratively",
+                           side_effect=AssertionError("iterative path hit")), \
+                mock.patch("btbphylo.de_duplicate.sort_and_drop_duplicates",
+                           wraps=de_duplicate.sort_and_drop_duplicates) as mock_sort_and_drop_duplicates:
+            metadata, df_output = de_duplicate.remove_duplicates(shuffled_df, pcMapped="max")
+        mock_sort_and_drop_duplicates.assert_called_once_with(shuffled_df, pcMapped="max")
+        # test the same samples are kept as by the iterative path
+        pd.testing.assert_frame_equal(df_output, expected)
+
+    def test_sort_and_drop_duplicates(self):
+        # test the same samples are kept as when iteratively removing duplicates
+        rng = np.random.default_rng(0)
+        test_df = pd.DataFrame({"Submission": pd.Series(rng.integers(0, 50, 200).astype(str), dtype="object"),
+                                "pcMapped": pd.Series(rng.integers(0, 4, 200), dtype=float),
+                                "Ncount": pd.Series(rng.integers(0, 4, 200), dtype=float)},
+                               index=rng.permutation(200))
+        test_df.loc[test_df.index[::7], "pcMapped"] = np.nan
+        pd.testing.assert_frame_equal(de_duplicate.sort_and_drop_duplicates(test_df, pcMapped="max", Ncount="min"),
+                                      de_duplicate.drop_duplicates_iteratively(test_df, pcMapped="max",
+                                                                               Ncount="min"))
+
     def test_get_indexes_to_remove(self):
         # test max
         test_df = pd.DataFrame({"Submission": pd.Series(["1", "1", "2", "2", "3"], dtype="object"),
@@ -1,43 +1,93 @@
+import os
 import unittest
+import tempfile
+import tracemalloc
+from unittest import mock
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import numpy.testing as nptesting
+import pandas.testing as pdtesting
 
 from btbphylo import filter_samples
 
 
+# invalid kwargs for filter_columns_numeric() and the exceptions they raise
+NUMERIC_BAD_KWARGS = (
+    # invalid kwarg type
+    (filter_samples.utils.InvalidDtype, {"column_A": "foo"}),
+    (filter_samples.utils.InvalidDtype, {"column_B": "foo"}),
+    # invlalid kwarg: is not in df.columns
+    (KeyError, {"foo": "foo"}),
+    # invalid kwarg val: must be len(2)
+    (ValueError, {"column_D": (1, )}),
+    (ValueError, {"column_D": (1, 2, 3)}),
+    # invalid kwarg val: must be type list or tuple
+    (ValueError, {"column_D": 1}),
+    (ValueError, {"column_D": "foo"}),
+    # invalid kwarg val: must be len(2)
+    (ValueError, {"column_D": ("foo",)}),
+    (ValueError, {"column_D": ("foo", "bar", "baz")}),
+    # invalid kwarg val: elements must be numeric
+    (ValueError, {"column_D": ("foo", "bar")}),
+    # invalid kwarg val: elements must be in order min followed by max
+    (ValueError, {"column_D": (2, 1)}),
+)
+
+# invalid kwargs for filter_columns_categorical() and the exceptions they raise
+CATEGORICAL_BAD_KWARGS = (
+    # invalid kwarg type
+    (filter_samples.utils.InvalidDtype, {"column_C": []}),
+    (filter_samples.utils.InvalidDtype, {"column_D": []}),
+    # invlalid kwarg: is not in df.columns
+    (KeyError, {"foo": "foo"}),
+    # invalid kwarg type: must be list
+    (ValueError, {"column_A": "a"}),
+    (ValueError, {"column_B": ("A", "Pass")}),
+    # invalid kwarg type: must be list of strings
+    (ValueError, {"column_A": [1, 2, 3]}),
+)
+
+
 class TestFilterSamples(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # categorical dtypes, so that categories aren't inferred for every series
+        cls.outcome_dtype = pd.CategoricalDtype(["Fail", "Pass"])
+        cls.abcd_dtype = pd.CategoricalDtype(list("abcd"))
+        # dataframes for input, built once and shared by tests; none of the
+        # functions under test modify their input
+        cls.filter_df_input = pd.DataFrame({"column_A": pd.Series(["a", "b", "c", "d", "e"], dtype="object"),
+                                            "Outcome": pd.Series(["Fail", "Pass", "Pass", "Pass", "Pass"],
+                                                                 dtype=cls.outcome_dtype),
+                                            "pcMapped": pd.Series([0.1, 0.2, 0.3, 0.4, 0.5], dtype=float),
+                                            "column_D": pd.Series([1, 3, 5, 7, 9], dtype=int)})
+        cls.numeric_input = pd.DataFrame({"column_A": pd.Series(["a", "b", "c", "d"], dtype=cls.abcd_dtype),
+                                          "column_B": pd.Series(["A", "B", "C", "D"], dtype=object),
+                                          "column_C": pd.Series([0.1, 0.2, 0.3, 0.4], dtype=float),
+                                          "column_D": pd.Series([1, 3, 5, 7], dtype=int)})
+        cls.categorical_input = cls.numeric_input.assign(column_D=pd.Series([1, 2, 3, 4], dtype=int))
+
     def test_filter_df(self):
-        # define dataframe for input
-        test_df = pd.DataFrame({"column_A": pd.Series(["a", "b", "c", "d", "e"], dtype="object"),
-                                "Outcome": pd.Series(["Fail", "Pass", "Pass", "Pass", "Pass"], dtype="category"),
-                                "pcMapped": pd.Series([0.1, 0.2, 0.3, 0.4, 0.5], dtype=float),
-                                "column_D": pd.Series([1, 3, 5, 7, 9], dtype=int)})
+        test_df = self.filter_df_input
         # test individual filters
         outcome = filter_samples.filter_df(test_df, pcMapped=(0.1, 0.3))
-        nptesting.assert_array_equal(outcome.values, pd.DataFrame({"column_A": ["b", "c"], "Outcome": ["Pass", "Pass"],
-                                     "pcMapped": [0.2, 0.3], "column_D": [3, 5]}).values)
+        pdtesting.assert_frame_equal(outcome, test_df.iloc[[1, 2]])
         outcome = filter_samples.filter_df(test_df, column_A=["a", "b", "e"])
-        nptesting.assert_array_equal(outcome.values, pd.DataFrame({"column_A": ["b", "e"], "Outcome": ["Pass", "Pass"],
-                                     "pcMapped": [0.2, 0.5], "column_D": [3, 9]}).values)
+        pdtesting.assert_frame_equal(outcome, test_df.iloc[[1, 4]])
         outcome = filter_samples.filter_df(test_df, column_D=(7, 10))
-        nptesting.assert_array_equal(outcome.values, pd.DataFrame({"column_A": ["d", "e"], "Outcome": ["Pass", "Pass"],
-                                     "pcMapped": [0.4, 0.5], "column_D": [7, 9]}).values)
+        pdtesting.assert_frame_equal(outcome, test_df.iloc[[3, 4]])
         # test multiple filters
         outcome = filter_samples.filter_df(test_df, pcMapped=(0.15, 0.45),
                                            column_A=["a", "b", "d", "e"], column_D=(2, 8))
-        nptesting.assert_array_equal(outcome.values, pd.DataFrame({"column_A": ["b", "d"], "Outcome": ["Pass", "Pass"],
-                                     "pcMapped": [0.2, 0.4], "column_D": [3, 7]}).values)
+        pdtesting.assert_frame_equal(outcome, test_df.iloc[[1, 3]])
         outcome = filter_samples.filter_df(test_df, pcMapped=(0.05, 0.45),
                                            column_A=["a", "b", "d", "e"], column_D=(0.5, 8), Outcome=["Pass", "Fail"])
-        nptesting.assert_array_equal(outcome.values, pd.DataFrame({"column_A": ["a", "b", "d"], "Outcome": ["Fail", "Pass", "Pass"],
-                                     "pcMapped": [0.1, 0.2, 0.4], "column_D": [1, 3, 7]}).values)
+        pdtesting.assert_frame_equal(outcome, test_df.iloc[[0, 1, 3]])
         # test no filters
         outcome = filter_samples.filter_df(test_df)
-        nptesting.assert_array_equal(outcome.values, pd.DataFrame({"column_A": pd.Series(["b", "c", "d", "e"], dtype="object"),
-                                                                   "Outcome": pd.Series(["Pass", "Pass", "Pass", "Pass"], dtype="category"),
-                                                                   "pcMapped": pd.Series([0.2, 0.3, 0.4, 0.5], dtype=float),
-                                                                   "column_D": pd.Series([3, 5, 7, 9], dtype=int)}).values)
+        pdtesting.assert_frame_equal(outcome, test_df.iloc[[1, 2, 3, 4]])
         # test empty output < 1 samples
         # empty
         with self.assertRaises(Exception):
@@ -55,105 +105,107 @@ class TestFilterSamples(unittest.TestCase):
         with self.assertRaises(ValueError):
             filter_samples.filter_df(test_df, foo="foo")
 
+    def test_filter_df_vectorised(self):
+        rng = np.random.default_rng(0)
+        # build categoricals from codes, rather than inferring categories from
+        # 100k strings
+        test_df = pd.DataFrame({"column_A": pd.Categorical.from_codes(rng.integers(0, 8, 100_000),
+                                                                      categories=list("abcdefgh")),
+                                "Outcome": pd.Categorical.from_codes(rng.integers(0, 2, 100_000),
+                                                                     dtype=self.outcome_dtype),
+                                "pcMapped": rng.random(100_000)})
+        # test filtering is done with boolean masks rather than row by row
+        with mock.patch.object(pd.DataFrame, "apply", autospec=True, side_effect=pd.DataFrame.apply) as mock_apply, \
+                mock.patch.object(pd.Series, "apply", autospec=True, side_effect=pd.Series.apply) as mock_series_apply:
+            outcome = filter_samples.filter_df(test_df, pcMapped=(0.1, 0.9), column_A=list("abcdef"))
+        mock_apply.assert_not_called()
+        mock_series_apply.assert_not_called()
+        expected = test_df[(test_df["pcMapped"] >= 0.1) & (test_df["pcMapped"] <= 0.9) &
+                           test_df["column_A"].isin(list("abcdef")) & (test_df["Outcome"] == "Pass")]
+        pdtesting.assert_frame_equal(outcome, expected)
+
     def test_filter_columns_numeric(self):
-        # define dataframe for input
-        test_df = pd.DataFrame({"column_A": pd.Series(["a", "b", "c", "d"], dtype="category"),
-                                "column_B": pd.Series(["A", "B", "C", "D"], dtype=object),
-                                "column_C": pd.Series([0.1, 0.2, 0.3, 0.4], dtype=float),
-                                "column_D": pd.Series([1, 3, 5, 7], dtype=int)})
+        test_df = self.numeric_input
         # test filter on float series
-        nptesting.assert_array_equal(filter_samples.filter_columns_numeric(test_df, column_C=(0.15, 0.35)).values,
-                                     pd.DataFrame({"column_A": ["b", "c"], "column_B": ["B", "C"],
-                                                   "column_C": [0.2, 0.3], "column_D": [3, 5]}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_numeric(test_df, column_C=(0.15, 0.35)),
+                                     test_df.iloc[[1, 2]])
         # test filter on int series
-        nptesting.assert_array_equal(filter_samples.filter_columns_numeric(test_df, column_D=(2, 6)).values,
-                                     pd.DataFrame({"column_A": ["b", "c"], "column_B": ["B", "C"],
-                                                   "column_C": [0.2, 0.3], "column_D": [3, 5]}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_numeric(test_df, column_D=(2, 6)),
+                                     test_df.iloc[[1, 2]])
         # test filter on multiple series
-        nptesting.assert_array_equal(filter_samples.filter_columns_numeric(test_df, column_D=(2, 4),
-                                                                           column_C=(0.05, 0.35)).values,
-                                     pd.DataFrame({"column_A": ["b"], "column_B": ["B"],
-                                                   "column_C": [0.2], "column_D": [3]}).values)
-        nptesting.assert_array_equal(filter_samples.filter_columns_numeric(test_df, **{"column_D": (3, 8),
-                                                                           "column_C": (0.25, 0.35)}).values,
-                                     pd.DataFrame({"column_A": ["c"], "column_B": ["C"],
-                                                   "column_C": [0.3], "column_D": [5]}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_numeric(test_df, column_D=(2, 4),
+                                                                           column_C=(0.05, 0.35)),
+                                     test_df.iloc[[1]])
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_numeric(test_df, **{"column_D": (3, 8),
+                                                                           "column_C": (0.25, 0.35)}),
+                                     test_df.iloc[[2]])
         # test empty output
         self.assertTrue(filter_samples.filter_columns_numeric(test_df, column_C=(0.23, 0.24)).empty)
         # test exceptions
-        # invalid kwarg type
-        with self.assertRaises(filter_samples.utils.InvalidDtype):
-            filter_samples.filter_columns_numeric(test_df, column_A="foo")
-        with self.assertRaises(filter_samples.utils.InvalidDtype):
-            filter_samples.filter_columns_numeric(test_df, column_B="foo")
-        # invlalid kwarg: is not in df.columns
-        with self.assertRaises(KeyError):
-            filter_samples.filter_columns_numeric(test_df, foo="foo")
-        # invalid kwarg val: must be len(2)
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D=(1, ))
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D=(1, 2, 3))
-        # invalid kwarg val: must be type list or tuple
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D=1)
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D="foo")
-        # invalid kwarg val: must be len(2)
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D=("foo",))
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D=("foo", "bar", "baz"))
-        # invalid kwarg val: elements must be numeric
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D=("foo", "bar"))
-        # invalid kwarg val: elements must be in order min followed by max
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_numeric(test_df, column_D=(2, 1))
+        for exception, kwargs in NUMERIC_BAD_KWARGS:
+            with self.subTest(kwargs=kwargs), self.assertRaises(exception):
+                filter_samples.filter_columns_numeric(test_df, **kwargs)
+
+    def test_filter_columns_numeric_dtypes(self):
+        # test downcast numeric columns are filtered without upcasting
+        test_df = pd.DataFrame({"x": pd.Series([0.1, 0.2, 0.3, 0.4], dtype="float32"),
+                                "y": pd.Series([1, 3, 5, 7], dtype="int32"),
+                                "z": pd.Series([1, 2, 3, 4], dtype="int8")})
+        outcome = filter_samples.filter_columns_numeric(test_df, x=(0.15, 0.35), y=(1, 6), z=(1, 3))
+        pdtesting.assert_frame_equal(outcome, test_df.iloc[[1, 2]])
+        self.assertEqual(outcome["x"].dtype, np.float32)
+        self.assertEqual(outcome["y"].dtype, np.int32)
+        self.assertEqual(outcome["z"].dtype, np.int8)
+
+    def test_numeric_mask_uses_arrays(self):
+        rng = np.random.default_rng(0)
+        test_df = pd.DataFrame({"x": rng.random(10_000), "y": rng.integers(0, 200, 10_000),
+                                "z": rng.random(10_000)})
+        # test only numpy arrays, not pandas objects, reach the comparisons
+        with mock.patch.object(np, "greater_equal", wraps=np.greater_equal) as mock_greater_equal, \
+                mock.patch.object(np, "less_equal", wraps=np.less_equal) as mock_less_equal:
+            outcome = filter_samples.filter_columns_numeric(test_df, x=(0.1, 0.9), y=(1, 100), z=(0.0, 1.0))
+        for mock_ufunc in (mock_greater_equal, mock_less_equal):
+            self.assertEqual(mock_ufunc.call_count, 3)
+            for call in mock_ufunc.call_args_list:
+                self.assertIsInstance(call.args[0], np.ndarray)
+                self.assertIsInstance(call.kwargs["out"], np.ndarray)
+        pdtesting.assert_frame_equal(outcome, test_df[test_df["x"].between(0.1, 0.9) &
+                                                      test_df["y"].between(1, 100) &
+                                                      test_df["z"].between(0.0, 1.0)])
 
     def test_filter_columns_categorical(self):
-        # define dataframe for input
-        test_df = pd.DataFrame({"column_A": pd.Series(["a", "b", "c", "d"], dtype="category"),
-                                "column_B": pd.Series(["A", "B", "C", "D"], dtype=object),
-                                "column_C": pd.Series([0.1, 0.2, 0.3, 0.4], dtype=float),
-                                "column_D": pd.Series([1, 2, 3, 4], dtype=int)})
+        test_df = self.categorical_input
         # test filter on category series
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, column_A=["a"]).values,
-                                     pd.DataFrame({"column_A": ["a"], "column_B": ["A"],
-                                                   "column_C": [0.1], "column_D": [1]}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, column_A=["a"]),
+                                     test_df.iloc[[0]])
         # test filter on object series
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, column_B=["B", "D"]).values,
-                                     pd.DataFrame({"column_A": ["b", "d"], "column_B": ["B", "D"],
-                                                   "column_C": [0.2, 0.4], "column_D": [2, 4]}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, column_B=["B", "D"]),
+                                     test_df.iloc[[1, 3]])
         # test filter by excluding
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, not_column_B=["B", "D"]).values,
-                                     pd.DataFrame({"column_A": ["a", "c"], "column_B": ["A", "C"],
-                                                   "column_C": [0.1, 0.3], "column_D": [1, 3]}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, not_column_B=["B", "D"]),
+                                     test_df.iloc[[0, 2]])
         # test filter by excluding and including - include followed by exclude
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, column_A=["a", "b"],
-                                                                               not_column_B=["B", "D"]).values,
-                                     pd.DataFrame({"column_A": ["a"], "column_B": ["A"],
-                                                   "column_C": [0.1], "column_D": [1]}).values)
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, column_B=["A", "B", "C", "D"],
-                                                                               not_column_A=["a", "b", "c", "d"]).values,
-                                     pd.DataFrame({"coulmn_A": [], "column_B": [], "column_c": [], "column_d": []}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, column_A=["a", "b"],
+                                                                               not_column_B=["B", "D"]),
+                                     test_df.iloc[[0]])
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, column_B=["A", "B", "C", "D"],
+                                                                               not_column_A=["a", "b", "c", "d"]),
+                                     test_df.iloc[[]])
         # test filter by excluding and including - exlcude followed by include
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, not_column_B=["B", "D"],
-                                                                               column_A=["a", "b"]).values,
-                                     pd.DataFrame({"column_A": ["a"], "column_B": ["A"],
-                                                   "column_C": [0.1], "column_D": [1]}).values)
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, not_column_B=["A", "B", "C", "D"],
-                                                                               column_A=["a", "b", "c", "d"]).values,
-                                     pd.DataFrame({"coulmn_A": [], "column_B": [], "column_c": [], "column_d": []}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, not_column_B=["B", "D"],
+                                                                               column_A=["a", "b"]),
+                                     test_df.iloc[[0]])
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, not_column_B=["A", "B", "C", "D"],
+                                                                               column_A=["a", "b", "c", "d"]),
+                                     test_df.iloc[[]])
         # test filter on multiple series
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, column_B=["B", "D"],
-                                                                               column_A=["a", "b"]).values,
-                                     pd.DataFrame({"column_A": ["b"], "column_B": ["B"],
-                                                   "column_C": [0.2], "column_D": [2]}).values)
-        nptesting.assert_array_equal(filter_samples.filter_columns_categorical(test_df, **{"column_B": ["B", "D"],
-                                                                               "column_A": ["c", "d"]}).values,
-                                     pd.DataFrame({"column_A": ["d"], "column_B": ["D"],
-                                                   "column_C": [0.4], "column_D": [4]}).values)
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, column_B=["B", "D"],
+                                                                               column_A=["a", "b"]),
+                                     test_df.iloc[[1]])
+        pdtesting.assert_frame_equal(filter_samples.filter_columns_categorical(test_df, **{"column_B": ["B", "D"],
+                                                                               "column_A": ["c", "d"]}),
+                                     test_df.iloc[[3]])
         # test empty output
         self.assertTrue(filter_samples.filter_columns_categorical(test_df, column_A=["a", "b"],
                                                                   column_B=["C", "D"]).empty)
@@ -162,20 +214,141 @@ class TestFilterSamples(unittest.TestCase):
         with self.assertWarns(Warning):
             filter_samples.filter_columns_categorical(test_df, column_A=["Z", "Y"], column_B=["x"])
         # test exceptions
-        # invalid kwarg type
-        with self.assertRaises(filter_samples.utils.InvalidDtype):
-            filter_samples.filter_columns_categorical(test_df, column_C=[])
-        # invalid kwarg type
-        with self.assertRaises(filter_samples.utils.InvalidDtype):
-            filter_samples.filter_columns_categorical(test_df, column_D=[])
-        # invlalid kwarg: is not in df.columns
-        with self.assertRaises(KeyError):
-            filter_samples.filter_columns_categorical(test_df, foo="foo")
-        # invalid kwarg type: must be list
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_categorical(test_df, column_A="a")
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_categorical(test_df, column_B=("A", "Pass"))
-        # invalid kwarg type: must be list of strings
-        with self.assertRaises(ValueError):
-            filter_samples.filter_columns_categorical(test_df, column_A=[1, 2, 3])
+        for exception, kwargs in CATEGORICAL_BAD_KWARGS:
+            with self.subTest(kwargs=kwargs), self.assertRaises(exception):
+                filter_samples.filter_columns_categorical(test_df, **kwargs)
+
+    def test_filter_columns_categorical_uses_codes(self):
+        rng = np.random.default_rng(0)
+        test_df = pd.DataFrame({"column_A": pd.Series(rng.choice(["a", "b", "c", "d"], 10000),
+                                                      dtype=self.abcd_dtype)})
+        # warm up, so that one-off allocations aren't traced
+        filter_samples.filter_columns_categorical(test_df, column_A=["a", "b"])
+        tracemalloc.start()
+        try:
+            outcome = filter_samples.filter_columns_categorical(test_df, column_A=["a", "b"])
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # test the filtered column is still categorical with unchanged categories
+        self.assertEqual(outcome["column_A"].dtype.name, "category")
+        self.assertTrue(outcome["column_A"].cat.categories.equals(test_df["column_A"].cat.categories))
+        nptesting.assert_array_equal(outcome.index, test_df.index[test_df["column_A"].isin(["a", "b"])])
+        # test the saving: one byte codes, several times smaller than strings...
+        self.assertEqual(outcome["column_A"].cat.codes.dtype, np.int8)
+        object_bytes = outcome.astype(object).memory_usage(deep=True).sum()
+        self.assertLess(outcome.memory_usage(deep=True).sum() * 5, object_bytes)
+        # ...and filtering never materialises the strings of the input
+        self.assertLess(peak, test_df.astype(object).memory_usage(deep=True).sum())
+
+    def test_masks(self):
+        test_df = pd.DataFrame({"column_A": pd.Series(["a", "b", None, "c"], dtype="category"),
+                                "column_B": [0.1, None, 0.3, 0.4]})
+        # missing values never match an inclusive criterion or a range...
+        nptesting.assert_array_equal(filter_samples.categorical_mask(test_df, column_A=["a", "b"]),
+                                     [True, True, False, False])
+        nptesting.assert_array_equal(filter_samples.numeric_mask(test_df, column_B=(0, 1)),
+                                     [True, False, True, True])
+        # ...but are kept by an exclusive criterion
+        nptesting.assert_array_equal(filter_samples.categorical_mask(test_df, not_column_A=["a", "b"]),
+                                     [False, False, True, True])
+        # no criteria
+        nptesting.assert_array_equal(filter_samples.categorical_mask(test_df), [True] * 4)
+        nptesting.assert_array_equal(filter_samples.numeric_mask(test_df), [True] * 4)
+
+    def test_parquet_filters(self):
+        # define schema for input
+        test_schema = pa.schema([("Sample", pa.dictionary(pa.int32(), pa.string())),
+                                 ("Outcome", pa.dictionary(pa.int32(), pa.string())),
+                                 ("pcMapped", pa.float64()),
+                                 ("column_D", pa.int64())])
+        # test Outcome is pushed down by default
+        self.assertEqual(filter_samples.parquet_filters(test_schema), [("Outcome", "in", ["Pass"])])
+        # test categorical and numerical filters
+        self.assertEqual(filter_samples.parquet_filters(test_schema, Outcome=["Fail"], Sample=["a", "b"],
+                                                        pcMapped=(90, 100), column_D=[1, 3]),
+                         [("Outcome", "in", ["Fail"]), ("Sample", "in", ["a", "b"]),
+                          ("pcMapped", ">=", 90), ("pcMapped", "<=", 100),
+                          ("column_D", ">=", 1), ("column_D", "<=", 3)])
+        # test 'not_' filters, invalid filters and unknown columns are not pushed down
+        self.assertEqual(filter_samples.parquet_filters(test_schema, not_Sample=["a"], Sample="a",
+                                                        pcMapped=(100, 90), column_D=["a", "b"], foo=["a"]),
+                         [("Outcome", "in", ["Pass"])])
+
+    def test_apply_filters(self):
+        # define dataframe for input
+        test_df = pd.DataFrame({"Outcome": pd.Series(["Fail", "Pass", "Pass", "Pass", "Pass"], dtype="category"),
+                                "pcMapped": pd.Series([0.1, 0.2, 0.3, 0.4, 0.5], dtype=float)})
+        # test no filters
+        nptesting.assert_array_equal(filter_samples.apply_filters(test_df, []).values, test_df.values)
+        # test categorical and numerical filters
+        outcome = filter_samples.apply_filters(test_df, [("Outcome", "in", ["Pass"]), ("pcMapped", ">=", 0.2),
+                                                         ("pcMapped", "<=", 0.4)])
+        nptesting.assert_array_equal(outcome.values, np.array([["Pass", 0.2],
+                                                               ["Pass", 0.3],
+                                                               ["Pass", 0.4]], dtype=object))
+        nptesting.assert_array_equal(outcome.index, [1, 2, 3])
+
+    def test_reference_values(self):
+        test_df = pd.DataFrame({"Sample": pd.Series(["a", "b", "c", "d"], dtype="category"),
+                                "Outcome": pd.Series(["Pass", "Fail", "Pass", "Pass"], dtype="category"),
+                                "pcMapped": [99.5, 99.5, 80.5, 99.5]})
+        kwargs = {"Sample": ["a", "b", "d"], "not_Outcome": ["Fail"], "pcMapped": (90, 100)}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            summary_filepath = os.path.join(temp_dir, "summary.csv")
+            filter_samples.utils.df_to_csv(test_df, summary_filepath, parquet=True)
+            # test both paths keep the unique values of inclusive categorical
+            # columns only, including the default 'Outcome' criterion
+            with mock.patch("btbphylo.filter_samples.CSV_CHUNKSIZE", 2):
+                for read in (filter_samples.csv_to_filtered_df, filter_samples.parquet_to_filtered_df):
+                    with self.subTest(read=read.__name__):
+                        _, reference_values = read(summary_filepath, **kwargs)
+                        self.assertDictEqual(reference_values, {"Outcome": {"Pass", "Fail"},
+                                                                "Sample": {"a", "b", "c", "d"}})
+            # test missing values are checked against the reference rather than df
+            with self.assertWarnsRegex(UserWarning, "does not contain the values 'z'$"):
+                filter_samples.categorical_mask(test_df.iloc[:1], reference_values, Sample=["b", "z"])
+
+    def test_filtered_df_empty(self):
+        test_df = pd.DataFrame({"Sample": pd.Series(["a", "b"], dtype="category"),
+                                "Outcome": pd.Series(["Pass", "Pass"], dtype="category"),
+                                "pcMapped": [99.5, 80.5]})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            summary_filepath = os.path.join(temp_dir, "summary.csv")
+            # test a filter which keeps nothing, from the parquet mirror and the csv
+            for parquet in (True, False):
+                with self.subTest(parquet=parquet):
+                    filter_samples.utils.df_to_csv(test_df, summary_filepath, parquet=parquet)
+                    df, metadata = filter_samples.get_wgs_samples_df(allow_wipe_out=True,
+                                                                     summary_filepath=summary_filepath,
+                                                                     Sample=["z"])
+                    self.assertListEqual(list(df.columns), list(test_df.columns))
+                    self.assertEqual(len(df), 0)
+                    self.assertDictEqual(metadata, {"number_of_passed_samples": 0})
+            # test a csv which yields no chunks at all
+            with mock.patch("btbphylo.filter_samples.utils.wgs_csv_to_df", return_value=iter([])):
+                df, reference_values = filter_samples.csv_to_filtered_df(summary_filepath, Sample=["z"])
+            pdtesting.assert_frame_equal(df, filter_samples.utils.empty_wgs_df())
+            self.assertDictEqual(reference_values, {"Outcome": set(), "Sample": set()})
+
+    def test_filter_clades(self):
+        # define dataframes for input
+        test_df = pd.DataFrame({"Sample": pd.Series(["a", "b", "c", "d", "e", "f", "g"], dtype="category"),
+                                "group": pd.Series(["X", "Y", "X", "Y", "Z", "X", "Y"], dtype="category"),
+                                "Outcome": pd.Series(["Pass", "Pass", "Pass", "Pass", "Pass", "Fail", "Pass"],
+                                                     dtype="category"),
+                                "Ncount": [1, 5, 3, 1, 0, 0, 2],
+                                "pcMapped": [99, 99, 99, 99, 99, 99, 90]})
+        test_clade_info = pd.DataFrame({"maxN": [2, 1]}, index=pd.Index(["Y", "X"], name="clade"))
+        # test samples are filtered per clade and ordered as in test_clade_info
+        outcome = filter_samples.filter_clades(test_df, test_clade_info)
+        nptesting.assert_array_equal(outcome["Sample"], ["d", "g", "a"])
+        # test additional filters
+        outcome = filter_samples.filter_clades(test_df, test_clade_info, pcMapped=(95, 100))
+        nptesting.assert_array_equal(outcome["Sample"], ["d", "a"])
+        # test equivalence with filtering each clade separately
+        expected = pd.concat([filter_samples.filter_df(test_df, allow_wipe_out=True, group=[clade],
+                                                       Ncount=(0, max_n))
+                              for clade, max_n in test_clade_info["maxN"].items()])
+        nptesting.assert_array_equal(filter_samples.filter_clades(test_df, test_clade_info).values,
+                                     expected.values)
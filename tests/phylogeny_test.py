@@ -1,43 +1,384 @@
 import unittest
 from unittest import mock
+import os
+import io
+import re
+import types
+import tempfile
+import contextlib
+import threading
 
+import numpy as np
 import pandas as pd
 import numpy.testing as nptesting
 
 from btbphylo import phylogeny
 
+# malformed s3 uris, each of which should raise BadS3UriError
+BAD_S3_URIS = ('s3://s3-csu-003', 's3://s3-csu-003abc', 's3://s3-csu-03/abc', 's3:/s3-csu-003/abc',
+               's4://s3-csu-003/abc', 's3://s5-abc-003/abc', 's3://s3-csu-abc/abc', 's3://s3-csu-1234/abc')
+
+# mock consensus files, as bytes: consensus files are copied in binary mode
+CONSENSUS_PAYLOADS = {"A": b">A\nAAA\nAAA\n", "B": b">B\nTTT\nTTT\n"}
+
+
+class FakeFile(io.BytesIO):
+    """
+        In-memory file for patching open(), recording the arguments it
+        was opened with and keeping its contents once closed
+    """
+    def __init__(self, filepath, mode="r", **kwargs):
+        super().__init__()
+        self.open_args = (filepath, mode, kwargs)
+
+    def close(self):
+        pass
+
+
+def fake_open(opened_files):
+    """
+        Returns a replacement for open() which appends a new FakeFile
+        to opened_files for each call
+    """
+    def _open(*args, **kwargs):
+        opened_files.append(FakeFile(*args, **kwargs))
+        return opened_files[-1]
+    return _open
+
+
+@contextlib.contextmanager
+def mock_multi_fasta_env(s3_keys):
+    """
+        Patches s3, open() and append_multi_fasta() for
+        build_multi_fasta(), where consensus files are stored under
+        s3_keys in 'foo_bucket'. Yields the mocks and the list of files
+        opened.
+    """
+    opened_files = []
+    with mock.patch("btbphylo.phylogeny.utils.get_s3_client"), \
+            mock.patch("btbphylo.phylogeny.utils.s3_download_file") as mock_s3_download_file, \
+            mock.patch("btbphylo.phylogeny.extract_s3_buckets_keys",
+                       return_value=(["foo_bucket"] * len(s3_keys), s3_keys)), \
+            mock.patch("btbphylo.phylogeny.append_multi_fasta") as mock_append_multi_fasta, \
+            mock.patch("builtins.open", fake_open(opened_files)):
+        yield types.SimpleNamespace(s3_download_file=mock_s3_download_file,
+                                    append_multi_fasta=mock_append_multi_fasta,
+                                    opened_files=opened_files)
+
 
 class TestPhylogeny(unittest.TestCase):
-    @mock.patch("btbphylo.phylogeny.utils.s3_download_file_cli")
-    @mock.patch("btbphylo.phylogeny.extract_s3_bucket")
-    @mock.patch("btbphylo.phylogeny.extract_s3_key")
-    def test_build_multi_fasta(self, _, mock_extract_s3_bucket, mock_extract_s3_key):
-        mock_extract_s3_bucket.return_value = "foo_bucket"
-        mock_extract_s3_key.return_value = "foo_key"
+    def test_build_multi_fasta(self):
         # test dataframe for input - 4 rows imitating 4 samples
         test_df = pd.DataFrame({"Sample": ["A", "B", "C", "D"],
                                 "ResultLoc": ["1", "2", "3", "4"]})
-        mock_open = mock.mock_open()
-        # mock open.read() to return 4 mock consensus sequences
-        mock_open().read.side_effect = ["AAA\nAAA", "TTT\nTTT", "CCC\nCCC", "GGG\nGGG"]
-        # run build_multi_fasta() with test_df and a patched open
-        with mock.patch("builtins.open", mock_open):
-            phylogeny.build_multi_fasta("foo", test_df, 'bar')
-        # calls to open to test against: 1 call for the output
-        # multifasta ("foo") and 4 calls for each consensus sequence
-        open_calls = [mock.call("foo", "wb"),
-                      mock.call(mock.ANY, "rb"),
-                      mock.call(mock.ANY, "rb"),
-                      mock.call(mock.ANY, "rb"),
-                      mock.call(mock.ANY, "rb")]
-        # assert that open was called with open_calls
-        mock_open.assert_has_calls(open_calls, any_order=True)
-        # assert that open.write() was called with mock consensus sequences
-        write_calls = [mock.call("AAA\nAAA"),
-                       mock.call("TTT\nTTT"),
-                       mock.call("CCC\nCCC"),
-                       mock.call("GGG\nGGG")]
-        mock_open().write.assert_has_calls(write_calls)
+        # run build_multi_fasta() with test_df, mocked s3 and a patched open
+        with mock_multi_fasta_env(["foo_key"] * 4) as env:
+            phylogeny.build_multi_fasta("foo", test_df, 'bar', n_workers=2)
+        # assert that all 4 consensus sequences were downloaded
+        download_calls = [mock.call("foo_bucket", "foo_key", "bar/A.fas", mock.ANY),
+                          mock.call("foo_bucket", "foo_key", "bar/B.fas", mock.ANY),
+                          mock.call("foo_bucket", "foo_key", "bar/C.fas", mock.ANY),
+                          mock.call("foo_bucket", "foo_key", "bar/D.fas", mock.ANY)]
+        env.s3_download_file.assert_has_calls(download_calls, any_order=True)
+        # assert that the output multifasta ("foo") was opened
+        self.assertListEqual([outfile.open_args for outfile in env.opened_files],
+                             [("foo", "wb", {"buffering": 1 << 20})])
+        # assert that each consensus sequence was appended in the order of
+        # test_df
+        append_calls = [mock.call(env.opened_files[0], "bar/A.fas"),
+                        mock.call(env.opened_files[0], "bar/B.fas"),
+                        mock.call(env.opened_files[0], "bar/C.fas"),
+                        mock.call(env.opened_files[0], "bar/D.fas")]
+        env.append_multi_fasta.assert_has_calls(append_calls)
+        # test etags of cached consensus files are listed once per s3 prefix
+        with mock_multi_fasta_env(["foo/A", "foo/B", "bar/C", "bar/D"]), \
+                mock.patch("btbphylo.phylogeny.path.exists") as mock_exists, \
+                mock.patch("btbphylo.phylogeny.utils.s3_list_etags") as mock_s3_list_etags, \
+                mock.patch("btbphylo.phylogeny.download_consensus") as mock_download_consensus:
+            mock_exists.side_effect = lambda filepath: filepath != "bar/D.fas"
+            mock_s3_list_etags.side_effect = [{"bar/C": ("etag_C", 1)}, {"foo/A": ("etag_A", 1)}]
+            phylogeny.build_multi_fasta("foo", test_df, 'bar', n_workers=2)
+        mock_s3_list_etags.assert_has_calls([mock.call("foo_bucket", "bar/", mock.ANY),
+                                             mock.call("foo_bucket", "foo/", mock.ANY)])
+        self.assertEqual(mock_s3_list_etags.call_count, 2)
+        self.assertListEqual([call.kwargs["s3_etag"] for call in mock_download_consensus.call_args_list],
+                             [("etag_A", 1), None, ("etag_C", 1), None])
+        # test a failed listing leaves download_consensus() to request the etags
+        with mock_multi_fasta_env(["foo/A", "foo/B", "bar/C", "bar/D"]), \
+                mock.patch("btbphylo.phylogeny.path.exists") as mock_exists, \
+                mock.patch("btbphylo.phylogeny.utils.s3_list_etags") as mock_s3_list_etags, \
+                mock.patch("btbphylo.phylogeny.download_consensus") as mock_download_consensus:
+            mock_exists.side_effect = lambda filepath: filepath != "bar/D.fas"
+            mock_s3_list_etags.side_effect = [phylogeny.botocore.exceptions.EndpointConnectionError(
+                endpoint_url="foo"), {"foo/A": ("etag_A", 1)}]
+            phylogeny.build_multi_fasta("foo", test_df, 'bar', n_workers=1)
+        self.assertListEqual([call.kwargs["s3_etag"] for call in mock_download_consensus.call_args_list],
+                             [("etag_A", 1), None, None, None])
+        # test nothing is listed if the cache is not validated
+        with mock_multi_fasta_env(["foo/A", "foo/B", "bar/C", "bar/D"]), \
+                mock.patch("btbphylo.phylogeny.path.exists", return_value=True), \
+                mock.patch("btbphylo.phylogeny.utils.s3_list_etags") as mock_s3_list_etags, \
+                mock.patch("btbphylo.phylogeny.download_consensus") as mock_download_consensus:
+            phylogeny.build_multi_fasta("foo", test_df, 'bar', n_workers=2, validate_cache=False)
+        mock_s3_list_etags.assert_not_called()
+        self.assertEqual(mock_download_consensus.call_count, 4)
+        self.assertFalse(any(call.args[4] for call in mock_download_consensus.call_args_list))
+        # test queued downloads are cancelled, rather than waited for, when
+        # appending fails: B's download (if it has started) is held until
+        # the executor shuts down, so C and D are still queued at that point
+        release = threading.Event()
+
+        class Executor(phylogeny.ThreadPoolExecutor):
+            def shutdown(self, wait=True, **kwargs):
+                if wait:
+                    release.set()
+                super().shutdown(wait, **kwargs)
+                release.set()
+
+        with mock_multi_fasta_env(["foo_key"] * 4) as env, \
+                mock.patch("btbphylo.phylogeny.ThreadPoolExecutor", Executor):
+            env.s3_download_file.side_effect = \
+                lambda bucket, key, dest, client: dest == "bar/A.fas" or release.wait(5)
+            env.append_multi_fasta.side_effect = OSError
+            with self.assertRaises(OSError):
+                phylogeny.build_multi_fasta("foo", test_df, 'bar', n_workers=1)
+        self.assertIn([call.args[2] for call in env.s3_download_file.call_args_list],
+                      (["bar/A.fas"], ["bar/A.fas", "bar/B.fas"]))
+
+    @mock.patch("btbphylo.phylogeny.utils.s3_download_file")
+    @mock.patch("btbphylo.phylogeny.utils.s3_object_etag")
+    def test_download_consensus(self, mock_s3_object_etag, mock_s3_download_file):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            consensus_filepath = os.path.join(temp_dir, "A.fas")
+            # test missing files are downloaded
+            phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath)
+            mock_s3_download_file.assert_called_once_with("foo_bucket", "foo_key",
+                                                          consensus_filepath, None)
+            mock_s3_object_etag.assert_not_called()
+            self.assertIsNone(phylogeny.utils.recorded_etag(consensus_filepath))
+            # test the etag of downloaded files is recorded, if known
+            phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath,
+                                         s3_etag=("0" * 32, 7))
+            self.assertEqual(phylogeny.utils.recorded_etag(consensus_filepath), "0" * 32)
+            mock_s3_object_etag.assert_not_called()
+            with open(consensus_filepath, "w") as f:
+                f.write(">A\nAAA\n")
+            # test cached files without a recorded etag are hashed once and
+            # not downloaded if they match the s3 object
+            phylogeny.utils.record_etag(consensus_filepath, None)
+            mock_s3_download_file.reset_mock()
+            mock_s3_object_etag.return_value = ("70187adf428710a2f33c9283417038a9", 7)
+            phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath)
+            mock_s3_download_file.assert_not_called()
+            self.assertEqual(phylogeny.utils.recorded_etag(consensus_filepath),
+                             "70187adf428710a2f33c9283417038a9")
+            # test cached files with a recorded etag are not hashed again
+            with mock.patch("btbphylo.phylogeny.utils.file_matches_etag") as mock_file_matches_etag:
+                phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath)
+                mock_file_matches_etag.assert_not_called()
+            mock_s3_download_file.assert_not_called()
+            # test cached files differing from the s3 object are downloaded
+            mock_s3_object_etag.return_value = ("0" * 32, 7)
+            phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath)
+            mock_s3_download_file.assert_called_once()
+            self.assertEqual(phylogeny.utils.recorded_etag(consensus_filepath), "0" * 32)
+            # test known etags are used rather than requested from s3
+            mock_s3_download_file.reset_mock()
+            mock_s3_object_etag.reset_mock()
+            phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath,
+                                         s3_etag=("0" * 32, 7))
+            mock_s3_object_etag.assert_not_called()
+            mock_s3_download_file.assert_not_called()
+            # test cached files are not checked if validate_cache is False
+            mock_s3_download_file.reset_mock()
+            mock_s3_object_etag.reset_mock()
+            phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath,
+                                         validate_cache=False)
+            mock_s3_object_etag.assert_not_called()
+            mock_s3_download_file.assert_not_called()
+            # test cached files are used, with a warning, if s3 can't be reached
+            # or the object is missing
+            for error in (phylogeny.utils.NoS3ObjectError("foo_bucket", "foo_key"),
+                          phylogeny.botocore.exceptions.ClientError({"Error": {"Code": "403"}},
+                                                                    "HeadObject"),
+                          phylogeny.botocore.exceptions.EndpointConnectionError(endpoint_url="foo")):
+                with self.subTest(error=type(error).__name__):
+                    mock_s3_object_etag.side_effect = error
+                    with self.assertWarns(UserWarning):
+                        phylogeny.download_consensus("foo_bucket", "foo_key", consensus_filepath)
+                    mock_s3_download_file.assert_not_called()
+
+    def test_append_multi_fasta(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # write 2 mock consensus sequences
+            for sample, consensus in CONSENSUS_PAYLOADS.items():
+                with open(os.path.join(temp_dir, f"{sample}.fas"), "wb") as f:
+                    f.write(consensus)
+            multi_fasta_path = os.path.join(temp_dir, "multi_fasta.fas")
+            # assert that the consensus sequences are copied verbatim,
+            # around any buffered writes to the output file
+            with open(multi_fasta_path, "wb") as outfile:
+                outfile.write(b"#")
+                phylogeny.append_multi_fasta(outfile, os.path.join(temp_dir, "A.fas"))
+                phylogeny.append_multi_fasta(outfile, os.path.join(temp_dir, "B.fas"))
+                outfile.write(b"#")
+            with open(multi_fasta_path, "rb") as f:
+                self.assertEqual(f.read(), b"#" + CONSENSUS_PAYLOADS["A"] + CONSENSUS_PAYLOADS["B"] + b"#")
+            # assert the fallback for outputs without a file descriptor
+            outfile = io.BytesIO()
+            phylogeny.append_multi_fasta(outfile, os.path.join(temp_dir, "A.fas"))
+            self.assertEqual(outfile.getvalue(), CONSENSUS_PAYLOADS["A"])
+            # assert partial copies are continued: sendfile copies 3 bytes
+            # at a time, then fails part way through the file
+            sendfile = os.sendfile
+            calls = []
+
+            def mock_sendfile(out_fd, in_fd, offset, count):
+                calls.append(offset)
+                if len(calls) > 2:
+                    raise OSError
+                return sendfile(out_fd, in_fd, offset, min(count, 3))
+
+            with open(multi_fasta_path, "wb") as outfile, \
+                    mock.patch("btbphylo.phylogeny.os.sendfile", side_effect=mock_sendfile):
+                phylogeny.append_multi_fasta(outfile, os.path.join(temp_dir, "A.fas"))
+            self.assertEqual(calls, [0, 3, 6])
+            with open(multi_fasta_path, "rb") as f:
+                self.assertEqual(f.read(), CONSENSUS_PAYLOADS["A"])
+
+    def test_fasta_line_length(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            fasta_path = os.path.join(temp_dir, "snps.fas")
+            for fasta, length in [(">A\nACGTA\n>B\nACGTT\n", 5),
+                                  (">A\r\nACG\r\n", 3),
+                                  (">A\nACGT", 4),
+                                  (">A\n", 0),
+                                  ("", 0)]:
+                with open(fasta_path, "w", newline="") as f:
+                    f.write(fasta)
+                self.assertEqual(phylogeny.fasta_line_length(fasta_path), length)
+
+    @mock.patch("btbphylo.phylogeny.utils.run")
+    def test_build_tree(self, mock_run):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snp_sites_outpath = os.path.join(temp_dir, "snps.fas")
+            # test mega is run for 4 or more taxa
+            with open(snp_sites_outpath, "w") as f:
+                f.write("".join(f">{sample}\nACGT\n" for sample in "ABCDE"))
+            self.assertEqual(phylogeny.count_fasta_records(snp_sites_outpath), 5)
+            self.assertEqual(phylogeny.count_fasta_records(snp_sites_outpath, limit=4), 4)
+            phylogeny.build_tree("tree", snp_sites_outpath)
+            mock_run.assert_called_once()
+            # test a warning is issued for fewer than 4 taxa, and for no taxa
+            mock_run.reset_mock()
+            for fasta in ["".join(f">{sample}\nACGT\n" for sample in "ABC"), ""]:
+                with open(snp_sites_outpath, "w") as f:
+                    f.write(fasta)
+                with self.assertWarns(UserWarning):
+                    phylogeny.build_tree("tree", snp_sites_outpath)
+            mock_run.assert_not_called()
+
+    def test_snp_distances(self):
+        # test alignment: N and - are ignored, as with snp-dists
+        test_input = np.array([list(b"ACGTA"),
+                               list(b"ACGTT"),
+                               list(b"TCNTT"),
+                               list(b"----T")], dtype=np.uint8)
+        test_output = np.array([[0, 1, 2, 1],
+                                [1, 0, 1, 0],
+                                [2, 1, 0, 0],
+                                [1, 0, 0, 0]])
+        nptesting.assert_array_equal(phylogeny.snp_distances(test_input), test_output)
+        # assert the same result when rows are compared one at a time
+        with mock.patch("btbphylo.phylogeny.BLOCK_BYTES", 1):
+            nptesting.assert_array_equal(phylogeny.snp_distances(test_input), test_output)
+        # test an alignment spanning several packed words against a
+        # site-by-site comparison
+        rng = np.random.default_rng(0)
+        test_input = rng.choice(np.frombuffer(b"ACGTN-", dtype=np.uint8), size=(6, 101))
+        acgt = np.isin(test_input, np.frombuffer(b"ACGT", dtype=np.uint8))
+        test_output = ((test_input[:, None] != test_input[None]) & acgt[:, None] & acgt[None]).sum(axis=-1)
+        nptesting.assert_array_equal(phylogeny.snp_distances(test_input), test_output)
+
+    @mock.patch("btbphylo.phylogeny.subprocess.Popen")
+    def test_snp_sites_to_snp_matrix(self, mock_popen):
+        mock_sites = mock.Mock(returncode=0, args=["snp-sites"])
+        mock_dists = mock.Mock(returncode=0, args=["snp-dists"])
+        mock_sites.wait.return_value = 0
+        mock_dists.wait.return_value = 0
+        mock_popen.side_effect = [mock_sites, mock_dists]
+        # mock snp-sites output, split across reads mid-sequence
+        mock_sites.stdout.read.side_effect = [b">A\nAC", b"GT\n>B\nAC", b"GA\n", b""]
+        with mock.patch("builtins.open", fake_open([])):
+            metadata = phylogeny.snp_sites_to_snp_matrix("foo", "bar", 2)
+        self.assertDictEqual(metadata, {"number_of_snps": 4})
+        # assert all of snp-sites' output was passed on to snp-dists
+        mock_dists.stdin.write.assert_has_calls([mock.call(b">A\nAC"), mock.call(b"GT\n>B\nAC"),
+                                                 mock.call(b"GA\n")])
+        mock_dists.stdin.close.assert_called()
+        # assert snp-sites' output is also written to snp_sites_outpath
+        mock_popen.side_effect = [mock_sites, mock_dists]
+        mock_sites.stdout.read.side_effect = [b">A\nAC", b"GT\n>B\nAC", b"GA\n", b""]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snp_sites_outpath = os.path.join(temp_dir, "snps.fas")
+            metadata = phylogeny.snp_sites_to_snp_matrix(os.path.join(temp_dir, "snps.csv"), "bar",
+                                                         snp_sites_outpath=snp_sites_outpath)
+            with open(snp_sites_outpath, "rb") as f:
+                self.assertEqual(f.read(), b">A\nACGT\n>B\nACGA\n")
+        self.assertDictEqual(metadata, {"number_of_snps": 4})
+        # assert exception if either process fails
+        mock_popen.side_effect = [mock_sites, mock_dists]
+        mock_sites.stdout.read.side_effect = [b""]
+        mock_dists.wait.return_value = 1
+        with mock.patch("builtins.open", fake_open([])):
+            with self.assertRaisesRegex(Exception, "exit code 1"):
+                phylogeny.snp_sites_to_snp_matrix("foo", "bar")
+        # assert snp-dists exiting early stops the pump, closes both pipes
+        # and reports snp-dists' exit code rather than snp-sites'
+        mock_popen.side_effect = [mock_sites, mock_dists]
+        mock_sites.stdout.read.side_effect = [b">A\nAC", b"GT\n"]
+        mock_sites.stdout.close.reset_mock()
+        mock_dists.stdin.close.reset_mock()
+        mock_dists.stdin.write.reset_mock()
+        mock_dists.stdin.write.side_effect = BrokenPipeError
+        mock_sites.wait.return_value = -13
+        mock_dists.wait.return_value = 2
+        with mock.patch("builtins.open", fake_open([])):
+            with self.assertRaisesRegex(Exception, r"snp-dists'\]\s+cmd failed with exit code 2"):
+                phylogeny.snp_sites_to_snp_matrix("foo", "bar")
+        mock_dists.stdin.write.assert_called_once()
+        mock_sites.stdout.close.assert_called()
+        mock_dists.stdin.close.assert_called()
+        mock_sites.kill.assert_not_called()
+        # assert processes are killed and waited for on other errors
+        mock_popen.side_effect = [mock_sites, mock_dists]
+        mock_sites.stdout.read.side_effect = OSError
+        mock_sites.poll.return_value = None
+        mock_dists.poll.return_value = None
+        mock_sites.wait.reset_mock()
+        mock_dists.wait.reset_mock()
+        with mock.patch("builtins.open", fake_open([])):
+            with self.assertRaises(OSError):
+                phylogeny.snp_sites_to_snp_matrix("foo", "bar")
+        for mock_ps in (mock_sites, mock_dists):
+            mock_ps.kill.assert_called_once()
+            mock_ps.wait.assert_called_once()
+
+    def test_extract_snp_sites_np(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            multi_fasta_path = os.path.join(temp_dir, "multi_fasta.fas")
+            # mock multi fasta with wrapped sequences: columns 1 and 6 are
+            # snp sites, column 4 varies but is N in sample B
+            with open(multi_fasta_path, "w") as f:
+                f.write(">A\nACGTA\nCGT\n>B\nACGAA\nNGT\n>C\nTCGAA\nCGT\n")
+            names, snps = phylogeny.extract_snp_sites_np(multi_fasta_path)
+            self.assertEqual(names, ["A", "B", "C"])
+            nptesting.assert_array_equal(snps, np.array([list(b"AT"), list(b"AA"), list(b"TA")]))
+            # assert exception if sequences are not aligned
+            with open(multi_fasta_path, "w") as f:
+                f.write(">A\nACGT\n>B\nACG\n")
+            with self.assertRaises(ValueError):
+                phylogeny.extract_snp_sites_np(multi_fasta_path)
 
     def test_extract_s3_bucket(self):
         # test good input
@@ -47,17 +388,9 @@ class TestPhylogeny(unittest.TestCase):
         test_output = ["s3-csu-003",
                        "s3-csu-123",
                        "s3-csu-001"]
-        fail = False
-        i = 0
         for input, output in zip(test_input, test_output):
-            try:
+            with self.subTest(input=input):
                 self.assertEqual(phylogeny.extract_s3_bucket(input), output)
-            except AssertionError as e:
-                i += 1
-                fail = True
-                print(f"Test failure {i}: ", e)
-        if fail:
-            print(f"{i} test failures")
 
     def test_extract_s3_key(self):
         # test good input
@@ -67,36 +400,49 @@ class TestPhylogeny(unittest.TestCase):
         test_output = ["abc/123/consensus/foo_consensus.fas",
                        "5/1/consensus/bar_consensus.fas",
                        "consensus/baz_consensus.fas"]
-        fail = False
-        i = 0
-        for input, output in zip(test_input, test_output):
-            try:
-                self.assertEqual(phylogeny.extract_s3_key(input[0], input[1]), output)
-            except AssertionError as e:
-                i += 1
-                fail = True
-                print(f"Test failure {i}: ", e)
-        if fail:
-            print(f"{i} test failures")
+        for (s3_uri, sample_name), output in zip(test_input, test_output):
+            with self.subTest(s3_uri=s3_uri, sample_name=sample_name):
+                self.assertEqual(phylogeny.extract_s3_key(s3_uri, sample_name), output)
+
+    def test_extract_s3_buckets_keys(self):
+        # test the same buckets and keys as extract_s3_bucket() and
+        # extract_s3_key()
+        test_uris = ["s3://s3-csu-003/abc/123/", "s3://s3-csu-123//5/1", "s3://s3-csu-001///"]
+        test_samples = ["foo", "bar", "baz"]
+        s3_buckets, s3_keys = \
+            phylogeny.extract_s3_buckets_keys(pd.Series(test_uris, dtype="category"),
+                                              pd.Series(test_samples, dtype="category"))
+        nptesting.assert_array_equal(s3_buckets, ["s3-csu-003", "s3-csu-123", "s3-csu-001"])
+        nptesting.assert_array_equal(s3_keys, ["abc/123/consensus/foo_consensus.fas",
+                                               "5/1/consensus/bar_consensus.fas",
+                                               "consensus/baz_consensus.fas"])
+        nptesting.assert_array_equal(s3_keys, [phylogeny.extract_s3_key(uri, sample)
+                                               for uri, sample in zip(test_uris, test_samples)])
+        # test exceptions
+        with self.assertRaises(phylogeny.BadS3UriError) as cm:
+            phylogeny.extract_s3_buckets_keys(pd.Series(["s3://s3-csu-003/abc", "s3://s3-csu-03/abc"]),
+                                              pd.Series(["foo", "bar"]))
+        self.assertEqual(cm.exception.message, "Incorrectly formatted s3 uri: 's3://s3-csu-03/abc'")
+        for s3_uri in BAD_S3_URIS:
+            with self.subTest(s3_uri=s3_uri), self.assertRaises(phylogeny.BadS3UriError):
+                phylogeny.extract_s3_buckets_keys(pd.Series([s3_uri]), pd.Series(["foo"]))
 
     def test_match_s3_uri(self):
         # test exceptions
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s3://s3-csu-003')
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s3://s3-csu-003abc')
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s3://s3-csu-03/abc')
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s3:/s3-csu-003/abc')
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s4://s3-csu-003/abc')
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s3://s5-abc-003/abc')
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s3://s3-csu-abc/abc')
-        with self.assertRaises(phylogeny.BadS3UriError):
-            phylogeny.match_s3_uri('s3://s3-csu-1234/abc')
+        for s3_uri in BAD_S3_URIS:
+            with self.subTest(s3_uri=s3_uri), self.assertRaises(phylogeny.BadS3UriError):
+                phylogeny.match_s3_uri(s3_uri)
+
+    def test_s3_uri_regex(self):
+        # test the s3 uri patterns are compiled once, at import
+        self.assertIsInstance(phylogeny._S3_URI_RE, re.Pattern)
+        self.assertIsInstance(phylogeny._S3_BUCKET_RE, re.Pattern)
+        # test match_s3_uri() uses the compiled pattern
+        with mock.patch("btbphylo.phylogeny._S3_URI_RE") as mock_s3_uri_re:
+            mock_s3_uri_re.match.return_value.group.return_value = "s3://s3-csu-003/"
+            self.assertEqual(phylogeny.match_s3_uri("s3://s3-csu-003/abc"), "s3://s3-csu-003/")
+            mock_s3_uri_re.match.assert_called_once_with("s3://s3-csu-003/abc")
+        self.assertEqual(phylogeny.match_s3_uri("s3://s3-csu-003//abc"), "s3://s3-csu-003//")
 
     def test_process_sample_name(self):
         # test cases
@@ -166,18 +512,9 @@ class TestPhylogeny(unittest.TestCase):
                        "1BCD2FGH",
                        "1BCD2FGH",
                        ""]
-        fail = False
-        i = 0
         for input, output in zip(test_input, test_output):
-            try:
+            with self.subTest(input=input):
                 self.assertEqual(phylogeny.process_sample_name(input), output)
-            except AssertionError as e:
-                i += 1
-                fail = True
-                print(f"Test failure {i}: ", e)
-        if fail:
-            print(f"{i} test failures")
-            raise AssertionError
 
     @mock.patch("btbphylo.phylogeny.process_sample_name")
     def test_post_process_snps_df(self, mock_process_sample_name):
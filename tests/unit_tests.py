@@ -1,5 +1,8 @@
+import io
+import os
 import unittest
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 from phylogeny_test import TestPhylogeny
 from filter_samples_test import TestFilterSamples
@@ -15,50 +18,126 @@ def test_suit(test_objs):
     return suit
 
 
+def run_test(test_id):
+    """
+        Runs a single test, given by its id, e.g.
+        'phylogeny_test.TestPhylogeny.test_build_tree'. Returns whether
+        the test passed and the test runner's output.
+    """
+    stream = io.StringIO()
+    result = unittest.TextTestRunner(stream=stream).run(
+        unittest.defaultTestLoader.loadTestsFromName(test_id))
+    return result.wasSuccessful(), stream.getvalue()
+
+
+def run_parallel(test_objs, n_workers=None):
+    """
+        Runs each test in test_objs in a separate process, using
+        n_workers processes (defaults to the number of cpus). Prints the
+        output of failing tests and returns True if all tests passed.
+    """
+    test_ids = [test_obj.id() for test_obj in test_objs]
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(run_test, test_ids))
+    failures = [(test_id, output) for test_id, (passed, output) in
+                zip(test_ids, results) if not passed]
+    for test_id, output in failures:
+        print(f"FAIL: {test_id}\n{output}")
+    print(f"Ran {len(test_ids)} tests: {len(failures)} failed")
+    return not failures
+
+
 if __name__ == "__main__":
     phylogeny_test = [TestPhylogeny('test_build_multi_fasta'),
+                      TestPhylogeny('test_download_consensus'),
+                      TestPhylogeny('test_append_multi_fasta'),
+                      TestPhylogeny('test_fasta_line_length'),
+                      TestPhylogeny('test_build_tree'),
+                      TestPhylogeny('test_snp_distances'),
+                      TestPhylogeny('test_snp_sites_to_snp_matrix'),
+                      TestPhylogeny('test_extract_snp_sites_np'),
                       TestPhylogeny('test_extract_s3_bucket'),
+                      TestPhylogeny('test_extract_s3_key'),
+                      TestPhylogeny('test_extract_s3_buckets_keys'),
                       TestPhylogeny('test_match_s3_uri'),
+                      TestPhylogeny('test_s3_uri_regex'),
                       TestPhylogeny('test_process_sample_name'),
                       TestPhylogeny('test_post_process_snps_df')]
     filter_samples_test = [TestFilterSamples('test_filter_df'),
+                           TestFilterSamples('test_filter_df_vectorised'),
                            TestFilterSamples('test_filter_columns_numeric'),
-                           TestFilterSamples('test_filter_columns_categorical')]
+                           TestFilterSamples('test_filter_columns_numeric_dtypes'),
+                           TestFilterSamples('test_numeric_mask_uses_arrays'),
+                           TestFilterSamples('test_filter_columns_categorical'),
+                           TestFilterSamples('test_filter_columns_categorical_uses_codes'),
+                           TestFilterSamples('test_parquet_filters'),
+                           TestFilterSamples('test_apply_filters'),
+                           TestFilterSamples('test_reference_values'),
+                           TestFilterSamples('test_filtered_df_empty'),
+                           TestFilterSamples('test_filter_clades'),
+                           TestFilterSamples('test_masks')]
     de_duplicate_test = [TestDeDuplicate('test_remove_duplicates'),
+                         TestDeDuplicate('test_remove_duplicates_scale'),
+                         TestDeDuplicate('test_remove_duplicates_without_groupby'),
+                         TestDeDuplicate('test_sort_and_drop_duplicates'),
                          TestDeDuplicate('test_get_indexes_to_remove')]
     update_summary_test = [TestUpdateSummary('test_append_df_wgs'),
+                           TestUpdateSummary('test_list_batch_prefixes'),
                            TestUpdateSummary('test_get_finalout_s3_keys'),
-                           TestUpdateSummary('test_extract_s3_key')]
+                           TestUpdateSummary('test_new_final_out_keys'),
+                           TestUpdateSummary('test_get_df_wgs')]
     missing_samples_report_test = [TestMissingSamplesReport('test_get_excluded'),
                                    TestMissingSamplesReport('test_exclusion_reason'),
                                    TestMissingSamplesReport('test_missing_data'),
                                    TestMissingSamplesReport('test_add_eartag_column')]
     consistify_test = [TestConsistify('test_consistify'),
                        TestConsistify('test_clade_correction')]
-    utils_test = [TestUtils('test_extract_submission_no')]
+    utils_test = [TestUtils('test_extract_submission_no'),
+                  TestUtils('test_get_s3_client'),
+                  TestUtils('test_parquet_mirror'),
+                  TestUtils('test_arrow_csv_to_df'),
+                  TestUtils('test_s3_download_file'),
+                  TestUtils('test_s3_list_etags'),
+                  TestUtils('test_concat_chunks'),
+                  TestUtils('test_git_head_sha'),
+                  TestUtils('test_link_or_copy'),
+                  TestUtils('test_dump_json'),
+                  TestUtils('test_file_matches_etag')]
     runner = unittest.TextTestRunner()
     parser = argparse.ArgumentParser(description='Test code')
     module_arg = parser.add_argument('--module', '-m', nargs=1,
                                      help="module to test: phylogeny, update_summary, filter_samples, de_duplicate, consistify or uitls'",
                                      default=None)
+    parser.add_argument('--parallel', '-p', type=int, nargs='?', const=os.cpu_count(), default=None,
+                        help="run each test in a separate process, using this many processes (defaults to the number of cpus)")
     args = parser.parse_args()
+
+    def run(test_objs):
+        if args.parallel:
+            # run tests in a process pool rather than with runner
+            return run_parallel(test_objs, args.parallel)
+        return runner.run(test_suit(test_objs))
+
     if args.module:
         if args.module[0] == 'phylogeny':
-            runner.run(test_suit(phylogeny_test))
+            run(phylogeny_test)
         elif args.module[0] == 'filter_samples':
-            runner.run(test_suit(filter_samples_test))
+            run(filter_samples_test)
         elif args.module[0] == 'de_duplicate':
-            runner.run(test_suit(de_duplicate_test))
+            run(de_duplicate_test)
         elif args.module[0] == 'update_summary':
-            runner.run(test_suit(update_summary_test))
+            run(update_summary_test)
         elif args.module[0] == 'missing_samples_report':
-            runner.run(test_suit(missing_samples_report_test))
+            run(missing_samples_report_test)
         elif args.module[0] == 'consistify':
-            runner.run(test_suit(consistify_test))
+            run(consistify_test)
         elif args.module[0] == 'utils':
-            runner.run(test_suit(utils_test))
+            run(utils_test)
         else:
             raise argparse.ArgumentError(module_arg,
                                          "Invalid argument. Please use phylogeny, update_summary, filter_samples, consistify or utils")
+    elif args.parallel:
+        run(phylogeny_test + filter_samples_test + de_duplicate_test + update_summary_test +
+            missing_samples_report_test + consistify_test + utils_test)
     else:
         unittest.main(buffer=True)
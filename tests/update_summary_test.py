@@ -1,6 +1,7 @@
 import unittest
 from unittest import mock
 
+import numpy as np
 import pandas as pd
 import numpy.testing as nptesting
 
@@ -8,62 +9,74 @@ from btbphylo import update_summary
 
 
 class TestUpdateSummary(unittest.TestCase):
+    @mock.patch("btbphylo.update_summary.utils.get_s3_client")
     @mock.patch("btbphylo.update_summary.finalout_s3_to_df")
-    def test_append_df_wgs(self, mock_finalout_s3_to_df):
-        mock_finalout_s3_to_df.return_value = pd.DataFrame()
-        # simulate 7 new keys
+    def test_append_df_wgs(self, mock_finalout_s3_to_df, _):
+        # simulate 7 new keys, each returning a FinalOut.csv with 1 sample
         test_new_keys = [0, 1, 2, 3, 4, 5, 6]
+        test_finalouts = [pd.DataFrame({"Sample": [sample], "bar": [sample]})
+                          for sample in ["a", "b", "c", "d", "e", "f", "g"]]
+        # return values depend on the key; downloads are not called in order
+        mock_finalout_s3_to_df.side_effect = \
+            lambda key, **kwargs: test_finalouts[key]
         # start with empty df_summary
-        test_df_wgs = pd.DataFrame({"foo": [], "bar": [], "baz": []})
-        with mock.patch("btbphylo.update_summary.add_submission_col") as mock_add_submission_col:
-            # mock sequential return values of calls to update_summary.add_submission_col,
-            # this effectively mocks the return value of finalout_csv_to_df(new_keys[itteration]).pipe(add_submission_col)
-            mock_add_submission_col.side_effect = [pd.DataFrame({"foo": ["a"], "bar": ["a"], "baz": ["a"]}),
-                                                   pd.DataFrame({"foo": ["b"], "bar": ["b"], "baz": ["b"]}),
-                                                   pd.DataFrame({"foo": ["c"], "bar": ["c"], "baz": ["c"]}),
-                                                   pd.DataFrame({"foo": ["d"], "bar": ["d"], "baz": ["d"]}),
-                                                   pd.DataFrame({"foo": ["e"], "bar": ["e"], "baz": ["e"]}),
-                                                   pd.DataFrame({"foo": ["f"], "bar": ["f"], "baz": ["f"]}),
-                                                   pd.DataFrame({"foo": ["g"], "bar": ["g"], "baz": ["g"]})]
-            test_output, _ = update_summary.append_df_wgs(test_df_wgs, test_new_keys)
-            # assert correct output
-            nptesting.assert_array_equal(test_output,
-                                         pd.DataFrame({"foo": ["a", "b", "c", "d", "e", "f", "g"],
-                                                       "bar": ["a", "b", "c", "d", "e", "f", "g"],
-                                                       "baz": ["a", "b", "c", "d", "e", "f", "g"]}).values)
-            finalout_csv_to_df_calls = [mock.call(0), mock.call(1), mock.call(2), mock.call(3),
-                                        mock.call(4), mock.call(5), mock.call(6)]
-            # assert recursion was called with correct order of arguments
-            mock_finalout_s3_to_df.assert_has_calls(finalout_csv_to_df_calls)
+        test_df_wgs = pd.DataFrame({"Sample": [], "bar": [], "Submission": []})
+        test_output, metadata = update_summary.append_df_wgs(test_df_wgs, test_new_keys, n_workers=4)
+        # assert correct output: in the order of test_new_keys
+        nptesting.assert_array_equal(test_output,
+                                     np.array([[sample, sample, sample.upper()] for sample in "abcdefg"],
+                                              dtype=object))
+        self.assertDictEqual(metadata, {"total_number_of_wgs_samples": 7})
+        # assert each FinalOut.csv was downloaded once
+        finalout_s3_to_df_calls = [mock.call(0, s3_client=mock.ANY), mock.call(1, s3_client=mock.ANY),
+                                   mock.call(2, s3_client=mock.ANY), mock.call(3, s3_client=mock.ANY),
+                                   mock.call(4, s3_client=mock.ANY), mock.call(5, s3_client=mock.ANY),
+                                   mock.call(6, s3_client=mock.ANY)]
+        mock_finalout_s3_to_df.assert_has_calls(finalout_s3_to_df_calls, any_order=True)
+        self.assertEqual(mock_finalout_s3_to_df.call_count, 7)
+        # assert no new keys leaves df_summary unchanged
+        test_output, _ = update_summary.append_df_wgs(test_df_wgs, [])
+        self.assertTrue(test_output.empty)
 
-    def test_get_finalout_s3_keys(self):
-        # mock AWS s3 CLI command for getting s3 metadata
-        with mock.patch("btbphylo.update_summary.utils.run") as mock_run:
-            mock_run.return_value = "2022-06-28 06:38:51      45876 v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv\n \
-                                     2022-06-28 06:38:51 45876 v3-2/Results_10032_27Jun22/bar\n \
-                                     a b c foo"
-            test_output = ["v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv",
-                           "v3-2/Results_10032_27Jun22/bar",
-                           "foo"]
-            self.assertEqual(update_summary.get_finalout_s3_keys(), test_output)
+    def test_get_df_wgs(self):
+        # test a missing summary csv gives an empty dataframe with the
+        # summary csv's columns and dtypes
+        test_output = update_summary.get_df_wgs("/no/such/summary.csv")
+        self.assertEqual(len(test_output), 0)
+        self.assertEqual(test_output.columns.to_list(),
+                         list(update_summary.utils.SUMMARY_DTYPES.keys()))
+        self.assertTrue(pd.api.types.is_categorical_dtype(test_output["group"]))
+        self.assertTrue(pd.api.types.is_float_dtype(test_output["Ncount"]))
 
-    def test_extract_s3_key(self):
-        # test case
-        test_input = ["2022-06-28 06:38:51      45876 v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv",
-                      "2022-06-28 06:38:51 45876 v3-2/Results_10032_27Jun22/bar",
-                      "a b c foo"]
-        test_output = ["v3-2/Results_10032_27Jun22/10032_FinalOut_28Jun22.csv",
-                       "v3-2/Results_10032_27Jun22/bar",
-                       "foo"]
-        fail = False
-        for input, output in zip(test_input, test_output):
-            try:
-                self.assertEqual(update_summary.extract_s3_key(input), output)
-            except AssertionError as e:
-                fail = True
-                print(e)
-        if fail:
-            raise AssertionError
+    @mock.patch("btbphylo.update_summary.utils.get_s3_client")
+    def test_list_batch_prefixes(self, mock_get_s3_client):
+        # mock paginated s3 listing of batch prefixes
+        mock_paginate = mock_get_s3_client().get_paginator().paginate
+        mock_paginate.return_value = [{"CommonPrefixes": [{"Prefix": "v3-2/Results_10032_27Jun22/"},
+                                                          {"Prefix": "v3-2/Results_10033_28Jun22/"}]},
+                                      {"CommonPrefixes": [{"Prefix": "v3-2/Results_10034_29Jun22/"}]},
+                                      {}]
+        self.assertEqual(update_summary.list_batch_prefixes(), ["v3-2/Results_10032_27Jun22/",
+                                                                "v3-2/Results_10033_28Jun22/",
+                                                                "v3-2/Results_10034_29Jun22/"])
+        mock_paginate.assert_called_once_with(Bucket="s3-csu-003", Prefix="v3-2/", Delimiter="/")
+
+    @mock.patch("btbphylo.update_summary.utils.get_s3_client")
+    def test_get_finalout_s3_keys(self, mock_get_s3_client):
+        # mock paginated s3 listing of 2 batches, returning pages by prefix
+        test_pages = {"v3-2/A/": [{"Contents": [{"Key": "v3-2/A/A_FinalOut_28Jun22.csv"},
+                                                {"Key": "v3-2/A/bar"}]}],
+                      "v3-2/B/": [{"Contents": [{"Key": "v3-2/B/foo"}]},
+                                  {"Contents": [{"Key": "v3-2/B/B_FinalOut_29Jun22.csv"}]}]}
+        mock_get_s3_client().get_paginator().paginate.side_effect = \
+            lambda Bucket, Prefix: test_pages[Prefix]
+        # assert FinalOut.csv keys are returned in the order of the batches
+        self.assertEqual(update_summary.get_finalout_s3_keys(batch_prefixes=["v3-2/A/", "v3-2/B/"]),
+                         ["v3-2/A/A_FinalOut_28Jun22.csv", "v3-2/B/B_FinalOut_29Jun22.csv"])
+        # assert all batches listed if batch_prefixes not provided
+        with mock.patch("btbphylo.update_summary.list_batch_prefixes") as mock_list_batch_prefixes:
+            mock_list_batch_prefixes.return_value = ["v3-2/B/"]
+            self.assertEqual(update_summary.get_finalout_s3_keys(), ["v3-2/B/B_FinalOut_29Jun22.csv"])
 
     def test_new_final_out_keys(self):
         # test case
@@ -76,14 +89,14 @@ class TestUpdateSummary(unittest.TestCase):
                                               "s3://s3-csu-003/v3-2/D/",
                                               "s3://s3-csu-003/v3-2/D/",
                                               "s3://s3-csu-003/v3-2/E/"]})
-        # mock get_finalout_s3_keys
-        with mock.patch("btbphylo.update_summary.get_finalout_s3_keys") as mock_get_finalout_s3_keys:
-            mock_get_finalout_s3_keys.return_value = ["v3-2/A/FinalOut.csv",
-                                                      "v3-2/B/FinalOut.csv",
-                                                      "v3-2/C/FinalOut.csv",
-                                                      "v3-2/D/FinalOut.csv",
-                                                      "v3-2/E/FinalOut.csv",
-                                                      "v3-2/F/FinalOut.csv",
+        # mock list_batch_prefixes and get_finalout_s3_keys
+        with mock.patch("btbphylo.update_summary.list_batch_prefixes") as mock_list_batch_prefixes, \
+                mock.patch("btbphylo.update_summary.get_finalout_s3_keys") as mock_get_finalout_s3_keys:
+            mock_list_batch_prefixes.return_value = ["v3-2/A/", "v3-2/B/", "v3-2/C/", "v3-2/D/",
+                                                     "v3-2/E/", "v3-2/F/", "v3-2/G/"]
+            mock_get_finalout_s3_keys.return_value = ["v3-2/F/FinalOut.csv",
                                                       "v3-2/G/FinalOut.csv"]
             self.assertEqual(update_summary.new_final_out_keys(test_df), ["v3-2/F/FinalOut.csv",
                                                                           "v3-2/G/FinalOut.csv"])
+            # assert only new batches are listed
+            mock_get_finalout_s3_keys.assert_called_once_with(batch_prefixes=["v3-2/F/", "v3-2/G/"])
@@ -1,4 +1,12 @@
 import unittest
+from unittest import mock
+import os
+import json
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pandas.testing as pdtesting
 
 from btbphylo import utils as utils
 
@@ -80,3 +88,222 @@ class TestUtils(unittest.TestCase):
         if fail:
             print(f"{i} test failures")
             raise AssertionError
+
+    @mock.patch("btbphylo.utils._s3_client", None)
+    @mock.patch("btbphylo.utils.boto3.session.Session")
+    def test_get_s3_client(self, mock_session):
+        # assert that concurrent callers all get the same client
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            clients = list(executor.map(lambda _: utils.get_s3_client(), range(32)))
+        self.assertTrue(all(client is clients[0] for client in clients))
+        mock_session.assert_called_once()
+        mock_session().client.assert_called_once_with("s3", config=mock.ANY)
+
+    def test_parquet_mirror(self):
+        test_df = pd.DataFrame({"Sample": pd.Series(["A", "B"], dtype="category"),
+                                "pcMapped": [90.5, 99.5],
+                                "Submission": ["AF-A", "AF-B"]})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            summary_filepath = os.path.join(temp_dir, "summary.csv")
+            # test the csv is read if there is no parquet mirror
+            utils.df_to_csv(test_df, summary_filepath)
+            self.assertFalse(utils.parquet_is_fresh(summary_filepath))
+            pdtesting.assert_frame_equal(utils.wgs_csv_to_df(summary_filepath), test_df)
+            # test the parquet mirror is read, with the same dtypes as the csv
+            utils.df_to_csv(test_df, summary_filepath, parquet=True)
+            self.assertTrue(utils.parquet_is_fresh(summary_filepath))
+            with mock.patch("btbphylo.utils.pd.read_csv") as mock_read_csv:
+                pdtesting.assert_frame_equal(utils.wgs_csv_to_df(summary_filepath), test_df)
+                mock_read_csv.assert_not_called()
+            # test reading a subset of columns, from the mirror and the csv
+            pdtesting.assert_frame_equal(utils.wgs_csv_to_df(summary_filepath,
+                                                             columns=["Sample"]),
+                                         test_df[["Sample"]])
+            os.remove(utils.parquet_filepath(summary_filepath))
+            pdtesting.assert_frame_equal(utils.wgs_csv_to_df(summary_filepath,
+                                                             columns=["Sample"]),
+                                         test_df[["Sample"]])
+            utils.df_to_csv(test_df, summary_filepath, parquet=True)
+            # test freshness does not depend on the mirror's own mtime
+            os.utime(utils.parquet_filepath(summary_filepath), (0, 0))
+            self.assertTrue(utils.parquet_is_fresh(summary_filepath))
+            # test a mirror is stale once the csv is edited, even within the
+            # same timestamp tick
+            csv_stat = os.stat(summary_filepath)
+            with open(summary_filepath, "a") as f:
+                f.write("C,80.5,AF-C\n")
+            os.utime(summary_filepath, ns=(csv_stat.st_atime_ns, csv_stat.st_mtime_ns))
+            self.assertFalse(utils.parquet_is_fresh(summary_filepath))
+            self.assertEqual(len(utils.wgs_csv_to_df(summary_filepath)), 3)
+            # test a mirror is stale if the csv is touched
+            utils.df_to_csv(test_df, summary_filepath, parquet=True)
+            os.utime(summary_filepath, ns=(csv_stat.st_atime_ns, csv_stat.st_mtime_ns + 1))
+            self.assertFalse(utils.parquet_is_fresh(summary_filepath))
+            # test mirrors without recorded csv metadata are never fresh
+            test_df.to_parquet(utils.parquet_filepath(summary_filepath), index=False)
+            self.assertFalse(utils.parquet_is_fresh(summary_filepath))
+
+    def test_arrow_csv_to_df(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            summary_filepath = os.path.join(temp_dir, "summary.csv")
+            # mock summary csv with missing values and an untyped column
+            with open(summary_filepath, "w") as f:
+                f.write("Sample,GenomeCov,Outcome,Submission,foo\n"
+                        "B,1.5,Pass,AF-B,3\n"
+                        "A,,Fail,,\n"
+                        "C,NA,,AF-C,5\n")
+            # assert the same dataframe (and categories) as pandas.read_csv
+            pdtesting.assert_frame_equal(utils.arrow_csv_to_df(summary_filepath, utils.SUMMARY_DTYPES),
+                                         pd.read_csv(summary_filepath, dtype=utils.SUMMARY_DTYPES))
+            # assert fall back to pandas for csvs with comments
+            with open(summary_filepath, "w") as f:
+                f.write("# comment\nSample,GenomeCov\nA,1.5\n")
+            pdtesting.assert_frame_equal(utils.wgs_csv_to_df(summary_filepath),
+                                         pd.DataFrame({"Sample": pd.Series(["A"], dtype="category"),
+                                                       "GenomeCov": [1.5]}))
+
+    def test_s3_download_file(self):
+        mock_s3_client = mock.Mock()
+        utils.s3_download_file("foo_bucket", "foo_key", "bar", mock_s3_client)
+        mock_s3_client.download_file.assert_called_once_with("foo_bucket", "foo_key", "bar",
+                                                             Config=utils.S3_TRANSFER_CONFIG)
+        # test missing objects raise NoS3ObjectError
+        mock_s3_client.download_file.side_effect = \
+            utils.botocore.exceptions.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        with self.assertRaises(utils.NoS3ObjectError):
+            utils.s3_download_file("foo_bucket", "foo_key", "bar", mock_s3_client)
+        # test other errors are re-raised
+        mock_s3_client.download_file.side_effect = \
+            utils.botocore.exceptions.ClientError({"Error": {"Code": "403"}}, "HeadObject")
+        with self.assertRaises(utils.botocore.exceptions.ClientError):
+            utils.s3_download_file("foo_bucket", "foo_key", "bar", mock_s3_client)
+
+    def test_s3_list_etags(self):
+        mock_s3_client = mock.Mock()
+        mock_s3_client.get_paginator.return_value.paginate.return_value = \
+            [{"Contents": [{"Key": "foo/A", "ETag": '"etag_A"', "Size": 1},
+                           {"Key": "foo/B", "ETag": '"etag_B-2"', "Size": 2}]},
+             {"Contents": [{"Key": "foo/C", "ETag": '"etag_C"', "Size": 3}]}, {}]
+        self.assertDictEqual(utils.s3_list_etags("foo_bucket", "foo/", mock_s3_client),
+                             {"foo/A": ("etag_A", 1), "foo/B": ("etag_B-2", 2), "foo/C": ("etag_C", 3)})
+        mock_s3_client.get_paginator.assert_called_once_with("list_objects_v2")
+        mock_s3_client.get_paginator.return_value.paginate.assert_called_once_with(Bucket="foo_bucket",
+                                                                                   Prefix="foo/")
+
+    def test_concat_chunks(self):
+        test_input = [pd.DataFrame({"Sample": pd.Series(["B", "A"], dtype="category"),
+                                    "pcMapped": [90.5, 99.5]}),
+                      pd.DataFrame({"Sample": pd.Series(["C"], index=[2], dtype="category"),
+                                    "pcMapped": [80.5]}, index=[2])]
+        expected = pd.DataFrame({"Sample": pd.Series(["B", "A", "C"], dtype="category"),
+                                 "pcMapped": [90.5, 99.5, 80.5]})
+        pdtesting.assert_frame_equal(utils.concat_chunks(iter(test_input)), expected)
+        # test no chunks give an empty summary dataframe
+        pdtesting.assert_frame_equal(utils.concat_chunks(iter([])), utils.empty_wgs_df())
+        # test a csv which only pandas can parse is read in chunks
+        with tempfile.TemporaryDirectory() as temp_dir:
+            summary_filepath = os.path.join(temp_dir, "summary.csv")
+            with open(summary_filepath, "w") as f:
+                f.write("# comment\nSample,pcMapped\nB,90.5\nA,99.5\nC,80.5\n")
+            with mock.patch("btbphylo.utils.CSV_CHUNKSIZE", 2):
+                pdtesting.assert_frame_equal(utils.wgs_csv_to_df(summary_filepath), expected)
+
+    @mock.patch("btbphylo.utils.subprocess.check_output")
+    def test_git_head_sha(self, mock_check_output):
+        test_sha = "0123456789abcdef0123456789abcdef01234567"
+        with tempfile.TemporaryDirectory() as temp_dir:
+            git_dir = os.path.join(temp_dir, ".git")
+            os.makedirs(os.path.join(git_dir, "refs", "heads"))
+            # test a branch with a loose ref
+            with open(os.path.join(git_dir, "HEAD"), "w") as f:
+                f.write("ref: refs/heads/main\n")
+            with open(os.path.join(git_dir, "refs", "heads", "main"), "w") as f:
+                f.write(test_sha + "\n")
+            self.assertEqual(utils.git_head_sha(temp_dir), test_sha)
+            # test a branch with a packed ref
+            with open(os.path.join(git_dir, "HEAD"), "w") as f:
+                f.write("ref: refs/heads/dev\n")
+            with open(os.path.join(git_dir, "packed-refs"), "w") as f:
+                f.write(f"# pack-refs with: peeled fully-peeled sorted\n"
+                        f"{test_sha} refs/heads/dev\n")
+            self.assertEqual(utils.git_head_sha(temp_dir), test_sha)
+            # test a detached HEAD
+            with open(os.path.join(git_dir, "HEAD"), "w") as f:
+                f.write(test_sha + "\n")
+            self.assertEqual(utils.git_head_sha(temp_dir), test_sha)
+            mock_check_output.assert_not_called()
+            # test falling back to git if .git can not be read
+            mock_check_output.return_value = (test_sha + "\n").encode()
+            self.assertEqual(utils.git_head_sha(os.path.join(temp_dir, "foo")), test_sha)
+            mock_check_output.assert_called_once()
+
+    def test_link_or_copy(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            src = os.path.join(temp_dir, "src.csv")
+            dst = os.path.join(temp_dir, "dst.csv")
+            with open(src, "w") as f:
+                f.write("foo")
+            # test dst is linked to src
+            utils.link_or_copy(src, dst)
+            self.assertTrue(os.path.samefile(src, dst))
+            # test linking again does nothing
+            utils.link_or_copy(src, dst)
+            self.assertTrue(os.path.samefile(src, dst))
+            # test rewriting src with df_to_csv does not alter dst
+            utils.df_to_csv(pd.DataFrame({"Sample": ["A"]}), src)
+            self.assertFalse(os.path.samefile(src, dst))
+            with open(dst) as f:
+                self.assertEqual(f.read(), "foo")
+            # test src is copied over an existing dst if it can't be linked
+            with mock.patch("btbphylo.utils.os.link", side_effect=OSError):
+                utils.link_or_copy(src, dst)
+            self.assertFalse(os.path.samefile(src, dst))
+            pdtesting.assert_frame_equal(pd.read_csv(dst), pd.DataFrame({"Sample": ["A"]}))
+            # test an unchanged copy is not copied again
+            with mock.patch("btbphylo.utils.os.link", side_effect=OSError), \
+                    mock.patch("btbphylo.utils.shutil.copy2") as mock_copy2:
+                utils.link_or_copy(src, dst)
+                mock_copy2.assert_not_called()
+            # test a failed link and copy leaves the existing dst in place
+            os.utime(src, ns=(0, 0))
+            with mock.patch("btbphylo.utils.os.link", side_effect=OSError), \
+                    mock.patch("btbphylo.utils.shutil.copy2", side_effect=OSError):
+                with self.assertRaises(OSError):
+                    utils.link_or_copy(src, dst)
+            pdtesting.assert_frame_equal(pd.read_csv(dst), pd.DataFrame({"Sample": ["A"]}))
+            # test a fresh parquet mirror is linked with the csv
+            utils.df_to_csv(pd.DataFrame({"Sample": ["A"]}), src, parquet=True)
+            utils.link_or_copy_summary(src, dst)
+            self.assertTrue(os.path.samefile(src, dst))
+            self.assertTrue(utils.parquet_is_fresh(dst))
+            # test no temporary files are left behind
+            self.assertEqual(sorted(os.listdir(temp_dir)),
+                             ["dst.csv", "dst.parquet", "src.csv", "src.parquet"])
+
+    def test_dump_json(self):
+        test_obj = {"foo": {"bar": (0, 1.5)}, "baz": [1, "a"]}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            json_filepath = os.path.join(temp_dir, "foo.json")
+            # test json and orjson (if installed) write the same file
+            utils.dump_json(test_obj, json_filepath)
+            with open(json_filepath) as f:
+                test_output = f.read()
+            with mock.patch("btbphylo.utils.orjson", None):
+                utils.dump_json(test_obj, json_filepath)
+            with open(json_filepath) as f:
+                self.assertEqual(f.read(), test_output)
+            self.assertEqual(json.loads(test_output),
+                             {"foo": {"bar": [0, 1.5]}, "baz": [1, "a"]})
+
+    def test_file_matches_etag(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filepath = os.path.join(temp_dir, "A.fas")
+            with open(filepath, "w") as f:
+                f.write(">A\nAAA\n")
+            # single part uploads: the ETag is the md5 of the content
+            self.assertTrue(utils.file_matches_etag(filepath, "70187adf428710a2f33c9283417038a9", 7))
+            self.assertFalse(utils.file_matches_etag(filepath, "0" * 32, 7))
+            self.assertFalse(utils.file_matches_etag(filepath, "70187adf428710a2f33c9283417038a9", 8))
+            # multipart uploads: only the size is compared
+            self.assertTrue(utils.file_matches_etag(filepath, "0" * 32 + "-2", 7))
+            self.assertFalse(utils.file_matches_etag(filepath, "0" * 32 + "-2", 8))